@@ -0,0 +1,9 @@
+import pytest
+from django.core.cache import caches
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    """Cached search results shouldn't leak between tests"""
+    for cache in caches.all():
+        cache.clear()
@@ -0,0 +1,19 @@
+from django.apps import AppConfig
+
+from regcore import search_cache
+from regcore.signals import documents_changed, layers_changed
+
+
+class RegcoreConfig(AppConfig):
+    name = 'regcore'
+
+    def ready(self):
+        from regcore import typeahead
+        documents_changed.connect(search_cache.documents_written,
+                                  dispatch_uid='regcore_search_cache_docs')
+        layers_changed.connect(search_cache.layers_written,
+                               dispatch_uid='regcore_search_cache_layers')
+        documents_changed.connect(typeahead.documents_written,
+                                  dispatch_uid='regcore_typeahead_docs')
+        layers_changed.connect(typeahead.layers_written,
+                               dispatch_uid='regcore_typeahead_layers')
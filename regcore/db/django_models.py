@@ -4,9 +4,12 @@ import collections
 
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
+from django.db.models import Q
 
 from regcore.db import interface
-from regcore.models import Diff, Document, Layer, Notice
+from regcore.diff import ancestor_labels
+from regcore.models import Diff, DiffEntry, Document, Layer, Notice
+from regcore.signals import documents_changed, layers_changed
 
 
 def treeify(node, tree_id, pos=1, level=0):
@@ -101,6 +104,8 @@ class DMDocuments(interface.Documents):
             doc_type=doc_type,
             label_string__startswith=root_label,
         ).delete()
+        documents_changed.send(sender=self.__class__, doc_type=doc_type,
+                               label=root_label, version=version)
 
     def bulk_insert(self, regs, doc_type, version):
         """Store all document objects"""
@@ -108,6 +113,9 @@ class DMDocuments(interface.Documents):
         Document.objects.bulk_create(
             [self._transform(r, doc_type, version) for r in regs],
             batch_size=settings.BATCH_SIZE)
+        documents_changed.send(sender=self.__class__, doc_type=doc_type,
+                               label='-'.join(regs[0]['label']),
+                               version=version)
 
     def listing(self, doc_type, label=None):
         """List regulation version-label pairs that match this label (or are
@@ -139,12 +147,17 @@ class DMLayers(interface.Layers):
         # @todo - use regex to avoid deleting 222-11 when replacing 22
         Layer.objects.filter(name=layer_name, doc_type=doc_type,
                              doc_id__startswith=root_doc_id).delete()
+        layers_changed.send(sender=self.__class__, doc_type=doc_type,
+                            doc_id=root_doc_id, name=layer_name)
 
     def bulk_insert(self, layers, layer_name, doc_type):
         """Store all layer objects"""
         Layer.objects.bulk_create(
             [self._transform(l, layer_name, doc_type) for l in layers],
             batch_size=settings.BATCH_SIZE)
+        if layers:
+            layers_changed.send(sender=self.__class__, doc_type=doc_type,
+                                doc_id=layers[0]['doc_id'], name=layer_name)
 
     def get(self, name, doc_type, doc_id):
         """Find the layer that matches these parameters"""
@@ -198,21 +211,45 @@ class DMNotices(interface.Notices):
 
 
 class DMDiffs(interface.Diffs):
-    """Implementation of Django-models as diff backend"""
-    def insert(self, label, old_version, new_version, diff):
+    """Implementation of Django-models as diff backend. Each diff's entries
+    are also stored individually, so that a slice of the diff can be read
+    without decompressing all of it"""
+    def insert(self, label, old_version, new_version, diff, summary=None):
         """Store a diff between two versions of a regulation node"""
-        Diff(label=label, old_version=old_version, new_version=new_version,
-             diff=diff).save()
+        model = Diff(label=label, old_version=old_version,
+                     new_version=new_version, diff=diff, summary=summary)
+        model.save()
+        if isinstance(diff, dict):
+            DiffEntry.objects.bulk_create(
+                DiffEntry(diff=model, label=entry_label, entry=entry)
+                for entry_label, entry in diff.items())
 
     def delete(self, label, old_version, new_version):
         Diff.objects.filter(label=label, old_version=old_version,
                             new_version=new_version).delete()
 
     def get(self, label, old_version, new_version):
-        """Find the associated diff"""
-        try:
-            diff = Diff.objects.get(label=label, old_version=old_version,
-                                    new_version=new_version)
-            return diff.diff
-        except ObjectDoesNotExist:
+        """Find the associated diff or, failing that, the entries within
+        `label` of the nearest ancestor's diff"""
+        candidates = Diff.objects.filter(
+            label__in=ancestor_labels(label), old_version=old_version,
+            new_version=new_version).values_list('pk', 'label')
+        if not candidates:
             return None
+        pk, diff_label = max(candidates, key=lambda pair: len(pair[1]))
+        if diff_label == label:
+            return Diff.objects.get(pk=pk).diff
+        entries = DiffEntry.objects.filter(diff_id=pk).filter(
+            Q(label=label) | Q(label__startswith=label + '-'))
+        return {entry.label: entry.entry for entry in entries}
+
+    def get_summary(self, label, old_version, new_version):
+        """Read the stored summary, if present, rather than the diff"""
+        summaries = Diff.objects.filter(
+            label=label, old_version=old_version,
+            new_version=new_version).values_list('summary', flat=True)
+        summary = next(iter(summaries), None)
+        if summary is None:
+            summary = super(DMDiffs, self).get_summary(
+                label, old_version, new_version)
+        return summary
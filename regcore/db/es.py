@@ -1,16 +1,48 @@
 """Each of the data structures relevant to the API (regulations, notices,
 etc.), implemented using Elastic Search as a data store"""
+import json
 import logging
+import threading
+import time
+from collections import defaultdict
+from functools import partial
+from multiprocessing.pool import ThreadPool
 
-from cached_property import cached_property
 from django.conf import settings
-from pyelasticsearch import ElasticSearch
-from pyelasticsearch.exceptions import ElasticHttpNotFoundError
+from pyelasticsearch import ElasticSearch, bulk_chunks
+from pyelasticsearch.exceptions import (
+    BulkError, ElasticHttpError, ElasticHttpNotFoundError)
 
 from regcore.db import interface
+from regcore.diff import ancestor_labels, slice_diff, summarize
+from regcore.labels import section_label
+from regcore.signals import documents_changed, layers_changed
 
 logger = logging.getLogger(__name__)
 
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client():
+    """Process-wide Elastic Search client for the current settings. Clients
+    are thread safe and keep a pool of keep-alive connections to each node, so
+    we share one rather than reconnecting per request (or per lookup)"""
+    key = (tuple(settings.ELASTIC_SEARCH_URLS),
+           settings.ELASTIC_SEARCH_TIMEOUT,
+           settings.ELASTIC_SEARCH_MAX_RETRIES)
+    client = _clients.get(key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                client = ElasticSearch(
+                    list(settings.ELASTIC_SEARCH_URLS),
+                    timeout=settings.ELASTIC_SEARCH_TIMEOUT,
+                    max_retries=settings.ELASTIC_SEARCH_MAX_RETRIES)
+                _clients[key] = client
+    return client
+
 
 def sanitize_doc_id(doc_id):
     """Not strictly required, but remove slashes from Elastic Search ids"""
@@ -19,21 +51,133 @@ def sanitize_doc_id(doc_id):
 
 class ESBase(object):
     """Shared code for Elastic Search storage models"""
+    def __init__(self, index=None):
+        self._index = index
 
-    @cached_property
+    @property
+    def index(self):
+        """Index (or alias) to read and write. Defaults to
+        ELASTIC_SEARCH_INDEX; the reindex command writes elsewhere"""
+        return self._index or settings.ELASTIC_SEARCH_INDEX
+
+    @property
     def es(self):
-        return ElasticSearch(settings.ELASTIC_SEARCH_URLS)
+        return get_client()
 
-    def safe_fetch(self, doc_type, es_id):
+    def safe_fetch(self, doc_type, es_id, source=None):
         """Attempt to retrieve a document from Elastic Search.
+        :param source: if set, only fetch these fields of the document
         :return: Found document, if it exists, otherwise None"""
+        kwargs = {}
+        if source is not None:
+            kwargs['es__source'] = source
         try:
-            result = self.es.get(settings.ELASTIC_SEARCH_INDEX, doc_type,
-                                 es_id)
+            result = self.es.get(self.index, doc_type,
+                                 es_id, **kwargs)
             return result['_source']
         except ElasticHttpNotFoundError:
             return None
 
+    def safe_fetch_many(self, doc_type, es_ids):
+        """Retrieve several documents with a single (multi-get) request.
+        :return: dict of each id to the found document or None"""
+        es_ids = list(es_ids)
+        found = dict.fromkeys(es_ids)
+        if es_ids:
+            response = self.es.multi_get(es_ids, index=self.index,
+                                         doc_type=doc_type)
+            for doc in response['docs']:
+                if doc.get('found'):
+                    found[doc['_id']] = doc['_source']
+        return found
+
+    def bulk_index(self, doc_type, docs):
+        """Index many documents (each with an "id"). Rather than a single
+        request, documents are split into chunks of (at most)
+        ELASTIC_SEARCH_BULK_BYTES, which are sent concurrently. Throttled
+        (429) requests and items are retried with exponential backoff.
+        :raises BulkError: listing every item which failed, once all chunks
+        have been attempted"""
+        actions = []
+        for doc in docs:
+            doc = dict(doc)     # copy
+            meta = {'index': {'_id': doc.pop('id')}}
+            actions.append(json.dumps(meta) + '\n' + json.dumps(doc))
+        chunks = list(bulk_chunks(
+            actions, docs_per_chunk=None,
+            bytes_per_chunk=settings.ELASTIC_SEARCH_BULK_BYTES))
+        send = partial(self._send_chunk, doc_type)
+        if len(chunks) > 1:
+            pool = ThreadPool(
+                min(len(chunks), settings.ELASTIC_SEARCH_BULK_WORKERS))
+            try:
+                results = pool.map(send, chunks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [send(chunk) for chunk in chunks]
+
+        errors = [error for result in results for error in result]
+        for error in errors:
+            for op, details in error.items():
+                logger.error('Failed to %s %s/%s (%s): %s', op, doc_type,
+                             details.get('_id'), details.get('status'),
+                             details.get('error'))
+        if errors:
+            raise BulkError(errors, [])
+
+    def _send_chunk(self, doc_type, chunk):
+        """Send a chunk of bulk actions, retrying any which are throttled.
+        :return: the errors for items which failed"""
+        retries = settings.ELASTIC_SEARCH_BULK_RETRIES
+        pending, errors = chunk, []
+        for attempt in range(retries + 1):
+            if attempt:
+                time.sleep(settings.ELASTIC_SEARCH_BULK_BACKOFF *
+                           2 ** (attempt - 1))
+            try:
+                self.es.bulk(pending, index=self.index,
+                             doc_type=doc_type)
+                return errors
+            except ElasticHttpError as err:
+                if err.status_code != 429 or attempt == retries:
+                    raise
+            except BulkError as err:
+                by_id = {json.loads(action.split('\n', 1)[0])['index']['_id']:
+                         action for action in pending}
+                pending = []
+                for error in err.errors:
+                    details = list(error.values())[0]
+                    if details.get('status') == 429 and attempt < retries:
+                        pending.append(by_id[details['_id']])
+                    else:
+                        errors.append(error)
+                if not pending:
+                    return errors
+        return errors
+
+    def scroll(self, doc_type, query):
+        """Iterate over every hit for a query, fetching a page (of
+        ELASTIC_SEARCH_SCROLL_SIZE hits) at a time via the scroll API"""
+        keep_alive = settings.ELASTIC_SEARCH_SCROLL_KEEP_ALIVE
+        result = self.es.search(
+            query, index=self.index, doc_type=doc_type,
+            size=settings.ELASTIC_SEARCH_SCROLL_SIZE, es_scroll=keep_alive)
+        try:
+            while result['hits']['hits']:
+                for hit in result['hits']['hits']:
+                    yield hit
+                result = self.es.send_request(
+                    'GET', ['_search', 'scroll'], body=result['_scroll_id'],
+                    query_params={'scroll': keep_alive})
+        finally:
+            try:
+                self.es.send_request('DELETE', ['_search', 'scroll'],
+                                     body=result['_scroll_id'])
+            except ElasticHttpError:
+                pass    # expires on its own
+
     def bulk_delete(self, *args, **kwarg):
         logger.warning("Elastic Search backend doesn't handle deletes")
 
@@ -41,52 +185,217 @@ class ESBase(object):
         logger.warning("Elastic Search backend doesn't handle deletes")
 
 
+def tree_positions(root):
+    """Nested-set positions (as in MPTT) for each node in a tree, keyed by
+    label_string, along with each node's parent label and position among its
+    siblings"""
+    positions = {}
+
+    def visit(node, left, parent=None, position=0):
+        right = left + 1
+        for idx, child in enumerate(node.get('children', [])):
+            right = visit(child, right, node, idx) + 1
+        positions['-'.join(node['label'])] = {
+            'left': left,
+            'right': right,
+            'parent': '-'.join(parent['label']) if parent else None,
+            'position': position,
+        }
+        return right
+    visit(root, 1)
+    return positions
+
+
 class ESDocuments(ESBase, interface.Documents):
-    """Implementation of Elastic Search as regulations backend"""
+    """Implementation of Elastic Search as regulations backend. Nodes are
+    stored flat (without their children); each records its parent and its
+    nested-set range within the tree it was written with, so a subtree can be
+    retrieved with a single range query.
+
+    Re-writing part of a tree (e.g. a single section) moves its nodes to a
+    tree of their own, leaving gaps in the ranges of their ancestors. Those
+    are noticed by counting the nodes in the range, in which case the subtree
+    is walked via parent labels instead"""
+    # Fields from the original node which are returned by `get`
+    NODE_FIELDS = ('label', 'text', 'title', 'node_type')
+
     def get(self, doc_type, label, version):
         """Find the regulation label + version"""
         reg_node = self.safe_fetch('reg_tree', version + '/' + label)
-        if reg_node is not None:
-            del reg_node['regulation']
-            del reg_node['version']
-            del reg_node['label_string']
-            del reg_node['id']
+        if reg_node is None:
+            return None
+        if 'left' not in reg_node:
+            # Stored before nodes were flattened; the subtree is inline
+            for field in ('regulation', 'version', 'label_string', 'id'):
+                reg_node.pop(field, None)
             return reg_node
 
-    def _transform(self, reg, doc_type, version):
+        query = {
+            'query': {'filtered': {'filter': self._subtree_filter(reg_node)}},
+            'sort': [{'left': 'asc'}],
+        }
+        size = self._subtree_size(reg_node)
+        flat_nodes = list(self._subtree_nodes(query, size))
+        if len(flat_nodes) != size:
+            flat_nodes = self._walk_subtree(reg_node)
+        return self._assemble(flat_nodes)
+
+    def get_many(self, doc_type, labels, version):
+        """Find several nodes (and their subtrees) of a single version with
+        two requests: a multi-get for the nodes and a search for all of their
+        descendants"""
+        fetched = self.safe_fetch_many(
+            'reg_tree', [version + '/' + label for label in labels])
+        results, flat_nodes = {}, {}
+        for label in labels:
+            reg_node = fetched[version + '/' + label]
+            if reg_node is not None and 'left' not in reg_node:
+                for field in ('regulation', 'version', 'label_string', 'id'):
+                    reg_node.pop(field, None)
+                results[label] = reg_node
+            elif reg_node is not None:
+                flat_nodes[label] = reg_node
+            else:
+                results[label] = None
+        if not flat_nodes:
+            return results
+
+        query = {
+            'query': {'filtered': {'filter': {'bool': {'should': [
+                self._subtree_filter(reg_node)
+                for reg_node in flat_nodes.values()]}}}},
+            'sort': [{'tree': 'asc'}, {'left': 'asc'}],
+        }
+        hits = list(self._subtree_nodes(
+            query, sum(self._subtree_size(n) for n in flat_nodes.values())))
+        for label, reg_node in flat_nodes.items():
+            subtree = [hit for hit in hits
+                       if hit['tree'] == reg_node['tree'] and
+                       reg_node['left'] <= hit['left'] <= reg_node['right']]
+            if len(subtree) != self._subtree_size(reg_node):
+                subtree = self._walk_subtree(reg_node)
+            results[label] = self._assemble(subtree)
+        return results
+
+    def _subtree_nodes(self, query, size):
+        """The flat nodes matching a subtree query, of which there are `size`.
+        Larger subtrees are scrolled through a page at a time, as a single
+        page can't exceed the index's max_result_window"""
+        if size <= settings.ELASTIC_SEARCH_SCROLL_SIZE:
+            result = self.es.search(query, index=self.index,
+                                    doc_type='reg_tree', size=size)
+            hits = result['hits']['hits']
+        else:
+            hits = self.scroll('reg_tree', query)
+        return (hit['_source'] for hit in hits)
+
+    def _walk_subtree(self, reg_node):
+        """The flat nodes of a subtree whose range is inconsistent, found a
+        level at a time by their parents' labels.
+        :return: the nodes in tree (pre-)order"""
+        children, parents = defaultdict(list), [reg_node['label_string']]
+        while parents:
+            query = {'query': {'filtered': {'filter': {'bool': {'must': [
+                {'term': {'doc_type': reg_node['doc_type']}},
+                {'term': {'version': reg_node['version']}},
+                {'terms': {'parent': parents}},
+            ]}}}}}
+            level = [hit['_source'] for hit in self.scroll('reg_tree', query)]
+            for flat_node in level:
+                children[flat_node['parent']].append(flat_node)
+            parents = [flat_node['label_string'] for flat_node in level]
+
+        ordered, to_visit = [], [reg_node]
+        while to_visit:
+            flat_node = to_visit.pop()
+            ordered.append(flat_node)
+            to_visit.extend(sorted(children[flat_node['label_string']],
+                                   key=lambda child: child.get('position', 0),
+                                   reverse=True))
+        return ordered
+
+    @staticmethod
+    def _subtree_filter(reg_node):
+        return {'bool': {'must': [
+            {'term': {'tree': reg_node['tree']}},
+            {'range': {'left': {'gte': reg_node['left'],
+                                'lte': reg_node['right']}}},
+        ]}}
+
+    @staticmethod
+    def _subtree_size(reg_node):
+        return (reg_node['right'] - reg_node['left'] + 1) // 2
+
+    def _assemble(self, flat_nodes):
+        """Rebuild a tree from flat nodes, sorted in tree (pre-)order"""
+        root, by_label = None, {}
+        for flat_node in flat_nodes:
+            node = {key: flat_node[key] for key in self.NODE_FIELDS
+                    if key in flat_node}
+            node['children'] = []
+            by_label[flat_node['label_string']] = node
+            parent = by_label.get(flat_node['parent'])
+            if root is None:
+                root = node
+            elif parent is not None:
+                parent['children'].append(node)
+        return root
+
+    def _transform(self, reg, doc_type, version, tree, positions):
         """Add some meta data fields which are ES specific"""
-        node = dict(reg)  # copy
+        node = {key: reg[key] for key in self.NODE_FIELDS if key in reg}
         node['doc_type'] = doc_type
         node['version'] = version
         node['label_string'] = '-'.join(node['label'])
         node['regulation'] = node['label'][0]
         node['id'] = version + '/' + node['label_string']
         node['root'] = len(node['label']) == 1
+        node['section'] = section_label(node['label_string'])
         node['is_subpart'] = (
             'Subpart' in node['label'] or
             'Subjgrp' in node['label']
         )
+        node['tree'] = tree
+        node.update(positions[node['label_string']])
         return node
 
     def bulk_insert(self, regs, doc_type, version):
-        """Store all reg objects"""
-        self.es.bulk_index(
-            settings.ELASTIC_SEARCH_INDEX, 'reg_tree',
-            [self._transform(r, doc_type, version) for r in regs],
-        )
+        """Store all reg objects. The first is the root of the tree"""
+        tree = version + '/' + '-'.join(regs[0]['label'])
+        positions = tree_positions(regs[0])
+        self.bulk_index(
+            'reg_tree',
+            [self._transform(r, doc_type, version, tree, positions)
+             for r in regs])
+        documents_changed.send(sender=self.__class__, doc_type=doc_type,
+                               label='-'.join(regs[0]['label']),
+                               version=version)
 
     def listing(self, doc_type, label=None):
         """List regulation version-label pairs that match this label (or are
         root, if label is None)"""
         if label is None:
-            query = {'match': {'root': True, 'doc_type': doc_type}}
+            match = {'root': True, 'doc_type': doc_type}
         else:
-            query = {'match': {'label_string': label, 'doc_type': doc_type}}
-        query = {'fields': ['label_string', 'version'], 'query': query}
-        result = self.es.search(query, index=settings.ELASTIC_SEARCH_INDEX,
-                                doc_type='reg_tree', size=100)
-        return sorted((res['fields']['version'], res['fields']['label_string'])
-                      for res in result['hits']['hits'])
+            match = {'label_string': label, 'doc_type': doc_type}
+        # Rather than fetching (a page of) matching nodes, aggregate their
+        # distinct version + label pairs; a size of 0 returns every bucket
+        query = {
+            'query': {'filtered': {'filter': {'bool': {'must': [
+                {'term': {field: value}}
+                for field, value in sorted(match.items())]}}}},
+            'aggs': {'versions': {
+                'terms': {'field': 'version', 'size': 0},
+                'aggs': {'labels': {
+                    'terms': {'field': 'label_string', 'size': 0}}},
+            }},
+        }
+        result = self.es.search(query, index=self.index,
+                                doc_type='reg_tree', size=0)
+        return sorted(
+            (version['key'], label['key'])
+            for version in result['aggregations']['versions']['buckets']
+            for label in version['labels']['buckets'])
 
 
 class ESLayers(ESBase, interface.Layers):
@@ -99,9 +408,12 @@ class ESLayers(ESBase, interface.Layers):
 
     def bulk_insert(self, layers, layer_name, doc_type):
         """Store all layer objects."""
-        self.es.bulk_index(
-            settings.ELASTIC_SEARCH_INDEX, 'layer',
+        self.bulk_index(
+            'layer',
             [self._transform(l, layer_name, doc_type) for l in layers])
+        if layers:
+            layers_changed.send(sender=self.__class__, doc_type=doc_type,
+                                doc_id=layers[0]['doc_id'], name=layer_name)
 
     def get(self, name, doc_type, doc_id):
         """Find the layer that matches these parameters"""
@@ -110,18 +422,31 @@ class ESLayers(ESBase, interface.Layers):
         if layer is not None:
             return layer['layer']
 
+    def get_many(self, name, doc_type, doc_ids):
+        """Find several layers with a single request"""
+        references = {':'.join([name, doc_type, sanitize_doc_id(doc_id)]):
+                      doc_id for doc_id in doc_ids}
+        layers = self.safe_fetch_many('layer', references)
+        return {doc_id: (layers[reference]['layer']
+                         if layers[reference] is not None else None)
+                for reference, doc_id in references.items()}
+
 
 class ESNotices(ESBase, interface.Notices):
     """Implementation of Elastic Search as notice backend"""
     def insert(self, doc_number, notice):
         """Store a single notice"""
-        self.es.index(settings.ELASTIC_SEARCH_INDEX, 'notice', notice,
+        self.es.index(self.index, 'notice', notice,
                       id=doc_number)
 
     def get(self, doc_number):
         """Find the associated notice"""
         return self.safe_fetch('notice', doc_number)
 
+    def get_many(self, doc_numbers):
+        """Find several notices with a single request"""
+        return self.safe_fetch_many('notice', doc_numbers)
+
     def listing(self, part=None):
         """All notices or filtered by cfr_part"""
         if part:
@@ -130,13 +455,9 @@ class ESNotices(ESBase, interface.Notices):
             query = {'match_all': {}}
         query = {'fields': ['effective_on', 'fr_url', 'publication_date'],
                  'query': query}
-        notices = []
-        results = self.es.search(query, doc_type='notice', size=100,
-                                 index=settings.ELASTIC_SEARCH_INDEX)
-        for notice in results['hits']['hits']:
+        for notice in self.scroll('notice', query):
             notice['fields']['document_number'] = notice['_id']
-            notices.append(notice['fields'])
-        return notices
+            yield notice['fields']
 
 
 class ESDiffs(ESBase, interface.Diffs):
@@ -145,7 +466,7 @@ class ESDiffs(ESBase, interface.Diffs):
     def to_id(label, old, new):
         return '/'.join([label, old, new])
 
-    def insert(self, label, old_version, new_version, diff):
+    def insert(self, label, old_version, new_version, diff, summary=None):
         """Store a diff between two versions of a regulation node"""
         struct = {
             'label': label,
@@ -153,12 +474,48 @@ class ESDiffs(ESBase, interface.Diffs):
             'new_version': new_version,
             'diff': diff
         }
-        self.es.index(settings.ELASTIC_SEARCH_INDEX, 'diff', struct,
+        if summary is not None:
+            struct['summary'] = summary
+        self.es.index(self.index, 'diff', struct,
                       id=self.to_id(label, old_version, new_version))
 
     def get(self, label, old_version, new_version):
-        """Find the associated diff"""
+        """Find the associated diff or, failing that, the entries within
+        `label` of the nearest ancestor's diff"""
         diff = self.safe_fetch('diff',
                                self.to_id(label, old_version, new_version))
         if diff is not None:
             return diff['diff']
+        return self.ancestor_slice(label, old_version, new_version)
+
+    def ancestor_slice(self, label, old_version, new_version):
+        """The entries within `label` of the nearest ancestor's diff"""
+        keys = [(ancestor, old_version, new_version)
+                for ancestor in ancestor_labels(label)[1:]]
+        diffs = self.get_many(keys)
+        for key in keys:
+            if diffs[key] is not None:
+                return slice_diff(diffs[key], label)
+
+    def get_summary(self, label, old_version, new_version):
+        """Fetch only the summary stored alongside the diff. Diffs indexed
+        without one (and slices of ancestors' diffs) are summarized"""
+        es_id = self.to_id(label, old_version, new_version)
+        doc = self.safe_fetch('diff', es_id, source='summary')
+        if doc is None:
+            diff = self.ancestor_slice(label, old_version, new_version)
+        elif 'summary' in doc:
+            return doc['summary']
+        else:
+            doc = self.safe_fetch('diff', es_id, source='diff')
+            diff = doc and doc['diff']
+        if diff is not None:
+            return summarize(diff)
+
+    def get_many(self, keys):
+        """Find several diffs with a single request"""
+        ids = {self.to_id(*key): key for key in keys}
+        diffs = self.safe_fetch_many('diff', ids)
+        return {key: (diffs[diff_id]['diff']
+                      if diffs[diff_id] is not None else None)
+                for diff_id, key in ids.items()}
@@ -3,6 +3,8 @@ import abc
 
 import six
 
+from regcore.diff import summarize
+
 
 @six.add_metaclass(abc.ABCMeta)
 class Documents(object):
@@ -27,6 +29,11 @@ class Documents(object):
         match the provided label (or all root regs), sorted by version"""
         raise NotImplementedError
 
+    def get_many(self, doc_type, labels, version):
+        """Return a dict of label to regulation node (or None). Backends may
+        override this to fetch in bulk"""
+        return {label: self.get(doc_type, label, version) for label in labels}
+
 
 @six.add_metaclass(abc.ABCMeta)
 class Layers(object):
@@ -51,6 +58,12 @@ class Layers(object):
         """Return a single layer (no meta data) or None"""
         raise NotImplementedError
 
+    def get_many(self, name, doc_type, doc_ids):
+        """Return a dict of doc_id to layer (or None). Backends may override
+        this to fetch in bulk"""
+        return {doc_id: self.get(name, doc_type, doc_id)
+                for doc_id in doc_ids}
+
 
 @six.add_metaclass(abc.ABCMeta)
 class Notices(object):
@@ -67,8 +80,14 @@ class Notices(object):
         """Return matching notice or None"""
         raise NotImplementedError
 
+    def get_many(self, doc_numbers):
+        """Return a dict of doc_number to notice (or None). Backends may
+        override this to fetch in bulk"""
+        return {doc_number: self.get(doc_number)
+                for doc_number in doc_numbers}
+
     def listing(self, part=None):
-        """Return all notices or notices by part"""
+        """Return (an iterable of) all notices or notices by part"""
         raise NotImplementedError
 
 
@@ -80,13 +99,28 @@ class Diffs(object):
            :param str new_version:"""
         raise NotImplementedError
 
-    def insert(self, label, old_version, new_version, diff):
+    def insert(self, label, old_version, new_version, diff, summary=None):
         """:param str label:
            :param str old_version:
            :param str new_version:
-           :param dict diff:"""
+           :param dict diff:
+           :param dict summary: see regcore.diff.summarize"""
         raise NotImplementedError
 
     def get(self, label, old_version, new_version):
-        """Return matching diff or None"""
+        """Return matching diff or, if there's none, the entries within
+        `label` of the nearest ancestor's diff. None if neither exists"""
         raise NotImplementedError
+
+    def get_summary(self, label, old_version, new_version):
+        """Return the summary of the diff `get` would return, or None.
+        Backends may override this to avoid fetching the diff itself"""
+        diff = self.get(label, old_version, new_version)
+        if diff is not None:
+            return summarize(diff)
+
+    def get_many(self, keys):
+        """:param keys: (label, old_version, new_version) triples
+        Return a dict of key to diff (or None). Backends may override this to
+        fetch in bulk"""
+        return {key: self.get(*key) for key in keys}
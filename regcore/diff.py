@@ -0,0 +1,166 @@
+"""Node-level diffs between two versions of a regulation tree, in the format
+uploaded by the parser. A diff maps each changed node's label string to one
+of:
+    {'op': 'added', 'node': the node, with `child_labels` for `children`}
+    {'op': 'deleted'}
+    {'op': 'modified', 'text': ops, 'title': ops, 'child_ops': ops}
+where a modified node only includes the components which changed. Text and
+title ops are ("delete", start, end) or ("insert", position, text), with
+character positions in the old version. Child ops also include
+("equal", start, end) and insert lists of child labels.
+
+Diffs are stored with a summary: the number of added, modified and deleted
+nodes, in total and per section. Summaries are small, so they're cached,
+invalidated when any diff between the same versions is written."""
+import difflib
+
+from django.conf import settings
+from django.core.cache import caches
+
+from regcore.labels import section_label
+
+ADDED, DELETED, MODIFIED = 'added', 'deleted', 'modified'
+INSERT, DELETE, EQUAL = 'insert', 'delete', 'equal'
+
+
+def ancestor_labels(label):
+    """The label and each of its ancestors' labels, deepest first"""
+    parts = label.split('-')
+    return ['-'.join(parts[:idx]) for idx in range(len(parts), 0, -1)]
+
+
+def is_within(label, prefix):
+    """Is the label that of the prefix's node or one of its descendants?"""
+    return label == prefix or label.startswith(prefix + '-')
+
+
+def slice_diff(diff, label):
+    """Only those entries of the diff which fall within the label"""
+    return {key: change for key, change in diff.items()
+            if is_within(key, label)}
+
+
+def label_string(node):
+    return '-'.join(node['label'])
+
+
+def nodes_by_label(tree):
+    """Flatten a tree into a dict of label string to node"""
+    nodes, to_visit = {}, [tree]
+    while to_visit:
+        node = to_visit.pop()
+        nodes[label_string(node)] = node
+        to_visit.extend(node.get('children', []))
+    return nodes
+
+
+def child_labels(node):
+    return [label_string(child) for child in node.get('children', [])]
+
+
+def text_ops(old, new):
+    """Operations which convert the old text into the new. Whitespace is
+    junk, so matches aren't anchored on it"""
+    matcher = difflib.SequenceMatcher(lambda c: c in ' \t\n', old, new)
+    ops = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag in (DELETE, 'replace'):
+            ops.append((DELETE, i1, i2))
+        if tag in (INSERT, 'replace'):
+            ops.append((INSERT, i1, new[j1:j2]))
+    return ops
+
+
+def child_ops(old, new):
+    """Operations which convert the old list of child labels into the new"""
+    matcher = difflib.SequenceMatcher(None, old, new)
+    ops = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag in (EQUAL, DELETE, 'replace'):
+            ops.append((EQUAL if tag == EQUAL else DELETE, i1, i2))
+        if tag in (INSERT, 'replace'):
+            ops.append((INSERT, i1, new[j1:j2]))
+    return ops
+
+
+def added(node):
+    as_dict = {key: value for key, value in node.items()
+               if key not in ('children', 'lft')}
+    as_dict['child_labels'] = child_labels(node)
+    return {'op': ADDED, 'node': as_dict}
+
+
+def modified(old, new):
+    """The changes to a node's own content, or None if there are none"""
+    change = {}
+    if old.get('text', '') != new.get('text', ''):
+        change['text'] = text_ops(old.get('text', ''), new.get('text', ''))
+    if old.get('title', '') != new.get('title', ''):
+        change['title'] = text_ops(old.get('title', ''),
+                                   new.get('title', ''))
+    old_children, new_children = child_labels(old), child_labels(new)
+    if old_children != new_children:
+        change['child_ops'] = child_ops(old_children, new_children)
+    if change:
+        change['op'] = MODIFIED
+        return change
+
+
+def changes_between(old_tree, new_tree):
+    """Diff two versions of a tree, aligning their nodes by label"""
+    old_nodes, new_nodes = nodes_by_label(old_tree), nodes_by_label(new_tree)
+    diff = {}
+    for label, old in old_nodes.items():
+        if label not in new_nodes:
+            diff[label] = {'op': DELETED}
+            continue
+        change = modified(old, new_nodes[label])
+        if change:
+            diff[label] = change
+    for label, new in new_nodes.items():
+        if label not in old_nodes:
+            diff[label] = added(new)
+    return diff
+
+
+def summarize(diff):
+    """Count the nodes added, modified and deleted by the diff"""
+    def counts():
+        return {ADDED: 0, MODIFIED: 0, DELETED: 0}
+    summary = dict(counts(), sections={})
+    for label, change in diff.items():
+        op = change.get('op') if isinstance(change, dict) else None
+        if op in (ADDED, MODIFIED, DELETED):
+            section = summary['sections'].setdefault(section_label(label),
+                                                     counts())
+            section[op] += 1
+            summary[op] += 1
+    return summary
+
+
+def get_summary_cache():
+    return caches[settings.DIFF_SUMMARY_CACHE]
+
+
+def _generation_key(old_version, new_version):
+    return ':'.join(['diff-summary', 'gen', old_version, new_version])
+
+
+def summary_cache_key(label, old_version, new_version):
+    """Writes to any diff between these versions may change the summary of
+    any label (summaries of sub-labels are sliced from their ancestors'
+    diffs), so keys incorporate a counter which writes bump"""
+    generation = get_summary_cache().get(
+        _generation_key(old_version, new_version), 0)
+    return ':'.join(['diff-summary', str(generation), label, old_version,
+                     new_version])
+
+
+def invalidate_summaries(old_version, new_version):
+    cache = get_summary_cache()
+    key = _generation_key(old_version, new_version)
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key)
+    except ValueError:  # evicted between the two calls
+        cache.set(key, 1, timeout=None)
@@ -0,0 +1,111 @@
+"""Keeps Haystack's index up to date as documents are written. Haystack's
+RealtimeSignalProcessor indexes each saved model individually, which never
+fires for `bulk_create` (and would be far too chatty if it did). Instead, we
+listen for whole trees being written by DMDocuments, queue them, and re-index
+each tree from a background thread in chunks of HAYSTACK_UPDATE_CHUNK_SIZE.
+
+Queued trees are lost if the process exits before they're indexed;
+`manage.py update_index` will catch the index up."""
+import logging
+import threading
+
+from django.conf import settings
+from django.db import connection as db_connection
+from django.db import transaction
+from haystack.query import SearchQuerySet
+from haystack.signals import BaseSignalProcessor
+from six.moves import queue
+
+from regcore import search_cache
+from regcore.models import Document
+from regcore.signals import documents_changed
+
+logger = logging.getLogger(__name__)
+
+
+class QueuedSignalProcessor(BaseSignalProcessor):
+    def setup(self):
+        from regcore.db.django_models import DMDocuments
+        self.queue = queue.Queue()
+        self._worker = None
+        self._worker_lock = threading.Lock()
+        documents_changed.connect(self.handle_tree, sender=DMDocuments,
+                                  dispatch_uid='regcore_haystack_queue')
+
+    def teardown(self):
+        documents_changed.disconnect(dispatch_uid='regcore_haystack_queue')
+
+    def handle_tree(self, sender, doc_type, label, version, **kwargs):
+        """Queue the tree once the write is committed (and hence visible to
+        the worker's connection)"""
+        transaction.on_commit(
+            lambda: self.enqueue((doc_type, label, version)))
+
+    def enqueue(self, tree):
+        self.queue.put(tree)
+        with self._worker_lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self.work)
+                self._worker.daemon = True
+                self._worker.start()
+
+    def work(self):
+        """Index queued trees until the process exits"""
+        while True:
+            try:
+                self.flush(block=True)
+            except Exception:   # keep going; update_index can fix the tree
+                logger.exception('Failed to update the search index')
+            finally:
+                db_connection.close()
+
+    def flush(self, block=False):
+        """Index every queued tree. Trees queued several times (e.g. deleted
+        then re-inserted) are only indexed once.
+        :param bool block: wait for at least one tree to be queued"""
+        trees = []
+        try:
+            trees.append(self.queue.get(block=block))
+            while True:
+                trees.append(self.queue.get_nowait())
+        except queue.Empty:
+            pass
+        for tree in sorted(set(trees), key=trees.index):
+            for using in self.connection_router.for_write():
+                self.update_tree(using, *tree)
+            # Searches since the write may have cached the old index's results
+            search_cache.invalidate_tree(*tree)
+
+    def update_tree(self, using, doc_type, label, version):
+        """Re-index all nodes of this tree and remove any that are no longer
+        present"""
+        backend = self.connections[using].get_backend()
+        index = self.connections[using].get_unified_index().get_index(
+            Document)
+        # Matches the nodes DMDocuments.bulk_delete removes
+        nodes = index.index_queryset(using=using).filter(
+            doc_type=doc_type, version=version,
+            label_string__startswith=label).order_by('pk')
+
+        chunk_size = settings.HAYSTACK_UPDATE_CHUNK_SIZE
+        current, last_pk = set(), None
+        while True:
+            chunk = nodes if last_pk is None else nodes.filter(pk__gt=last_pk)
+            chunk = list(chunk[:chunk_size])
+            if not chunk:
+                break
+            backend.update(index, chunk)
+            current.update(node.pk for node in chunk)
+            last_pk = chunk[-1].pk
+
+        indexed = SearchQuerySet(using=using).models(Document).filter(
+            doc_type=doc_type, regulation=label.split('-')[0])
+        if version:
+            indexed = indexed.filter(version=version)
+        stale = [pk for pk, label_string
+                 in indexed.values_list('pk', 'label_string')
+                 if label_string.startswith(label) and pk not in current]
+        for pk in stale:
+            backend.remove(Document(pk=pk))
+        logger.info('Indexed %s nodes and removed %s from %s %s@%s',
+                    len(current), len(stale), doc_type, label, version)
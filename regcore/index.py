@@ -1,22 +1,36 @@
 """Schemas used by Elastic Search as well as an initialization function,
-which sends the schemas over to the Elastic Search instance."""
-
+which sends the schemas over to the Elastic Search instance. Also includes
+helpers for building a replacement index and publishing it via an alias."""
+import logging
+from datetime import datetime
 
 from django.conf import settings
-from pyelasticsearch import ElasticSearch
-from pyelasticsearch.exceptions import IndexAlreadyExistsError
+from pyelasticsearch.exceptions import (
+    ElasticHttpNotFoundError, IndexAlreadyExistsError)
+
+from regcore.db.es import get_client
+
+logger = logging.getLogger(__name__)
 
 NODE_SEARCH_SCHEMA = {
     'text': {'type': 'string'},  # Full text search
-    #   Do not search children, but make them available
-    'children': {'type': 'object', 'enabled': False},
     'label': {'type': 'string'},    # An array of strings
     'label_string': {'type': 'string', 'index': 'not_analyzed'},
     'regulation': {'type': 'string', 'index': 'not_analyzed'},
     'title': {'type': 'string'},
     'node_type': {'type': 'string', 'index': 'not_analyzed'},
     'id': {'type': 'string', 'index': 'not_analyzed'},
-    'version': {'type': 'string', 'index': 'not_analyzed'}
+    'version': {'type': 'string', 'index': 'not_analyzed'},
+    'doc_type': {'type': 'string', 'index': 'not_analyzed'},
+    'root': {'type': 'boolean'},
+    #   Section containing the node (e.g. 1005-12); used to collapse results
+    'section': {'type': 'string', 'index': 'not_analyzed'},
+    #   Nodes are stored flat; these locate each within its tree
+    'tree': {'type': 'string', 'index': 'not_analyzed'},
+    'parent': {'type': 'string', 'index': 'not_analyzed'},
+    'position': {'type': 'integer'},
+    'left': {'type': 'integer'},
+    'right': {'type': 'integer'},
 }
 
 LAYER_SCHEMA = {
@@ -43,29 +57,103 @@ DIFF_SCHEMA = {
     'old_version': {'type': 'string', 'index': 'not_analyzed'},
     'new_version': {'type': 'string', 'index': 'not_analyzed'},
     #   No need to index this
-    'diff': {'type': 'object', 'enabled': False}
+    'diff': {'type': 'object', 'enabled': False},
+    'summary': {'type': 'object', 'enabled': False},
 }
 
 
-def init_schema():
-    """Should be called at application startup. Makes sure the mappings and
-    index exist."""
-    es = ElasticSearch(settings.ELASTIC_SEARCH_URLS)
-    try:
-        es.create_index(settings.ELASTIC_SEARCH_INDEX)
-    except IndexAlreadyExistsError:
-        pass
-
+def put_mappings(es, index):
+    """Send the schemas for each of our document types"""
     #   Does not replace if exact mapping already exists
-    es.put_mapping(settings.ELASTIC_SEARCH_INDEX, 'reg_tree', {
+    es.put_mapping(index, 'reg_tree', {
         'reg_tree': {'properties': NODE_SEARCH_SCHEMA}
     })
-    es.put_mapping(settings.ELASTIC_SEARCH_INDEX, 'layer', {
+    es.put_mapping(index, 'layer', {
         'layer': {'properties': LAYER_SCHEMA}
     })
-    es.put_mapping(settings.ELASTIC_SEARCH_INDEX, 'notice', {
+    es.put_mapping(index, 'notice', {
         'notice': {'properties': LAYER_SCHEMA}
     })
-    es.put_mapping(settings.ELASTIC_SEARCH_INDEX, 'diff', {
+    es.put_mapping(index, 'diff', {
         'diff': {'properties': DIFF_SCHEMA}
     })
+
+
+def init_schema():
+    """Should be called at application startup. Makes sure the mappings and
+    index exist."""
+    es = get_client()
+    try:
+        es.create_index(settings.ELASTIC_SEARCH_INDEX)
+    except IndexAlreadyExistsError:
+        pass
+    put_mappings(es, settings.ELASTIC_SEARCH_INDEX)
+
+
+def new_index_name(alias):
+    """Indexes behind an alias are named after it, with a timestamp"""
+    return '{0}_{1}'.format(alias,
+                            datetime.utcnow().strftime('%Y%m%d%H%M%S%f'))
+
+
+def create_index(es, index):
+    """Create a new index for bulk loading. Refreshes are disabled until the
+    index is published via `switch_alias`"""
+    es.create_index(index, settings={'index': {'refresh_interval': '-1'}})
+    put_mappings(es, index)
+
+
+def aliased_indexes(es, alias):
+    """Names of the indexes an alias currently points to"""
+    try:
+        response = es.get_aliases(alias=alias)
+    except ElasticHttpNotFoundError:
+        return []
+    return sorted(index for index, value in response.items()
+                  if alias in value.get('aliases', {}))
+
+
+def is_concrete_index(es, name):
+    """Is there an index (rather than an alias) with this name?"""
+    try:
+        existing = es.get_settings(name)
+    except ElasticHttpNotFoundError:
+        return False
+    return name in existing
+
+
+def switch_alias(es, alias, index, replace_index=False):
+    """Atomically point the alias at `index` (rather than whichever indexes it
+    pointed to before). An index (rather than an alias) with the alias's name,
+    as created by `init_schema`, can't coexist with the alias. It's only
+    deleted if `replace_index`; searches fail in the brief gap before the
+    alias is created"""
+    es.update_settings(index, {'index': {'refresh_interval': '1s'}})
+    es.refresh(index)
+    if is_concrete_index(es, alias):
+        if not replace_index:
+            raise ValueError(
+                '{0} is an index rather than an alias'.format(alias))
+        logger.warning('Replacing index %s with an alias', alias)
+        es.delete_index(alias)
+
+    actions = [{'remove': {'index': old, 'alias': alias}}
+               for old in aliased_indexes(es, alias)]
+    actions.append({'add': {'index': index, 'alias': alias}})
+    es.update_aliases(actions)
+
+
+def remove_old_indexes(es, alias, keep=0):
+    """Delete indexes built for this alias which it no longer points to,
+    retaining the `keep` most recent (e.g. to allow rolling back)"""
+    current = set(aliased_indexes(es, alias))
+    prefix = alias + '_'
+    candidates = sorted(
+        index for index in es.get_settings(prefix + '*')
+        if index not in current and index.startswith(prefix) and
+        index[len(prefix):].isdigit())
+    to_delete = candidates[:len(candidates) - keep] if keep else candidates
+    for index in to_delete:
+        logger.info('Deleting old index %s', index)
+        es.delete_index(index)
+    return to_delete
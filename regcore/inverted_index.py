@@ -0,0 +1,384 @@
+"""A compact, read-only inverted index over Document nodes, for deployments
+with a fixed corpus (e.g. public read-only replicas). The index is written to
+a single file which is memory-mapped when loaded, so that multiple worker
+processes share the (large) posting lists and document text through the OS
+page cache.
+
+File layout: an eight byte magic string, a four byte (little-endian) header
+length, a JSON header, and then a series of binary sections whose offsets are
+listed in the header. Posting lists are stored as doc-id deltas, each list
+using the narrowest array type which fits its largest delta."""
+import heapq
+import json
+import logging
+import math
+import mmap
+import os
+import re
+import struct
+import sys
+import tempfile
+import threading
+from array import array
+from collections import defaultdict
+
+from django.conf import settings
+
+from regcore.db.django_models import DMLayers
+from regcore.models import Document
+
+try:
+    from itertools import accumulate
+except ImportError:     # Python 2
+    def accumulate(iterable):
+        total = 0
+        for value in iterable:
+            total += value
+            yield total
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'REGCIDX1'
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+# Array typecodes in order of width; posting lists use the narrowest that fits
+WIDTHS = ('B', 'H', 'I')
+WIDTH_LIMITS = (2 ** 8, 2 ** 16, 2 ** 32)
+
+
+def tokenize(text):
+    return re.findall(r'\w+', text.lower(), re.UNICODE)
+
+
+def _to_bytes(arr):
+    return arr.tobytes() if hasattr(arr, 'tobytes') else arr.tostring()
+
+
+def _from_bytes(typecode, data):
+    arr = array(typecode)
+    if hasattr(arr, 'frombytes'):
+        arr.frombytes(data)
+    else:   # Python 2
+        arr.fromstring(data)
+    return arr
+
+
+def _narrowest(values):
+    """Index (into WIDTHS) of the narrowest typecode which holds all values"""
+    largest = max(values) if values else 0
+    for idx, limit in enumerate(WIDTH_LIMITS):
+        if largest < limit:
+            return idx
+    raise ValueError('Value too large to index: {0}'.format(largest))
+
+
+def _layer_titles(doc_type, regulation, version):
+    """Map of label to the title which should be displayed for it, derived
+    from the keyterms and terms layers"""
+    titles = {}
+    if doc_type == 'cfr':
+        doc_id = '{0}/{1}'.format(version, regulation)
+    else:
+        doc_id = regulation
+    terms = DMLayers().get('terms', doc_type, doc_id)
+    # We need the references, not the locations of defined terms
+    if terms:
+        for term_struct in terms['referenced'].values():
+            titles.setdefault(term_struct['reference'], term_struct['term'])
+    keyterms = DMLayers().get('keyterms', doc_type, doc_id) or {}
+    for label, keyterm in keyterms.items():
+        titles[label] = keyterm[0]['key_term']     # keyterms take priority
+    return titles
+
+
+def _serialize(document, layer_titles):
+    """The fields returned for each search result. Titles are resolved here,
+    at build time, so no layer lookups are needed when searching"""
+    regulation = document.label_string.split('-')[0]
+    title = document.title or layer_titles.get(document.label_string)
+    record = {
+        'text': document.text,
+        'label': document.label_string.split('-'),
+        'version': document.version,
+        'regulation': regulation,
+        'label_string': document.label_string,
+    }
+    if title:
+        record['title'] = title
+    return record
+
+
+def write_index(documents, path):
+    """Build an index of the provided Documents and write it to `path`. The
+    file is written elsewhere and moved into place, so readers never see a
+    partial index"""
+    postings = defaultdict(lambda: (array('I'), array('I')))
+    lengths = array('I')
+    codes = {'doc_type': [], 'version': [], 'regulation': [], 'node_type': []}
+    columns = {key: array('H') for key in codes}
+    flags = array('B')
+    doc_offsets, doc_blob = array('I', [0]), bytearray()
+    titles_by_reg = {}
+
+    for doc_id, document in enumerate(documents):
+        regulation = document.label_string.split('-')[0]
+        layer_key = (document.doc_type, regulation, document.version)
+        if layer_key not in titles_by_reg:
+            titles_by_reg[layer_key] = _layer_titles(*layer_key)
+        record = _serialize(document, titles_by_reg[layer_key])
+
+        tokens = tokenize(record.get('title', '') + '\n' + document.text)
+        lengths.append(len(tokens))
+        term_freqs = defaultdict(int)
+        for token in tokens:
+            term_freqs[token] += 1
+        for term, freq in term_freqs.items():
+            doc_ids, freqs = postings[term]
+            doc_ids.append(doc_id)
+            freqs.append(freq)
+
+        for key, value in (('doc_type', document.doc_type),
+                           ('version', document.version),
+                           ('regulation', regulation),
+                           ('node_type', document.node_type)):
+            if value not in codes[key]:
+                codes[key].append(value)
+            columns[key].append(codes[key].index(value))
+        is_subpart = ('Subpart' in document.label_string or
+                      'Subjgrp' in document.label_string)
+        flags.append(int(document.root) | (int(is_subpart) << 1))
+
+        doc_blob.extend(json.dumps(record).encode('utf-8'))
+        doc_offsets.append(len(doc_blob))
+
+    num_docs = len(lengths)
+    avg_length = float(sum(lengths)) / num_docs if num_docs else 0.0
+    avg_length = avg_length or 1.0
+    norms = array('f', (K1 * (1 - B + B * length / avg_length)
+                        for length in lengths))
+
+    terms = sorted(postings)
+    term_offsets, term_df, term_widths = array('I', [0]), array('I'), \
+        array('B')
+    posting_blob = bytearray()
+    for term in terms:
+        doc_ids, freqs = postings[term]
+        deltas = [doc_ids[0]] + [b - a for a, b in zip(doc_ids, doc_ids[1:])]
+        delta_width, freq_width = _narrowest(deltas), _narrowest(freqs)
+        posting_blob.extend(_to_bytes(array(WIDTHS[delta_width], deltas)))
+        posting_blob.extend(_to_bytes(array(WIDTHS[freq_width], freqs)))
+        term_offsets.append(len(posting_blob))
+        term_df.append(len(doc_ids))
+        term_widths.append(delta_width * len(WIDTHS) + freq_width)
+
+    sections = [
+        ('norms', _to_bytes(norms)),
+        ('doc_type', _to_bytes(columns['doc_type'])),
+        ('version', _to_bytes(columns['version'])),
+        ('regulation', _to_bytes(columns['regulation'])),
+        ('node_type', _to_bytes(columns['node_type'])),
+        ('flags', _to_bytes(flags)),
+        ('doc_offsets', _to_bytes(doc_offsets)),
+        ('term_offsets', _to_bytes(term_offsets)),
+        ('term_df', _to_bytes(term_df)),
+        ('term_widths', _to_bytes(term_widths)),
+        ('terms', '\n'.join(terms).encode('utf-8')),
+        ('docs', bytes(doc_blob)),
+        ('postings', bytes(posting_blob)),
+    ]
+    header = {'num_docs': num_docs, 'codes': codes,
+              'byteorder': sys.byteorder, 'sections': {}}
+    position = 0
+    for name, data in sections:
+        header['sections'][name] = [position, len(data)]
+        position += len(data)
+    header_bytes = json.dumps(header).encode('utf-8')
+
+    dirname = os.path.dirname(os.path.abspath(path))
+    handle, tmp_path = tempfile.mkstemp(dir=dirname)
+    with os.fdopen(handle, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<I', len(header_bytes)))
+        f.write(header_bytes)
+        for _, data in sections:
+            f.write(data)
+    os.rename(tmp_path, path)
+    logger.info('Wrote search index of %s documents, %s terms to %s',
+                num_docs, len(terms), path)
+
+
+class InvertedIndex(object):
+    """Memory-mapped view of an index file written by `write_index`"""
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mmap[:len(MAGIC)] != MAGIC:
+            raise ValueError('Not a search index: {0}'.format(path))
+        header_start = len(MAGIC) + 4
+        header_length, = struct.unpack(
+            '<I', self.mmap[len(MAGIC):header_start])
+        header = json.loads(
+            self.mmap[header_start:header_start + header_length]
+            .decode('utf-8'))
+        if header['byteorder'] != sys.byteorder:
+            raise ValueError('Index was built on an incompatible platform')
+        self.data_start = header_start + header_length
+        self.sections = header['sections']
+        self.num_docs = header['num_docs']
+        self.codes = header['codes']
+
+        # These are small (one entry per document or term), so we copy them
+        # out of the mapping for faster access
+        self.norms = self._array('f', 'norms')
+        self.columns = {key: self._array('H', key) for key in self.codes}
+        self.flags = self._array('B', 'flags')
+        self.doc_offsets = self._array('I', 'doc_offsets')
+        self.term_offsets = self._array('I', 'term_offsets')
+        self.term_df = self._array('I', 'term_df')
+        self.term_widths = self._array('B', 'term_widths')
+        terms = self._section('terms').decode('utf-8')
+        self.term_ids = {term: idx
+                         for idx, term in enumerate(terms.split('\n'))
+                         if term}
+
+    def _section(self, name, start=0, end=None):
+        offset, length = self.sections[name]
+        if end is None:
+            end = length
+        offset += self.data_start
+        return self.mmap[offset + start:offset + end]
+
+    def _array(self, typecode, name):
+        return _from_bytes(typecode, self._section(name))
+
+    def postings(self, term_id):
+        """Decode a term's posting list.
+        :return: pair of arrays: document ids and term frequencies"""
+        count = self.term_df[term_id]
+        delta_width, freq_width = divmod(self.term_widths[term_id],
+                                         len(WIDTHS))
+        delta_type, freq_type = WIDTHS[delta_width], WIDTHS[freq_width]
+        start = self.term_offsets[term_id]
+        middle = start + count * array(delta_type).itemsize
+        deltas = _from_bytes(delta_type,
+                             self._section('postings', start, middle))
+        freqs = _from_bytes(freq_type, self._section(
+            'postings', middle, self.term_offsets[term_id + 1]))
+        return array('I', accumulate(deltas)), freqs
+
+    def _matches_filters(self, filters):
+        """Convert filter values into a predicate on document ids"""
+        checks = []
+        for key in ('doc_type', 'version', 'regulation'):
+            if filters.get(key) is not None:
+                if filters[key] not in self.codes[key]:
+                    return lambda doc_id: False
+                code, column = self.codes[key].index(filters[key]), \
+                    self.columns[key]
+                checks.append(lambda doc_id, code=code, column=column:
+                              column[doc_id] == code)
+        for bit, key in enumerate(('is_root', 'is_subpart')):
+            if filters.get(key) is not None:
+                checks.append(lambda doc_id, bit=bit, value=filters[key]:
+                              bool(self.flags[doc_id] & (1 << bit)) == value)
+        return lambda doc_id: all(check(doc_id) for check in checks)
+
+    def _candidates(self, query, filters):
+        """Find documents containing every term in the query which pass the
+        filters.
+        :return: pair of each term's (id, {doc id: frequency}) and a list of
+        the matching document ids"""
+        term_ids = set()
+        for term in tokenize(query):
+            if term not in self.term_ids:
+                return [], []
+            term_ids.add(self.term_ids[term])
+        if not term_ids:
+            return [], []
+
+        term_postings = []
+        candidates = None
+        for term_id in sorted(term_ids, key=self.term_df.__getitem__):
+            doc_ids, freqs = self.postings(term_id)
+            term_postings.append((term_id, dict(zip(doc_ids, freqs))))
+            if candidates is None:
+                candidates = set(doc_ids)
+            else:
+                candidates.intersection_update(doc_ids)
+
+        matches = self._matches_filters(filters)
+        return term_postings, [doc_id for doc_id in candidates
+                               if matches(doc_id)]
+
+    def search(self, query, limit, after=None, with_scores=False,
+               **filters):
+        """Find documents containing every term in the query, ranked by BM25.
+        :param int limit: maximum number of document ids to return
+        :param after: (score, document id) of a previous result; only those
+        ranked below it are returned
+        :param bool with_scores: return (document id, score) pairs rather
+        than document ids
+        :param filters: doc_type, version, regulation, is_root, is_subpart
+        :return: pair of total matches and a list of document ids"""
+        term_postings, candidates = self._candidates(query, filters)
+
+        scores = defaultdict(float)
+        for term_id, freqs in term_postings:
+            df = self.term_df[term_id]
+            idf = math.log(1 + (self.num_docs - df + 0.5) / (df + 0.5))
+            for doc_id in candidates:
+                freq = freqs[doc_id]
+                scores[doc_id] += idf * freq * (K1 + 1) / (
+                    freq + self.norms[doc_id])
+
+        def key(doc_id):
+            return (-scores[doc_id], doc_id)
+        remaining = candidates
+        if after is not None:
+            after_key = (-after[0], after[1])
+            remaining = [doc_id for doc_id in candidates
+                         if key(doc_id) > after_key]
+        ranked = heapq.nsmallest(limit, remaining, key=key)
+        if with_scores:
+            ranked = [(doc_id, scores[doc_id]) for doc_id in ranked]
+        return len(candidates), ranked
+
+    def facet_counts(self, query, facets, **filters):
+        """Count the documents matching a search by their values of each
+        facet (doc_type, version, regulation or node_type). Indexes written
+        before node types were stored report no counts for them.
+        :return: dict of facet -> {value: count}"""
+        _, candidates = self._candidates(query, filters)
+        counts = {}
+        for facet in facets:
+            counts[facet] = defaultdict(int)
+            if facet not in self.columns:
+                continue
+            column, codes = self.columns[facet], self.codes[facet]
+            for doc_id in candidates:
+                counts[facet][codes[column[doc_id]]] += 1
+        return counts
+
+    def document(self, doc_id):
+        """The stored fields for a single document"""
+        return json.loads(self._section(
+            'docs', self.doc_offsets[doc_id], self.doc_offsets[doc_id + 1]
+        ).decode('utf-8'))
+
+
+_loaded = {}
+_load_lock = threading.Lock()
+
+
+def load_index(path=None):
+    """Load (building, if necessary) the index at `path`, defaulting to the
+    MEMORY_SEARCH_INDEX setting. Loaded indexes are cached per process"""
+    path = path or settings.MEMORY_SEARCH_INDEX
+    with _load_lock:
+        if path not in _loaded:
+            if not os.path.exists(path):
+                write_index(Document.objects.order_by('tree_id', 'lft')
+                            .iterator(), path)
+            _loaded[path] = InvertedIndex(path)
+        return _loaded[path]
@@ -0,0 +1,13 @@
+"""Helpers for node labels, e.g. 1005-12-a"""
+# Nodes which group sections without containing them in their labels, e.g.
+# 1005-Subpart-A contains 1005-12
+SECTION_GROUPS = ('Subpart', 'Subjgrp')
+
+
+def section_label(label_string):
+    """The label of the section (e.g. 1005-12) containing this node. Roots,
+    subparts and subject groups are their own sections"""
+    parts = label_string.split('-')
+    if len(parts) > 1 and parts[1] in SECTION_GROUPS:
+        return label_string
+    return '-'.join(parts[:2])
@@ -0,0 +1,23 @@
+import logging
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from regcore.inverted_index import write_index
+from regcore.models import Document
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Build the inverted index used by the memory_search handler"   # noqa
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'path', nargs='?', default=None,
+            help='where to write the index; defaults to MEMORY_SEARCH_INDEX')
+
+    def handle(self, *args, **options):
+        path = options['path'] or settings.MEMORY_SEARCH_INDEX
+        write_index(Document.objects.order_by('tree_id', 'lft').iterator(),
+                    path)
@@ -0,0 +1,119 @@
+import logging
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from regcore import search_cache
+from regcore.db.django_models import DMDocuments
+from regcore.db.es import ESDiffs, ESDocuments, ESLayers, ESNotices, get_client
+from regcore.index import (
+    create_index, is_concrete_index, new_index_name, remove_old_indexes,
+    switch_alias)
+from regcore.models import Diff, Document, Layer, Notice
+
+logger = logging.getLogger(__name__)
+
+
+def flatten(node):
+    """Pre-order list of a node and its descendants, as the write API
+    provides them"""
+    nodes = [node]
+    for child in node['children']:
+        nodes.extend(flatten(child))
+    return nodes
+
+
+def load_tree(index, doc_type, label, version):
+    tree = DMDocuments().get(doc_type, label, version)
+    if tree:
+        ESDocuments(index).bulk_insert(flatten(tree), doc_type, version)
+
+
+def load_layers(index, name, doc_type):
+    layers = [dict(layer.layer, doc_id=layer.doc_id)
+              for layer in Layer.objects.filter(name=name, doc_type=doc_type)]
+    ESLayers(index).bulk_insert(layers, name, doc_type)
+
+
+def load_notices(index):
+    es_notices = ESNotices(index)
+    for notice in Notice.objects.all():
+        es_notices.insert(notice.document_number, notice.notice)
+
+
+def load_diffs(index):
+    es_diffs = ESDiffs(index)
+    for diff in Diff.objects.all():
+        es_diffs.insert(diff.label, diff.old_version, diff.new_version,
+                        diff.diff, diff.summary)
+
+
+def run_task(task):
+    """Run in a worker thread; each thread has its own DB connection, which
+    we close when done"""
+    fn, args = task
+    try:
+        fn(*args)
+    finally:
+        connection.close()
+
+
+class Command(BaseCommand):
+    help = ("Load the Django-model data into a new Elastic Search index, "   # noqa
+            "then point the ELASTIC_SEARCH_INDEX alias at it")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4,
+                            help='number of concurrent loading threads')
+        parser.add_argument('--keep', type=int, default=1,
+                            help='number of previous indexes to retain')
+        parser.add_argument(
+            '--replace-index', action='store_true',
+            help=('delete an existing index named ELASTIC_SEARCH_INDEX so '
+                  'that an alias can take its place (searches fail briefly)'))
+
+    def handle(self, *args, **options):
+        es = get_client()
+        alias = settings.ELASTIC_SEARCH_INDEX
+        # The Django models are our only source; if Elastic Search is the
+        # primary store, they're likely empty
+        if not Document.objects.exists():
+            raise CommandError('No documents are stored via Django models; '
+                               'refusing to replace {0}'.format(alias))
+        if is_concrete_index(es, alias) and not options['replace_index']:
+            raise CommandError(
+                '{0} is an index rather than an alias. Run once with '
+                '--replace-index to replace it with an alias; searches will '
+                'fail between its deletion and the alias\'s '
+                'creation'.format(alias))
+        index = new_index_name(alias)
+        logger.info('Building %s', index)
+        create_index(es, index)
+
+        trees = list(Document.objects.filter(level=0).values_list(
+            'doc_type', 'label_string', 'version'))
+        tasks = [(load_tree, (index,) + tree) for tree in trees]
+        tasks.extend(
+            (load_layers, (index, name, doc_type))
+            for name, doc_type in Layer.objects.values_list(
+                'name', 'doc_type').distinct().order_by())
+        tasks.extend([(load_notices, (index,)), (load_diffs, (index,))])
+
+        if options['workers'] > 1:
+            pool = ThreadPool(options['workers'])
+            try:
+                pool.map(run_task, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for fn, task_args in tasks:
+                fn(*task_args)
+
+        switch_alias(es, alias, index, options['replace_index'])
+        logger.info('%s now points to %s', alias, index)
+        for doc_type, label, version in trees:
+            search_cache.invalidate(doc_type, label.split('-')[0], version)
+        remove_old_indexes(es, alias, options['keep'])
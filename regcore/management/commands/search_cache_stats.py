@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from regcore import search_cache
+
+
+class Command(BaseCommand):
+    help = "Report the search cache hit rate"   # noqa
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true',
+                            help='Reset the counters after reporting')
+
+    def handle(self, *args, **options):
+        stats = search_cache.stats()
+        self.stdout.write(
+            'hits: {hits}, misses: {misses}, hit rate: {hit_rate:.1%}'.format(
+                **stats))
+        if options['reset']:
+            search_cache.reset_stats()
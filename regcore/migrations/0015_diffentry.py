@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import regcore.fields
+
+
+def split_diffs(apps, schema_editor):
+    """Index the entries of existing diffs"""
+    Diff = apps.get_model('regcore', 'Diff')
+    DiffEntry = apps.get_model('regcore', 'DiffEntry')
+    for diff in Diff.objects.iterator():
+        if isinstance(diff.diff, dict):
+            DiffEntry.objects.bulk_create(
+                DiffEntry(diff=diff, label=label, entry=entry)
+                for label, entry in diff.diff.items())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('regcore', '0014_auto_20160504_0101'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DiffEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('label', models.SlugField(max_length=200)),
+                ('entry', regcore.fields.CompressedJSONField()),
+                ('diff', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='entries', to='regcore.Diff')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='diffentry',
+            unique_together=set([('diff', 'label')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='diffentry',
+            index_together=set([('diff', 'label')]),
+        ),
+        migrations.RunPython(split_diffs, migrations.RunPython.noop),
+    ]
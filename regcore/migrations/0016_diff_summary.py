@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+import regcore.fields
+from regcore.diff import summarize
+
+
+def summarize_diffs(apps, schema_editor):
+    Diff = apps.get_model('regcore', 'Diff')
+    for diff in Diff.objects.iterator():
+        if isinstance(diff.diff, dict):
+            diff.summary = summarize(diff.diff)
+            diff.save(update_fields=['summary'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('regcore', '0015_diffentry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='diff',
+            name='summary',
+            field=regcore.fields.CompressedJSONField(null=True),
+        ),
+        migrations.RunPython(summarize_diffs, migrations.RunPython.noop),
+    ]
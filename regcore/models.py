@@ -59,7 +59,23 @@ class Diff(models.Model):
     old_version = models.SlugField(max_length=20)
     new_version = models.SlugField(max_length=20)
     diff = CompressedJSONField()
+    # Counts of changed nodes; see regcore.diff.summarize
+    summary = CompressedJSONField(null=True)
 
     class Meta:
         index_together = (('label', 'old_version', 'new_version'),)
         unique_together = (('label', 'old_version', 'new_version'),)
+
+
+class DiffEntry(models.Model):
+    """A single label's change within a Diff, stored separately so that
+    the changes to one section can be read without decompressing the whole
+    diff"""
+    diff = models.ForeignKey(Diff, on_delete=models.CASCADE,
+                             related_name='entries')
+    label = models.SlugField(max_length=200)
+    entry = CompressedJSONField()
+
+    class Meta:
+        index_together = (('diff', 'label'),)
+        unique_together = (('diff', 'label'),)
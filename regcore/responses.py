@@ -1,7 +1,7 @@
 """Helper functions for creating Django HTTP responses"""
 import json
 
-from django.http import Http404, HttpResponse
+from django.http import Http404, HttpResponse, StreamingHttpResponse
 
 
 def user_error(reason):
@@ -10,6 +10,14 @@ def user_error(reason):
     return HttpResponse(obj, 'application/json', 400)
 
 
+def unavailable(reason):
+    """Refuse (for now) to serve a request, e.g. when overloaded"""
+    response = HttpResponse(json.dumps({'reason': reason}), 'application/json',
+                            503)
+    response['Retry-After'] = '1'
+    return response
+
+
 def success(ret_value=None):
     """Respond with either a JSON message or empty body"""
     if ret_value is not None:
@@ -18,6 +26,28 @@ def success(ret_value=None):
         return HttpResponse('', status=204)
 
 
+_END = object()
+
+
+def stream_results(results):
+    """Respond with a JSON object containing a list of results. Results are
+    serialized and sent one at a time, so they needn't all be in memory.
+    The first result is fetched before responding, so errors in starting
+    (e.g. a failed first query) raise rather than becoming a truncated 200;
+    errors after that can only cut the response short"""
+    results = iter(results)
+    first = next(results, _END)
+
+    def chunks():
+        yield '{"results": ['
+        if first is not _END:
+            yield json.dumps(first)
+            for result in results:
+                yield ', ' + json.dumps(result)
+        yield ']}'
+    return StreamingHttpResponse(chunks(), content_type='application/json')
+
+
 def four_oh_four():
     """Layer of indirection for 404s. Allows easier migration between web
     frameworks"""
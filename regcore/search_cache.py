@@ -0,0 +1,121 @@
+"""Caching of search responses. Entries are keyed on the normalized search
+arguments and expire after SEARCH_CACHE_TTL seconds. Writes invalidate
+entries via "generation" counters: each key incorporates the generations of
+the scopes (doc_type, regulation and version) the search covers and writes
+bump the generations of the scopes they touch, so stale entries are simply
+never read again. Indexes updated after the write (Postgres' PendingIndex
+queue, Haystack's queued processor) invalidate again once they're updated,
+discarding anything cached from the old index in between.
+
+Invalidation (and the hit-rate counters) are only visible across processes if
+the configured cache is shared, e.g. memcached"""
+import hashlib
+import json
+import logging
+import re
+
+from django.conf import settings
+from django.core.cache import caches
+
+logger = logging.getLogger(__name__)
+
+PREFIX = 'search-cache'
+ANY = '*'
+# Writes which don't identify a version (e.g. preamble layers) bump a
+# separate counter, which version-specific searches also check
+UNVERSIONED = '-'
+
+
+def get_cache():
+    return caches[settings.SEARCH_CACHE]
+
+
+def enabled():
+    return settings.SEARCH_CACHE_TTL > 0
+
+
+def normalize_query(q):
+    return re.sub(r'\s+', ' ', q).strip().lower()
+
+
+def _generation_key(doc_type, regulation, version):
+    return ':'.join([PREFIX, 'gen', doc_type, regulation, version])
+
+
+def _generation_keys(doc_type, regulation, version):
+    """The generation counters a search with these filters depends on"""
+    regulation = regulation or ANY
+    if version is None:
+        return [_generation_key(doc_type, regulation, ANY)]
+    return [_generation_key(doc_type, regulation, version),
+            _generation_key(doc_type, regulation, UNVERSIONED)]
+
+
+def cache_key(handler, doc_type, search_args):
+    """Key for the response to this search. Two searches which differ only in
+    query case or whitespace share a key"""
+    args = search_args._replace(q=normalize_query(search_args.q))
+    generation_keys = _generation_keys(
+        doc_type, search_args.regulation, search_args.version)
+    generations = get_cache().get_many(generation_keys)
+    parts = [handler, doc_type, list(args)] + [
+        generations.get(key, 0) for key in generation_keys]
+    digest = hashlib.sha1(json.dumps(parts).encode('utf-8')).hexdigest()
+    return ':'.join([PREFIX, 'response', digest])
+
+
+def _increment(key):
+    cache = get_cache()
+    # `add` is a no-op if the key exists; `incr` is atomic in shared caches
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key)
+    except ValueError:  # evicted between the two calls
+        cache.set(key, 1, timeout=None)
+
+
+def invalidate(doc_type, regulation, version=None):
+    """Discard cached searches which may include this regulation + version"""
+    version = version or UNVERSIONED
+    for reg in (regulation, ANY):
+        for ver in (version, ANY):
+            _increment(_generation_key(doc_type, reg, ver))
+    logger.debug('Invalidated cached searches for %s %s@%s',
+                 doc_type, regulation, version)
+
+
+def record(hit):
+    _increment(':'.join([PREFIX, 'hits' if hit else 'misses']))
+
+
+def stats():
+    """Hit and miss counts since the counters were last reset"""
+    values = get_cache().get_many([PREFIX + ':hits', PREFIX + ':misses'])
+    hits = values.get(PREFIX + ':hits', 0)
+    misses = values.get(PREFIX + ':misses', 0)
+    total = hits + misses
+    return {'hits': hits, 'misses': misses,
+            'hit_rate': float(hits) / total if total else 0.0}
+
+
+def reset_stats():
+    get_cache().delete_many([PREFIX + ':hits', PREFIX + ':misses'])
+
+
+def invalidate_tree(doc_type, label, version):
+    """Discard cached searches which may include the tree rooted at label"""
+    invalidate(doc_type, label.split('-')[0], version)
+
+
+def documents_written(sender, doc_type, label, version, **kwargs):
+    invalidate_tree(doc_type, label, version)
+
+
+def layers_written(sender, doc_type, doc_id, **kwargs):
+    """CFR layers are identified by version/label; preamble layers by label
+    alone"""
+    if '/' in doc_id:
+        version, label = doc_id.split('/', 1)
+    else:
+        version, label = None, doc_id
+    invalidate(doc_type, label.split('-')[0], version)
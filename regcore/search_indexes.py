@@ -6,14 +6,17 @@ from regcore import models
 class DocumentIndex(indexes.Indexable, indexes.SearchIndex):
     """Search index used by Haystack"""
     doc_type = indexes.CharField(model_attr='doc_type')
-    version = indexes.CharField(model_attr='version', null=True)
+    version = indexes.CharField(model_attr='version', null=True,
+                                faceted=True)
     label_string = indexes.CharField(model_attr='label_string')
     text = indexes.CharField(model_attr='text')
     is_root = indexes.BooleanField(model_attr='root')
     is_subpart = indexes.BooleanField()
     title = indexes.MultiValueField()
+    node_type = indexes.CharField(model_attr='node_type', null=True,
+                                  faceted=True)
 
-    regulation = indexes.CharField(model_attr='label_string')
+    regulation = indexes.CharField(model_attr='label_string', faceted=True)
     text = indexes.CharField(document=True, use_template=True)
 
     def prepare_regulation(self, obj):
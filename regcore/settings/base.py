@@ -44,12 +44,31 @@ BACKENDS = {}
 
 ELASTIC_SEARCH_URLS = []
 ELASTIC_SEARCH_INDEX = 'eregs'
+# Seconds to wait for each Elastic Search request and the number of other
+# nodes to try after a failure
+ELASTIC_SEARCH_TIMEOUT = 60
+ELASTIC_SEARCH_MAX_RETRIES = 0
+# Bulk indexing sends chunks of (at most) this many bytes, with this many
+# concurrent requests. Throttled requests are retried after BACKOFF seconds,
+# doubling for each of RETRIES attempts
+ELASTIC_SEARCH_BULK_BYTES = 5 * 1024 * 1024
+ELASTIC_SEARCH_BULK_WORKERS = 4
+ELASTIC_SEARCH_BULK_RETRIES = 5
+ELASTIC_SEARCH_BULK_BACKOFF = 0.5
+# Listings scroll through results in pages of this size, keeping the scroll
+# open for (at most) this long between pages
+ELASTIC_SEARCH_SCROLL_SIZE = 500
+ELASTIC_SEARCH_SCROLL_KEEP_ALIVE = '1m'
 
 HAYSTACK_CONNECTIONS = {
     'default': {
         'ENGINE': 'haystack.backends.simple_backend.SimpleEngine',
     }
 }
+# With a Haystack backend which stores its own index, set
+# HAYSTACK_SIGNAL_PROCESSOR = 'regcore.haystack_signals.QueuedSignalProcessor'
+# to re-index trees as they're written, this many nodes per update
+HAYSTACK_UPDATE_CHUNK_SIZE = 500
 
 LOGGING = {
     'version': 1,
@@ -74,6 +93,14 @@ LOGGING = {
 }
 
 SEARCH_HANDLER = 'regcore_read.views.haystack_search.search'
+# Prefix lookup of titles and terms; regcore_pgsql provides a Postgres-backed
+# alternative
+TYPEAHEAD_HANDLER = 'regcore_read.views.typeahead.typeahead'
+# The default handler's in-process index is rebuilt when writes (noted in the
+# named Django cache, which should be shared between processes) change its
+# entries, or once it's this many seconds old (None: never)
+TYPEAHEAD_CACHE = 'default'
+TYPEAHEAD_INDEX_MAX_AGE = 600
 
 # Batch size used in `bulk_create`; defaults to a conservative value to avoid
 # hitting SQLite limits
@@ -82,6 +109,41 @@ BATCH_SIZE = 50
 # Lower bound for search results to appear when using pgsql search
 PG_SEARCH_RANK_CUTOFF = 0.15
 
+# File backing the in-memory search index (if using memory_search). Built on
+# first use if missing
+MEMORY_SEARCH_INDEX = 'eregs.idx'
+
+# Search responses are cached (in the named Django cache) for this many
+# seconds; 0 disables caching. Only enable it with a shared cache (e.g.
+# memcached): writes invalidate cached searches only in processes sharing it
+SEARCH_CACHE = 'default'
+SEARCH_CACHE_TTL = 0
+
+# Searches with count=estimate stop counting matches beyond this many
+SEARCH_COUNT_CAP = 1000
+
+# Haystack searches with collapse=true group (at most) this many of the best
+# matches into sections
+HAYSTACK_COLLAPSE_CAP = 10000
+
+# Searches running longer than this many seconds are cancelled (Postgres,
+# SQLite and Elastic Search only); at most SEARCH_MAX_CONCURRENT run at once in
+# each process. Either may be 0 to disable it. Excess searches receive a 503
+SEARCH_TIMEOUT = 10
+SEARCH_MAX_CONCURRENT = 8
+
+# Limits for POST /search/batch. Searches which don't use the database (Elastic
+# Search, in-memory) are run concurrently on this many threads
+SEARCH_BATCH_MAX_QUERIES = 20
+SEARCH_BATCH_WORKERS = 4
+
+# Diff summaries (GET /diff/.../summary) are cached in the named Django cache
+# for this many seconds; 0 disables caching. Writing a diff invalidates them,
+# but only in processes sharing the cache, so only enable it with a shared
+# cache (e.g. memcached)
+DIFF_SUMMARY_CACHE = 'default'
+DIFF_SUMMARY_CACHE_TTL = 0
+
 _envvars = ('HTTP_AUTH_USER', 'HTTP_AUTH_PASSWORD')
 for var in _envvars:
     globals()[var] = os.environ.get(var)
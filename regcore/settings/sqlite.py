@@ -0,0 +1,5 @@
+from regcore.settings.base import *     # noqa
+
+INSTALLED_APPS.remove('haystack')
+INSTALLED_APPS.append('regcore_sqlite')
+SEARCH_HANDLER = 'regcore_sqlite.views.search'
@@ -0,0 +1,10 @@
+"""Signals sent by the storage backends so that optional apps (e.g. search
+indexes) can react to writes without the backends knowing about them"""
+from django.dispatch import Signal
+
+# Sent whenever a document tree (rooted at `label`) is inserted or deleted
+documents_changed = Signal(providing_args=['doc_type', 'label', 'version'])
+
+# Sent whenever the layer data for a document (`doc_id`) is inserted or
+# deleted; `name` is the layer's name
+layers_changed = Signal(providing_args=['doc_type', 'doc_id', 'name'])
@@ -4,7 +4,7 @@ from datetime import date
 import pytest
 
 from regcore.db.django_models import DMDiffs, DMDocuments, DMLayers, DMNotices
-from regcore.models import Diff, Document, Layer, Notice
+from regcore.models import Diff, DiffEntry, Document, Layer, Notice
 
 
 @pytest.mark.django_db
@@ -210,6 +210,44 @@ def test_diff_get_success():
     assert DMDiffs().get('lablab', 'oldold', 'newnew') == {'some': 'body'}
 
 
+@pytest.mark.django_db
+def test_diff_get_slice(django_assert_num_queries):
+    """Sub-labels should be read from the nearest ancestor's entries, without
+    loading the whole diff"""
+    dmd = DMDiffs()
+    dmd.insert('1005', 'old', 'new', {
+        '1005-1': {'op': 'deleted'}, '1005-12': {'op': 'modified'},
+        '1005-12-a': {'op': 'added'}, '1005-120': {'op': 'deleted'}})
+    dmd.insert('1005-12-b', 'old', 'new', {'1005-12-b-1': {'op': 'added'}})
+
+    with django_assert_num_queries(2):
+        assert dmd.get('1005-12', 'old', 'new') == {
+            '1005-12': {'op': 'modified'}, '1005-12-a': {'op': 'added'}}
+    assert dmd.get('1005-12-b-1', 'old', 'new') == {
+        '1005-12-b-1': {'op': 'added'}}
+    assert dmd.get('1005-2', 'old', 'new') == {}
+    assert dmd.get('1005-12', 'old', 'other') is None
+    assert dmd.get('1010-12', 'old', 'new') is None
+
+    dmd.delete('1005', 'old', 'new')
+    assert dmd.get('1005-12', 'old', 'new') is None
+    assert DiffEntry.objects.count() == 1
+
+
+@pytest.mark.django_db
+def test_diff_get_summary(django_assert_num_queries):
+    """Stored summaries should be read without the diff; others derived from
+    the (possibly sliced) diff"""
+    dmd = DMDiffs()
+    dmd.insert('1005', 'old', 'new', {'1005-2': {'op': 'added'}},
+               {'stored': 'summary'})
+    with django_assert_num_queries(1):
+        assert dmd.get_summary('1005', 'old', 'new') == {
+            'stored': 'summary'}
+    assert dmd.get_summary('1005-2', 'old', 'new')['added'] == 1
+    assert dmd.get_summary('1005', 'old', 'other') is None
+
+
 @pytest.mark.django_db
 def test_diff_insert_delete():
     """We can insert and replace a diff"""
@@ -1,12 +1,28 @@
+import json
+import threading
 from contextlib import contextmanager
 from unittest import TestCase
 
 import pytest
+from django.test import override_settings
 from mock import patch
 pytest.importorskip('pyelasticsearch')  # noqa
-from pyelasticsearch.exceptions import ElasticHttpNotFoundError
+from pyelasticsearch.exceptions import (
+    BulkError, ElasticHttpError, ElasticHttpNotFoundError)
 
-from regcore.db.es import ESDiffs, ESDocuments, ESLayers, ESNotices
+from regcore.db import es as es_module
+from regcore.db.es import (
+    ESDiffs, ESDocuments, ESLayers, ESNotices, get_client)
+
+
+def decode_actions(actions):
+    """Convert bulk index actions back into documents (with ids)"""
+    docs = []
+    for action in actions:
+        meta, doc = [json.loads(line) for line in action.split('\n')]
+        doc['id'] = meta['index']['_id']
+        docs.append(doc)
+    return docs
 
 
 class ESBase(object):
@@ -16,7 +32,7 @@ class ESBase(object):
     def expect_get(self, doc_type, ident, doc=None):
         """Expect an attempt to find a single document
            :param doc: document to return or None to test no document"""
-        with patch('regcore.db.es.ElasticSearch') as es:
+        with patch('regcore.db.es.get_client') as es:
             if doc is None:
                 es.return_value.get.side_effect = ElasticHttpNotFoundError
             else:
@@ -28,7 +44,7 @@ class ESBase(object):
     @contextmanager
     def expect_insert(self, doc_type, ident):
         """Expect a document to be written."""
-        with patch('regcore.db.es.ElasticSearch') as es:
+        with patch('regcore.db.es.get_client') as es:
             yield es.return_value.index
             self.assertEqual(doc_type, es.return_value.index.call_args[0][1])
             self.assertEqual(ident,
@@ -36,18 +52,20 @@ class ESBase(object):
 
     @contextmanager
     def expect_bulk_insert(self, doc_type, num_docs):
-        """Expect multiple documents to be written.."""
-        with patch('regcore.db.es.ElasticSearch') as es:
-            yield es.return_value.bulk_index
-            self.assertEqual(doc_type,
-                             es.return_value.bulk_index.call_args[0][1])
-            self.assertEqual(num_docs,
-                             len(es.return_value.bulk_index.call_args[0][2]))
+        """Expect multiple documents to be written. Yields a list which will
+        be populated with the (decoded) documents sent"""
+        written = []
+        with patch('regcore.db.es.get_client') as es:
+            yield written
+            for call in es.return_value.bulk.call_args_list:
+                self.assertEqual(doc_type, call[1]['doc_type'])
+                written.extend(decode_actions(call[0][0]))
+        self.assertEqual(num_docs, len(written))
 
     @contextmanager
     def expect_search(self, doc_type, query, results):
         """Expect a search to be performed and respond with these results"""
-        with patch('regcore.db.es.ElasticSearch') as es:
+        with patch('regcore.db.es.get_client') as es:
             es.return_value.search.return_value = {'hits': {'hits': results}}
             yield es.return_value.search
             self.assertEqual(es.return_value.search.call_args[1]['doc_type'],
@@ -61,53 +79,166 @@ class ESDocumentsTest(TestCase, ESBase):
         with self.expect_get('reg_tree', 'verver/lablab'):
             self.assertIsNone(ESDocuments().get('cfr', 'lablab', 'verver'))
 
-    def test_get_success(self):
+    def test_get_success_nested(self):
+        """Nodes stored before flattening include their subtree"""
         return_value = {'first': 0, 'version': 'remove', 'id': 'also',
                         'label_string': 'a', 'regulation': '100'}
         with self.expect_get('reg_tree', 'verver/lablab', return_value):
             self.assertEqual(ESDocuments().get('cfr', 'lablab', 'verver'),
                              {"first": 0})
 
+    def test_get_success(self):
+        def flat(label, left, right, parent, **kwargs):
+            node = {'label': label.split('-'), 'label_string': label,
+                    'text': label + ' text', 'left': left, 'right': right,
+                    'parent': parent, 'tree': 'verver/111',
+                    'version': 'verver', 'regulation': '111'}
+            node.update(kwargs)
+            return node
+        nodes = [flat('111-2', 2, 7, '111', title='Two'),
+                 flat('111-2-a', 3, 4, '111-2'),
+                 flat('111-2-b', 5, 6, '111-2', node_type='regtext')]
+        with patch('regcore.db.es.get_client') as es:
+            es.return_value.get.return_value = {'_source': nodes[0]}
+            es.return_value.search.return_value = {'hits': {'hits': [
+                {'_source': node} for node in nodes]}}
+            result = ESDocuments().get('cfr', '111-2', 'verver')
+
+            query = es.return_value.search.call_args[0][0]
+            self.assertEqual(query['sort'], [{'left': 'asc'}])
+            self.assertIn({'range': {'left': {'gte': 2, 'lte': 7}}},
+                          query['query']['filtered']['filter']['bool']['must'])
+            self.assertEqual(es.return_value.search.call_args[1]['size'], 3)
+
+        self.assertEqual(result, {
+            'label': ['111', '2'], 'text': '111-2 text', 'title': 'Two',
+            'children': [
+                {'label': ['111', '2', 'a'], 'text': '111-2-a text',
+                 'children': []},
+                {'label': ['111', '2', 'b'], 'text': '111-2-b text',
+                 'node_type': 'regtext', 'children': []}]})
+
+    @override_settings(ELASTIC_SEARCH_SCROLL_SIZE=2)
+    def test_get_scrolls_large_subtrees(self):
+        """Subtrees larger than a page should be scrolled through"""
+        nodes = [{'label': ['111'], 'label_string': '111', 'left': 1,
+                  'right': 6, 'parent': None, 'tree': 'verver/111'}] + [
+            {'label': ['111', str(idx)], 'label_string': '111-' + str(idx),
+             'left': 2 * idx, 'right': 2 * idx + 1, 'parent': '111',
+             'tree': 'verver/111'} for idx in (1, 2)]
+        with patch('regcore.db.es.get_client') as es:
+            client = es.return_value
+            client.get.return_value = {'_source': nodes[0]}
+            client.search.return_value = {'_scroll_id': 's1', 'hits': {
+                'hits': [{'_source': node} for node in nodes[:2]]}}
+            client.send_request.side_effect = [
+                {'_scroll_id': 's2', 'hits': {'hits': [
+                    {'_source': nodes[2]}]}},
+                {'_scroll_id': 's3', 'hits': {'hits': []}},
+                {}]
+            result = ESDocuments().get('cfr', '111', 'verver')
+
+            self.assertEqual(client.search.call_args[1]['size'], 2)
+            self.assertIn('es_scroll', client.search.call_args[1])
+        self.assertEqual([c['label'] for c in result['children']],
+                         [['111', '1'], ['111', '2']])
+
+    def test_get_walks_inconsistent_subtrees(self):
+        """If part of the subtree was re-written separately (so is missing
+        from the range), it should be walked via parent labels"""
+        def flat(label, parent, position=0, tree='verver/111', **kwargs):
+            node = {'label': label.split('-'), 'label_string': label,
+                    'parent': parent, 'position': position, 'tree': tree,
+                    'doc_type': 'cfr', 'version': 'verver'}
+            node.update(kwargs)
+            return node
+        root = flat('111', None, left=1, right=8)
+        by_parent = {
+            '111': [flat('111-2', '111', 1, tree='verver/111-2'),
+                    flat('111-1', '111', 0)],
+            '111-1': [],
+            '111-2': [flat('111-2-a', '111-2', tree='verver/111-2')],
+            '111-2-a': [],
+        }
+
+        def scroll(doc_type, query):
+            terms = query['query']['filtered']['filter']['bool']['must'][2]
+            return [{'_source': node} for parent in terms['terms']['parent']
+                    for node in by_parent[parent]]
+
+        with patch('regcore.db.es.get_client') as es, \
+                patch.object(ESDocuments, 'scroll', side_effect=scroll):
+            es.return_value.get.return_value = {'_source': root}
+            es.return_value.search.return_value = {'hits': {'hits': [
+                {'_source': root}, {'_source': by_parent['111'][1]}]}}
+            result = ESDocuments().get('cfr', '111', 'verver')
+
+        self.assertEqual(result['label'], ['111'])
+        self.assertEqual([c['label'] for c in result['children']],
+                         [['111', '1'], ['111', '2']])
+        self.assertEqual(result['children'][1]['children'][0]['label'],
+                         ['111', '2', 'a'])
+
     def test_bulk_insert(self):
-        n2 = {'text': 'some text', 'label': ['111', '2'], 'children': []}
+        n2 = {'text': 'some text', 'label': ['111', '2'], 'children': [],
+              'node_type': 'regtext'}
         n3 = {'text': 'other', 'label': ['111', '3'], 'children': []}
         # Use a copy of the children
-        root = {'text': 'root', 'label': ['111'], 'children': [dict(n2),
-                                                               dict(n3)]}
+        root = {'text': 'root', 'label': ['111'], 'title': 'Root',
+                'children': [dict(n2), dict(n3)]}
         nodes = [root, n2, n3]
 
         with self.expect_bulk_insert('reg_tree', 3) as bulk_insert:
             ESDocuments().bulk_insert(nodes, 'cfr', 'verver')
 
-        root.update({'version': 'verver', 'regulation': '111',
-                     'label_string': '111', 'id': 'verver/111', 'root': True,
-                     'is_subpart': False})
-        n2.update({'version': 'verver', 'regulation': '111',
-                   'label_string': '111-2', 'id': 'verver/111-2',
-                   'root': False, 'is_subpart': False})
-        n3.update({'version': 'verver', 'regulation': '111',
-                   'label_string': '111-3', 'id': 'verver/111-3',
-                   'root': False, 'is_subpart': False})
-        bulk_data = [dict(root), dict(n2), dict(n3)]
+        shared = {'version': 'verver', 'regulation': '111', 'doc_type': 'cfr',
+                  'tree': 'verver/111', 'is_subpart': False}
+        root = {'text': 'root', 'label': ['111'], 'title': 'Root',
+                'label_string': '111', 'id': 'verver/111', 'root': True,
+                'section': '111', 'left': 1, 'right': 6, 'parent': None,
+                'position': 0}
+        n2 = {'text': 'some text', 'label': ['111', '2'],
+              'node_type': 'regtext', 'label_string': '111-2',
+              'id': 'verver/111-2', 'root': False, 'section': '111-2',
+              'left': 2, 'right': 3, 'parent': '111', 'position': 0}
+        n3 = {'text': 'other', 'label': ['111', '3'],
+              'label_string': '111-3', 'id': 'verver/111-3', 'root': False,
+              'section': '111-3', 'left': 4, 'right': 5, 'parent': '111',
+              'position': 1}
+        bulk_data = [root, n2, n3]
         for node in bulk_data:
-            node['doc_type'] = 'cfr'
-        self.assertEqual(bulk_data, bulk_insert.call_args[0][2])
+            node.update(shared)
+        self.assertEqual(bulk_data, bulk_insert)
 
     def test_listing(self):
-        query = {'match': {'label_string': 'lll', 'doc_type': 'cfr'}}
-        results = [{'fields': {'version': 'ver1', 'label_string': 'lll'}},
-                   {'fields': {'version': 'aaa', 'label_string': 'lll'}},
-                   {'fields': {'version': '333', 'label_string': 'lll'}},
-                   {'fields': {'version': 'four', 'label_string': 'lll'}}]
-        with self.expect_search('reg_tree', query, results):
+        def bucket(key, *labels):
+            return {'key': key, 'labels': {'buckets': [
+                {'key': label} for label in labels]}}
+        aggregations = {'versions': {'buckets': [
+            bucket('ver1', 'lll'), bucket('aaa', 'lll', 'mmm'),
+            bucket('333', 'lll')]}}
+        with patch('regcore.db.es.get_client') as es:
+            es.return_value.search.return_value = {
+                'aggregations': aggregations}
             entries = ESDocuments().listing('cfr', 'lll')
+            query = es.return_value.search.call_args[0][0]
+            self.assertEqual(
+                query['query']['filtered']['filter']['bool']['must'],
+                [{'term': {'doc_type': 'cfr'}},
+                 {'term': {'label_string': 'lll'}}])
+            self.assertEqual(
+                query['aggs']['versions']['terms'],
+                {'field': 'version', 'size': 0})
+            self.assertEqual(es.return_value.search.call_args[1]['size'], 0)
 
-        self.assertEqual([('333', 'lll'), ('aaa', 'lll'), ('four', 'lll'),
-                          ('ver1', 'lll')], entries)
-
-        query = {'match': {'root': True, 'doc_type': 'cfr'}}
-        with self.expect_search('reg_tree', query, results):
             ESDocuments().listing('cfr')
+            query = es.return_value.search.call_args[0][0]
+            self.assertEqual(
+                query['query']['filtered']['filter']['bool']['must'],
+                [{'term': {'doc_type': 'cfr'}}, {'term': {'root': True}}])
+
+        self.assertEqual([('333', 'lll'), ('aaa', 'lll'), ('aaa', 'mmm'),
+                          ('ver1', 'lll')], entries)
 
 
 class ESLayersTest(TestCase, ESBase):
@@ -132,7 +263,7 @@ class ESLayersTest(TestCase, ESBase):
         del layers[1]['doc_id']
         transformed = [{'id': 'name:cfr:verver:111-22', 'layer': layers[0]},
                        {'id': 'name:cfr:verver:111-23', 'layer': layers[1]}]
-        self.assertEqual(transformed, bulk_insert.call_args[0][2])
+        self.assertEqual(transformed, bulk_insert)
 
 
 class ESNoticesTest(TestCase, ESBase):
@@ -151,20 +282,40 @@ class ESNoticesTest(TestCase, ESBase):
         self.assertEqual(insert.call_args[0][2], {"some": "structure"})
 
     def test_listing(self):
-        query = {'match_all': {}}
-        results = [{'_id': 22, '_somethingelse': 5, 'fields': {
-                        'effective_on': '2005-05-05'}},
-                   {'_id': 9, '_somethingelse': 'blue', 'fields': {}}]
-        with self.expect_search('notice', query, results):
-            entries = ESNotices().listing()
+        """All pages of results should be scrolled through"""
+        page1 = [{'_id': 22, '_somethingelse': 5, 'fields': {
+                      'effective_on': '2005-05-05'}}]
+        page2 = [{'_id': 9, '_somethingelse': 'blue', 'fields': {}}]
+        with patch('regcore.db.es.get_client') as es:
+            es.return_value.search.return_value = {
+                '_scroll_id': 's1', 'hits': {'hits': page1}}
+            es.return_value.send_request.side_effect = [
+                {'_scroll_id': 's2', 'hits': {'hits': page2}},
+                {'_scroll_id': 's3', 'hits': {'hits': []}},
+                {}]
+            entries = list(ESNotices().listing())
+
+            self.assertEqual(
+                es.return_value.search.call_args[0][0]['query'],
+                {'match_all': {}})
+            self.assertEqual(
+                [call[1].get('body')
+                 for call in es.return_value.send_request.call_args_list],
+                ['s1', 's2', 's3'])
+            self.assertEqual(
+                es.return_value.send_request.call_args[0][0], 'DELETE')
 
         self.assertEqual([{'document_number': 22,
                            'effective_on': '2005-05-05'},
                           {'document_number': 9}], entries)
 
-        query = {'match': {'cfr_parts': '876'}}
-        with self.expect_search('notice', query, results):
-            ESNotices().listing('876')
+        with patch('regcore.db.es.get_client') as es:
+            es.return_value.search.return_value = {
+                '_scroll_id': 's1', 'hits': {'hits': []}}
+            self.assertEqual(list(ESNotices().listing('876')), [])
+            self.assertEqual(
+                es.return_value.search.call_args[0][0]['query'],
+                {'match': {'cfr_parts': '876'}})
 
 
 class ESDiffTest(TestCase, ESBase):
@@ -181,6 +332,49 @@ class ESDiffTest(TestCase, ESBase):
             self.assertEqual(ESDiffs().get('lablab', 'oldold', 'newnew'),
                              {"some": 'body'})
 
+    @patch('regcore.db.es.ESDiffs.get_many')
+    def test_get_slice(self, get_many):
+        """Sub-labels should be sliced from their nearest ancestor's diff"""
+        get_many.return_value = {
+            ('1005-12', 'old', 'new'): None,
+            ('1005', 'old', 'new'): {'1005-12-a': 'a', '1005-120': 'b'}}
+        with self.expect_get('diff', '1005-12-a/old/new'):
+            self.assertEqual(ESDiffs().get('1005-12-a', 'old', 'new'),
+                             {'1005-12-a': 'a'})
+        self.assertEqual(get_many.call_args[0][0], [
+            ('1005-12', 'old', 'new'), ('1005', 'old', 'new')])
+
+    def test_get_summary(self):
+        """Only the stored summary should be fetched"""
+        return_value = {'summary': {'stored': 'summary'}}
+        with self.expect_get('diff', 'lablab/oldold/newnew',
+                             return_value) as get:
+            self.assertEqual(
+                ESDiffs().get_summary('lablab', 'oldold', 'newnew'),
+                {'stored': 'summary'})
+        self.assertEqual(get.call_count, 1)
+        self.assertEqual(get.call_args[1], {'es__source': 'summary'})
+
+    def test_get_summary_unsummarized(self):
+        """Diffs indexed without a summary should be summarized"""
+        with self.expect_get('diff', 'lablab/oldold/newnew') as get:
+            get.side_effect = [{'_source': {}},
+                               {'_source': {'diff': {'1-2': {'op': 'added'}}}}]
+            summary = ESDiffs().get_summary('lablab', 'oldold', 'newnew')
+        self.assertEqual(summary['added'], 1)
+        self.assertEqual(get.call_args[1], {'es__source': 'diff'})
+
+    @patch('regcore.db.es.ESDiffs.get_many')
+    def test_get_summary_slice(self, get_many):
+        """Sub-labels should be summarized from their nearest ancestor's diff,
+        without fetching their own label again"""
+        get_many.return_value = {('1005', 'old', 'new'): {
+            '1005-12': {'op': 'deleted'}, '1005-13': {'op': 'deleted'}}}
+        with self.expect_get('diff', '1005-12/old/new') as get:
+            summary = ESDiffs().get_summary('1005-12', 'old', 'new')
+        self.assertEqual(summary['deleted'], 1)
+        self.assertEqual(get.call_count, 1)
+
     def test_insert(self):
         with self.expect_insert('diff', 'lablab/oldold/newnew') as insert:
             ESDiffs().insert('lablab', 'oldold', 'newnew',
@@ -190,3 +384,165 @@ class ESDiffTest(TestCase, ESBase):
                           'old_version': 'oldold',
                           'new_version': 'newnew',
                           'diff': {'some': 'structure'}})
+
+
+def test_get_client_shared(monkeypatch, settings):
+    """A single client should be shared (across threads) per configuration"""
+    monkeypatch.setattr(es_module, '_clients', {})
+    settings.ELASTIC_SEARCH_URLS = ['http://example.com:9200']
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(get_client()))
+               for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len({id(client) for client in results}) == 1
+    assert ESLayers().es is results[0]
+    assert ESDocuments().es is results[0]
+
+    settings.ELASTIC_SEARCH_TIMEOUT = 5
+    client = get_client()
+    assert client is not results[0]
+    assert client._transport.kwargs['timeout'] == 5
+
+
+def bulk_item(doc_id, status, error=None):
+    details = {'_id': doc_id, 'status': status}
+    if error:
+        details['error'] = error
+    return {'index': details}
+
+
+@pytest.fixture
+def bulk_settings(settings):
+    settings.ELASTIC_SEARCH_BULK_BACKOFF = 0
+    settings.ELASTIC_SEARCH_BULK_RETRIES = 2
+    return settings
+
+
+def test_bulk_index_chunks(bulk_settings):
+    """Chunks should be limited by size and sent concurrently"""
+    bulk_settings.ELASTIC_SEARCH_BULK_BYTES = 200
+    docs = [{'id': str(idx), 'text': 'a' * 50} for idx in range(10)]
+    with patch('regcore.db.es.get_client') as es:
+        # Create the mocked client before threads race to do so
+        bulk = es.return_value.bulk
+        ESLayers().bulk_index('layer', docs)
+        calls = bulk.call_args_list
+
+    assert len(calls) > 1
+    for call in calls:
+        assert len('\n'.join(call[0][0])) + 1 <= 200
+    written = [doc for call in calls for doc in decode_actions(call[0][0])]
+    assert sorted(written, key=lambda doc: int(doc['id'])) == docs
+
+
+def test_bulk_index_retries_throttled_items(bulk_settings):
+    docs = [{'id': 'a'}, {'id': 'b'}, {'id': 'c'}]
+    with patch('regcore.db.es.get_client') as es:
+        es.return_value.bulk.side_effect = [
+            BulkError([bulk_item('b', 429)],
+                      [bulk_item('a', 201), bulk_item('c', 201)]),
+            {'items': []},
+        ]
+        ESLayers().bulk_index('layer', docs)
+        calls = es.return_value.bulk.call_args_list
+
+    assert len(calls) == 2
+    assert decode_actions(calls[1][0][0]) == [{'id': 'b'}]
+
+
+def test_bulk_index_retries_throttled_requests(bulk_settings):
+    with patch('regcore.db.es.get_client') as es:
+        es.return_value.bulk.side_effect = [
+            ElasticHttpError(429, 'slow down'), {'items': []}]
+        ESLayers().bulk_index('layer', [{'id': 'a'}])
+        assert es.return_value.bulk.call_count == 2
+
+    with patch('regcore.db.es.get_client') as es:
+        es.return_value.bulk.side_effect = ElasticHttpError(429, 'slow')
+        with pytest.raises(ElasticHttpError):
+            ESLayers().bulk_index('layer', [{'id': 'a'}])
+        assert es.return_value.bulk.call_count == 3
+
+
+def test_bulk_index_reports_item_errors(bulk_settings):
+    """Items which fail (or remain throttled) should be reported together"""
+    docs = [{'id': 'a'}, {'id': 'b'}]
+    with patch('regcore.db.es.get_client') as es:
+        es.return_value.bulk.side_effect = [
+            BulkError([bulk_item('a', 400, 'Bad'), bulk_item('b', 429)], []),
+            BulkError([bulk_item('b', 429)], []),
+            BulkError([bulk_item('b', 429)], []),
+        ]
+        with pytest.raises(BulkError) as err:
+            ESLayers().bulk_index('layer', docs)
+
+    assert err.value.errors == [bulk_item('a', 400, 'Bad'),
+                                bulk_item('b', 429)]
+
+
+def mget_response(*found):
+    """Multi-get response; `found` is a sequence of (id, source or None)"""
+    return {'docs': [
+        {'_id': es_id, 'found': source is not None, '_source': source}
+        if source is not None else {'_id': es_id, 'found': False}
+        for es_id, source in found]}
+
+
+def test_layers_get_many():
+    with patch('regcore.db.es.get_client') as es:
+        es.return_value.multi_get.return_value = mget_response(
+            ('name:cfr:v:1', {'layer': {'some': 'layer'}}),
+            ('name:cfr:v:2', None))
+        result = ESLayers().get_many('name', 'cfr', ['v/1', 'v/2'])
+        assert es.return_value.multi_get.call_count == 1
+        assert sorted(es.return_value.multi_get.call_args[0][0]) == [
+            'name:cfr:v:1', 'name:cfr:v:2']
+    assert result == {'v/1': {'some': 'layer'}, 'v/2': None}
+
+
+def test_notices_diffs_get_many():
+    with patch('regcore.db.es.get_client') as es:
+        es.return_value.multi_get.return_value = mget_response(
+            ('n1', {'a': 'notice'}), ('n2', None))
+        assert ESNotices().get_many(['n1', 'n2']) == {
+            'n1': {'a': 'notice'}, 'n2': None}
+
+        es.return_value.multi_get.return_value = mget_response(
+            ('l/o/n', {'diff': {'a': 'diff'}}), ('l/o/n2', None))
+        assert ESDiffs().get_many([('l', 'o', 'n'), ('l', 'o', 'n2')]) == {
+            ('l', 'o', 'n'): {'a': 'diff'}, ('l', 'o', 'n2'): None}
+
+        assert ESDiffs().get_many([]) == {}
+        assert es.return_value.multi_get.call_count == 2
+
+
+def test_documents_get_many():
+    """Subtrees for all found nodes are fetched in one search"""
+    def flat(label, left, right, parent, tree='v/1'):
+        return {'label': label.split('-'), 'label_string': label,
+                'text': label, 'left': left, 'right': right,
+                'parent': parent, 'tree': tree}
+    tree_1 = [flat('1-a', 2, 5, '1'), flat('1-a-i', 3, 4, '1-a'),
+              flat('1-b', 6, 7, '1')]
+    with patch('regcore.db.es.get_client') as es:
+        es.return_value.multi_get.return_value = mget_response(
+            ('v/1-a', tree_1[0]), ('v/1-b', tree_1[2]), ('v/1-c', None),
+            ('v/2', {'label': ['2'], 'children': [], 'version': 'v',
+                     'id': 'v/2'}))
+        es.return_value.search.return_value = {'hits': {'hits': [
+            {'_source': node} for node in tree_1]}}
+        result = ESDocuments().get_many('cfr', ['1-a', '1-b', '1-c', '2'],
+                                        'v')
+        assert es.return_value.search.call_count == 1
+        assert es.return_value.search.call_args[1]['size'] == 3
+
+    assert result == {
+        '1-a': {'label': ['1', 'a'], 'text': '1-a', 'children': [
+            {'label': ['1', 'a', 'i'], 'text': '1-a-i', 'children': []}]},
+        '1-b': {'label': ['1', 'b'], 'text': '1-b', 'children': []},
+        '1-c': None,
+        '2': {'label': ['2'], 'children': []},
+    }
@@ -0,0 +1,77 @@
+from regcore import diff
+
+
+def node(label, text='', children=(), **kwargs):
+    return dict(label=label.split('-'), text=text, children=list(children),
+                node_type='regtext', **kwargs)
+
+
+def apply_text_ops(text, ops):
+    """Apply ops as the UI does: positions refer to the original text"""
+    chars = [[c] for c in text] + [[]]
+    for op in ops:
+        if op[0] == diff.DELETE:
+            for idx in range(op[1], op[2]):
+                chars[idx] = []
+        else:
+            chars[op[1]].insert(0, op[2])
+    return ''.join(''.join(c) for c in chars)
+
+
+def test_slice_diff():
+    assert diff.ancestor_labels('1005-12-a') == ['1005-12-a', '1005-12',
+                                                 '1005']
+    assert diff.slice_diff({'1005-12': 1, '1005-12-a': 2, '1005-120': 3,
+                            '1005': 4}, '1005-12') == {'1005-12': 1,
+                                                       '1005-12-a': 2}
+
+
+def test_text_ops():
+    old, new = 'The fee is charged monthly.', 'A fee is charged annually.'
+    ops = diff.text_ops(old, new)
+    assert {op[0] for op in ops} == {diff.DELETE, diff.INSERT}
+    assert apply_text_ops(old, ops) == new
+    assert diff.text_ops(old, old) == []
+
+
+def test_child_ops():
+    assert diff.child_ops(['1-a', '1-b', '1-c'], ['1-a', '1-c', '1-d']) == [
+        (diff.EQUAL, 0, 1), (diff.DELETE, 1, 2), (diff.EQUAL, 2, 3),
+        (diff.INSERT, 3, ['1-d'])]
+
+
+def test_changes_between():
+    old = node('1005', children=[
+        node('1005-1', 'Unchanged', title='Scope'),
+        node('1005-2', 'Old text', children=[node('1005-2-a', 'Removed')]),
+    ])
+    new = node('1005', children=[
+        node('1005-1', 'Unchanged', title='Scope'),
+        node('1005-2', 'New text', title='Definitions'),
+        node('1005-3', 'Added', lft=5),
+    ])
+    changes = diff.changes_between(old, new)
+
+    assert set(changes) == {'1005', '1005-2', '1005-2-a', '1005-3'}
+    assert changes['1005'] == {'op': diff.MODIFIED, 'child_ops': [
+        (diff.EQUAL, 0, 2), (diff.INSERT, 2, ['1005-3'])]}
+    assert changes['1005-2']['op'] == diff.MODIFIED
+    assert apply_text_ops('Old text', changes['1005-2']['text']) == \
+        'New text'
+    assert changes['1005-2']['title'] == [(diff.INSERT, 0, 'Definitions')]
+    assert changes['1005-2']['child_ops'] == [(diff.DELETE, 0, 1)]
+    assert changes['1005-2-a'] == {'op': diff.DELETED}
+    assert changes['1005-3'] == {'op': diff.ADDED, 'node': {
+        'label': ['1005', '3'], 'text': 'Added', 'node_type': 'regtext',
+        'child_labels': []}}
+
+
+def test_summarize():
+    assert diff.summarize({
+        '1005': {'op': diff.MODIFIED}, '1005-2': {'op': diff.ADDED},
+        '1005-2-a-1': {'op': diff.ADDED}, '1005-A-1': {'op': diff.DELETED},
+        'other': 'structure'}) == {
+            'added': 2, 'modified': 1, 'deleted': 1, 'sections': {
+                '1005': {'added': 0, 'modified': 1, 'deleted': 0},
+                '1005-2': {'added': 2, 'modified': 0, 'deleted': 0},
+                '1005-A': {'added': 0, 'modified': 0, 'deleted': 1}}}
@@ -0,0 +1,101 @@
+import threading
+
+import pytest
+from mock import Mock
+
+pytest.importorskip('haystack')     # noqa
+from regcore import haystack_signals
+from regcore.db.django_models import DMDocuments
+from regcore.signals import documents_changed
+from regcore.tests.recipes import doc_recipe
+
+
+@pytest.fixture
+def processor():
+    connections = {'default': Mock()}
+    router = Mock()
+    router.for_write.return_value = ['default']
+    processor = haystack_signals.QueuedSignalProcessor(connections, router)
+    yield processor
+    processor.teardown()
+
+
+@pytest.mark.django_db
+def test_handle_tree(monkeypatch, processor):
+    """Trees should be queued once the write commits"""
+    callbacks = []
+    monkeypatch.setattr(haystack_signals.transaction, 'on_commit',
+                        callbacks.append)
+    monkeypatch.setattr(processor, 'enqueue', Mock())
+    documents_changed.send(sender=DMDocuments, doc_type='cfr', label='1005',
+                           version='v1')
+
+    assert not processor.enqueue.called
+    callbacks[0]()
+    processor.enqueue.assert_called_once_with(('cfr', '1005', 'v1'))
+
+
+def test_enqueue(monkeypatch, processor):
+    """A background worker should index queued trees"""
+    indexed = threading.Event()
+    monkeypatch.setattr(processor, 'update_tree',
+                        lambda *args: indexed.set())
+    processor.enqueue(('cfr', '1005', 'v1'))
+    assert indexed.wait(5)
+
+
+def test_flush_deduplicates(monkeypatch, processor):
+    update_tree, invalidate_tree = Mock(), Mock()
+    monkeypatch.setattr(processor, 'update_tree', update_tree)
+    monkeypatch.setattr(haystack_signals.search_cache, 'invalidate_tree',
+                        invalidate_tree)
+    for tree in (('cfr', '1005', 'v1'), ('cfr', '1010', 'v1'),
+                 ('cfr', '1005', 'v1')):
+        processor.queue.put(tree)
+    processor.flush()
+    assert [c[0] for c in update_tree.call_args_list] == [
+        ('default', 'cfr', '1005', 'v1'), ('default', 'cfr', '1010', 'v1')]
+    # cached searches are invalidated once the index is updated
+    assert [c[0] for c in invalidate_tree.call_args_list] == [
+        ('cfr', '1005', 'v1'), ('cfr', '1010', 'v1')]
+
+    processor.flush()   # nothing queued
+    assert update_tree.call_count == 2
+
+
+@pytest.mark.django_db
+def test_update_tree(monkeypatch, processor, settings):
+    """Nodes should be indexed in chunks; those no longer present, removed"""
+    settings.HAYSTACK_UPDATE_CHUNK_SIZE = 2
+
+    def make(label_string, version='v1', **kwargs):
+        return doc_recipe.make(
+            id='{0}-{1}'.format(version, label_string), doc_type='cfr',
+            label_string=label_string, version=version, **kwargs)
+
+    root = make('1005')
+    for idx in range(4):
+        make('1005-{0}'.format(idx), parent=root)
+    make('1005', version='v2')
+    make('1010')
+
+    sqs = Mock()
+    sqs.return_value.models.return_value.filter.return_value\
+        .filter.return_value.values_list.return_value = [
+            ('v1-1005-3', '1005-3'), ('v1-1005-9', '1005-9'),
+            ('v1-1005-Subpart-A', '1005-Subpart-A')]
+    monkeypatch.setattr(haystack_signals, 'SearchQuerySet', sqs)
+    connection = processor.connections['default']
+    backend = connection.get_backend.return_value
+    index = connection.get_unified_index.return_value.get_index.return_value
+    index.index_queryset.side_effect = \
+        lambda using: haystack_signals.Document.objects.all()
+
+    processor.update_tree('default', 'cfr', '1005', 'v1')
+
+    chunks = [[node.pk for node in c[0][1]]
+              for c in backend.update.call_args_list]
+    assert chunks == [['v1-1005', 'v1-1005-0'], ['v1-1005-1', 'v1-1005-2'],
+                      ['v1-1005-3']]
+    removed = [c[0][0].pk for c in backend.remove.call_args_list]
+    assert removed == ['v1-1005-9', 'v1-1005-Subpart-A']
@@ -1,24 +1,51 @@
 from unittest import TestCase
 
 import pytest
-from mock import patch
+from mock import Mock, patch
 pytest.importorskip('pyelasticsearch')  # noqa
-from pyelasticsearch.exceptions import IndexAlreadyExistsError
+from pyelasticsearch.exceptions import (
+    ElasticHttpNotFoundError, IndexAlreadyExistsError)
 
+from regcore import index
 from regcore.index import init_schema
 
 
 class IndexTest(TestCase):
 
-    @patch('regcore.index.ElasticSearch')
+    @patch('regcore.index.get_client')
     def test_init_schema(self, es):
         init_schema()
         self.assertTrue(es.called)
         self.assertTrue(es.return_value.create_index.called)
         self.assertTrue(es.return_value.put_mapping.called)
 
-    @patch('regcore.index.ElasticSearch')
+    @patch('regcore.index.get_client')
     def test_init_schema_index_exists(self, es):
         es.return_value.create_index.side_effect = IndexAlreadyExistsError()
         init_schema()
         self.assertTrue(es.return_value.put_mapping.called)
+
+
+def test_switch_alias_replaces_index():
+    """An index with the alias's name (from init_schema) is replaced"""
+    es = Mock()
+    es.get_settings.return_value = {'eregs': {}}
+    es.get_aliases.side_effect = ElasticHttpNotFoundError()
+    with pytest.raises(ValueError):
+        index.switch_alias(es, 'eregs', 'eregs_2')
+    assert not es.delete_index.called
+
+    index.switch_alias(es, 'eregs', 'eregs_2', replace_index=True)
+    es.delete_index.assert_called_once_with('eregs')
+    es.update_aliases.assert_called_once_with(
+        [{'add': {'index': 'eregs_2', 'alias': 'eregs'}}])
+
+
+def test_remove_old_indexes_keep():
+    es = Mock()
+    es.get_aliases.return_value = {'eregs_4': {'aliases': {'eregs': {}}}}
+    es.get_settings.return_value = {
+        'eregs_1': {}, 'eregs_2': {}, 'eregs_3': {}, 'eregs_4': {},
+        'eregs_other': {}}
+    assert index.remove_old_indexes(es, 'eregs', keep=1) == [
+        'eregs_1', 'eregs_2']
@@ -0,0 +1,143 @@
+import pytest
+
+from regcore import inverted_index
+from regcore.models import Document, Layer
+
+
+def make_doc(label_string, text, title='', version='vvv', doc_type='cfr'):
+    return Document(id=label_string, label_string=label_string, text=text,
+                    title=title, version=version, doc_type=doc_type,
+                    root='-' not in label_string, node_type='regtext')
+
+
+@pytest.fixture
+def index(tmpdir):
+    path = str(tmpdir.join('index'))
+    inverted_index.write_index([
+        make_doc('1000', 'Regulation Z', 'Truth in lending'),
+        make_doc('1000-1', 'Overdraft fees and overdraft charges'),
+        make_doc('1000-2', 'Escrow accounts for fees'),
+        make_doc('1000-Subpart-A', 'Overdraft subpart'),
+        make_doc('2000-1', 'Overdraft again', version='v2'),
+        make_doc('2000-2', 'Preamble overdraft', doc_type='preamble'),
+    ], path)
+    return inverted_index.InvertedIndex(path)
+
+
+def labels(index, doc_ids):
+    return [index.document(doc_id)['label_string'] for doc_id in doc_ids]
+
+
+def test_tokenize():
+    assert inverted_index.tokenize('Some-thing, ELSE?') == [
+        'some', 'thing', 'else']
+
+
+@pytest.mark.django_db
+def test_postings_delta_encoded(index):
+    """Posting lists should decode to absolute document ids"""
+    doc_ids, freqs = index.postings(index.term_ids['overdraft'])
+    assert list(doc_ids) == [1, 3, 4, 5]
+    assert list(freqs) == [2, 1, 1, 1]
+
+
+def test_narrowest():
+    assert inverted_index._narrowest([0, 255]) == 0
+    assert inverted_index._narrowest([256]) == 1
+    assert inverted_index._narrowest([2 ** 16]) == 2
+    with pytest.raises(ValueError):
+        inverted_index._narrowest([2 ** 32])
+
+
+@pytest.mark.django_db
+def test_search_all_terms(index):
+    """Only documents with every term should match; ranked by BM25"""
+    total, doc_ids = index.search('fees', limit=10)
+    assert total == 2
+    assert labels(index, doc_ids) == ['1000-2', '1000-1']
+
+    total, doc_ids = index.search('overdraft fees', limit=10)
+    assert total == 1
+    assert labels(index, doc_ids) == ['1000-1']
+
+    assert index.search('overdraft missing', limit=10) == (0, [])
+    assert index.search('!!', limit=10) == (0, [])
+
+
+@pytest.mark.django_db
+def test_search_filters(index):
+    def search(**filters):
+        return labels(index, index.search('overdraft', limit=10,
+                                          **filters)[1])
+
+    assert set(search()) == {'1000-1', '1000-Subpart-A', '2000-1', '2000-2'}
+    assert set(search(doc_type='cfr', version='vvv')) == {
+        '1000-1', '1000-Subpart-A'}
+    assert search(regulation='2000', doc_type='preamble') == ['2000-2']
+    assert set(search(doc_type='cfr', is_subpart=False)) == {
+        '1000-1', '2000-1'}
+    assert search(is_subpart=True) == ['1000-Subpart-A']
+    assert search(is_root=True) == []
+    assert search(version='unknown') == []
+
+
+@pytest.mark.django_db
+def test_search_limit(index):
+    total, doc_ids = index.search('overdraft', limit=2)
+    assert total == 4
+    assert len(doc_ids) == 2
+
+
+@pytest.mark.django_db
+def test_search_after(index):
+    """Results should resume after the given (score, doc id)"""
+    _, ranked = index.search('overdraft', limit=10, with_scores=True)
+    assert len(ranked) == 4
+    doc_id, score = ranked[1]
+    total, rest = index.search('overdraft', limit=10, after=(score, doc_id))
+    assert total == 4
+    assert rest == [doc_id for doc_id, _ in ranked[2:]]
+
+
+@pytest.mark.django_db
+def test_titles_from_layers(tmpdir):
+    """Missing titles should be filled in from the keyterms and terms
+    layers"""
+    Layer.objects.create(name='keyterms', doc_type='cfr', doc_id='vvv/1000',
+                         layer={'1000-1': [{'key_term': 'Keyterm'}]})
+    Layer.objects.create(
+        name='terms', doc_type='cfr', doc_id='vvv/1000',
+        layer={'referenced': {
+            'a': {'reference': '1000-1', 'term': 'Defined'},
+            'b': {'reference': '1000-2', 'term': 'Defined'}}})
+    path = str(tmpdir.join('index'))
+    inverted_index.write_index([
+        make_doc('1000-1', 'Text'), make_doc('1000-2', 'Text'),
+        make_doc('1000-3', 'Text', title='Own')], path)
+    index = inverted_index.InvertedIndex(path)
+
+    assert [index.document(i)['title'] for i in range(3)] == [
+        'Keyterm', 'Defined', 'Own']
+    # titles are searchable
+    assert index.search('defined', limit=10) == (1, [1])
+
+
+@pytest.mark.django_db
+def test_load_index_builds_once(tmpdir, monkeypatch, settings):
+    """The index should be built when missing and cached thereafter"""
+    settings.MEMORY_SEARCH_INDEX = str(tmpdir.join('index'))
+    monkeypatch.setattr(inverted_index, '_loaded', {})
+    Document.objects.create(label_string='1000-1', text='Stored text',
+                            version='vvv', doc_type='cfr')
+
+    index = inverted_index.load_index()
+    assert tmpdir.join('index').check()
+    assert inverted_index.load_index() is index
+    assert index.search('stored', limit=10) == (1, [0])
+
+
+def test_bad_file(tmpdir):
+    path = tmpdir.join('index')
+    path.write('not an index')
+    with pytest.raises(ValueError):
+        inverted_index.InvertedIndex(str(path))
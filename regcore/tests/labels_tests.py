@@ -0,0 +1,16 @@
+import pytest
+
+from regcore.labels import section_label
+
+
+@pytest.mark.parametrize('label,expected', [
+    ('1005', '1005'),
+    ('1005-12', '1005-12'),
+    ('1005-12-a-1', '1005-12'),
+    ('1005-A-3', '1005-A'),
+    ('1005-Subpart', '1005-Subpart'),
+    ('1005-Subpart-A', '1005-Subpart-A'),
+    ('1005-Subjgrp-Abc', '1005-Subjgrp-Abc'),
+])
+def test_section_label(label, expected):
+    assert section_label(label) == expected
@@ -0,0 +1,16 @@
+import pytest
+from django.core.management import call_command
+
+from regcore.inverted_index import InvertedIndex
+from regcore.models import Document
+
+
+@pytest.mark.django_db
+def test_build_memory_index(tmpdir):
+    Document.objects.create(label_string='1000-1', text='Indexed text',
+                            version='vvv', doc_type='cfr')
+    path = str(tmpdir.join('index'))
+    call_command('build_memory_index', path)
+
+    index = InvertedIndex(path)
+    assert index.search('indexed', limit=10) == (1, [0])
@@ -0,0 +1,93 @@
+import json
+
+import pytest
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from mock import patch
+
+pytest.importorskip('pyelasticsearch')  # noqa
+from regcore.db.django_models import DMDocuments
+from regcore.management.commands import reindex_es
+from regcore.models import Diff, Layer, Notice
+
+
+def test_flatten():
+    tree = {'label': ['1'], 'children': [
+        {'label': ['1', 'a'], 'children': [
+            {'label': ['1', 'a', 'i'], 'children': []}]},
+        {'label': ['1', 'b'], 'children': []}]}
+    assert [n['label'] for n in reindex_es.flatten(tree)] == [
+        ['1'], ['1', 'a'], ['1', 'a', 'i'], ['1', 'b']]
+
+
+@pytest.mark.django_db
+def test_reindex(settings):
+    settings.ELASTIC_SEARCH_INDEX = 'eregs'
+    child = {'label': ['111', '1'], 'text': 'child', 'children': [],
+             'node_type': 'regtext'}
+    root = {'label': ['111'], 'text': 'root', 'children': [child],
+            'node_type': 'regtext'}
+    child['parent'] = root
+    DMDocuments().bulk_insert([root, child], 'cfr', 'vvv')
+    Layer.objects.create(name='terms', doc_type='cfr', doc_id='vvv/111',
+                         layer={'a': 'b'})
+    Notice.objects.create(document_number='nnn', publication_date='2001-01-01',
+                          notice={'some': 'notice'})
+    Diff.objects.create(label='111', old_version='v1', new_version='v2',
+                        diff={'some': 'diff'}, summary={'some': 'summary'})
+
+    with patch('regcore.management.commands.reindex_es.get_client') as es, \
+            patch('regcore.db.es.get_client', es):
+        client = es.return_value
+        client.get_aliases.return_value = {
+            'eregs_2002': {'aliases': {'eregs': {}}}}
+        client.get_settings.side_effect = lambda index: {
+            'eregs': {'eregs_2002': {}},
+            'eregs_*': {'eregs_2001': {}, 'eregs_2002': {}},
+        }[index]
+        call_command('reindex_es', workers=1)
+
+    index = client.create_index.call_args[0][0]
+    assert index.startswith('eregs_')
+    assert client.put_mapping.call_args[0][0] == index
+
+    written = {}
+    for call in client.bulk.call_args_list:
+        assert call[1]['index'] == index
+        for action in call[0][0]:
+            meta, doc = [json.loads(line) for line in action.split('\n')]
+            written[meta['index']['_id']] = doc
+    assert written['vvv/111']['text'] == 'root'
+    assert written['vvv/111-1']['parent'] == '111'
+    assert written['terms:cfr:vvv:111']['layer'] == {'a': 'b'}
+    notice_call, diff_call = client.index.call_args_list
+    assert notice_call[0][:3] == (index, 'notice', {'some': 'notice'})
+    assert diff_call[0][:2] == (index, 'diff')
+    assert diff_call[0][2]['summary'] == {'some': 'summary'}
+
+    client.update_aliases.assert_called_once_with([
+        {'remove': {'index': 'eregs_2002', 'alias': 'eregs'}},
+        {'add': {'index': index, 'alias': 'eregs'}}])
+    # The new index isn't in the (mocked) listing; by default, the most recent
+    # old index is kept
+    assert not client.delete_index.called
+
+
+@pytest.mark.django_db
+def test_reindex_refuses(settings):
+    """Without documents to load, or with an index where the alias would
+    go, the existing index should be left alone"""
+    settings.ELASTIC_SEARCH_INDEX = 'eregs'
+    with patch('regcore.management.commands.reindex_es.get_client') as es:
+        client = es.return_value
+        client.get_settings.return_value = {'eregs': {}}
+        with pytest.raises(CommandError):
+            call_command('reindex_es', workers=1)
+
+        DMDocuments().bulk_insert([{'label': ['111'], 'text': 'root',
+                                    'children': [], 'node_type': 'regtext'}],
+                                  'cfr', 'vvv')
+        with pytest.raises(CommandError):
+            call_command('reindex_es', workers=1)
+    assert not client.create_index.called
+    assert not client.delete_index.called
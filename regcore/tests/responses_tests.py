@@ -1,7 +1,8 @@
 import json
 from unittest import TestCase
 
-from regcore.responses import success, user_error
+from regcore.responses import (
+    stream_results, success, unavailable, user_error)
 
 
 class ResponsesTest(TestCase):
@@ -14,6 +15,13 @@ class ResponsesTest(TestCase):
         self.assertIn('my reason', response_text)
         json.loads(response_text)   # valid json
 
+    def test_unavailable(self):
+        response = unavailable('busy')
+        self.assertEqual(503, response.status_code)
+        self.assertEqual('1', response['Retry-After'])
+        self.assertEqual({'reason': 'busy'},
+                         json.loads(response.content.decode('utf-8')))
+
     def test_success_empty(self):
         response = success()
         self.assertEqual(204, response.status_code)
@@ -26,3 +34,20 @@ class ResponsesTest(TestCase):
         self.assertEqual('application/json', response['Content-type'])
         self.assertEqual(structure,
                          json.loads(response.content.decode('utf-8')))
+
+    def test_stream_results(self):
+        for results in ([], [{'a': 1}], [{'a': 1}, 2, 'three']):
+            response = stream_results(iter(results))
+            self.assertEqual(200, response.status_code)
+            self.assertEqual('application/json', response['Content-type'])
+            content = b''.join(response.streaming_content).decode('utf-8')
+            self.assertEqual({'results': results}, json.loads(content))
+
+    def test_stream_results_first_error(self):
+        """Errors fetching the first result should raise before any
+        response is sent"""
+        def results():
+            raise ValueError('unreachable')
+            yield {'a': 1}
+        with self.assertRaises(ValueError):
+            stream_results(results())
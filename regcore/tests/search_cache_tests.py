@@ -0,0 +1,88 @@
+import pytest
+
+from regcore import search_cache
+from regcore.db.django_models import DMLayers
+from regcore_read.views.search_utils import SearchArgs
+
+
+def args(q='term', version=None, regulation=None, page=0):
+    return SearchArgs(q=q, version=version, regulation=regulation,
+                      is_root=None, is_subpart=None, page=page, page_size=10,
+                      collapse=False, count='exact', cursor=None,
+                      facets=[], snippet=False)
+
+
+def key(*arg_list, **kwargs):
+    return search_cache.cache_key('handler', 'cfr', args(*arg_list, **kwargs))
+
+
+def test_normalize_query():
+    assert search_cache.normalize_query('  Some\tTERM\n here ') == \
+        'some term here'
+
+
+def test_cache_key_normalized():
+    """Case and whitespace differences in the query share a key; other
+    arguments do not"""
+    assert key('overdraft  Fees') == key('overdraft fees')
+    assert key('overdraft') != key('escrow')
+    assert key('overdraft') != key('overdraft', page=1)
+    assert key('overdraft') != key('overdraft', version='vvv')
+    assert key('overdraft') != search_cache.cache_key(
+        'handler', 'preamble', args('overdraft'))
+    assert key('overdraft') != search_cache.cache_key(
+        'other', 'cfr', args('overdraft'))
+
+
+@pytest.mark.parametrize('write, changed, unchanged', [
+    # write: (regulation, version)
+    (('1000', 'v1'),
+     [{}, {'regulation': '1000'}, {'version': 'v1'},
+      {'regulation': '1000', 'version': 'v1'}],
+     [{'regulation': '2000'}, {'version': 'v2'},
+      {'regulation': '1000', 'version': 'v2'}]),
+    (('1000', None),
+     [{}, {'regulation': '1000'}, {'version': 'v1'},
+      {'regulation': '1000', 'version': 'v2'}],
+     [{'regulation': '2000'}, {'regulation': '2000', 'version': 'v1'}]),
+])
+def test_invalidate(write, changed, unchanged):
+    """Writes should only invalidate searches which could include them"""
+    before = {repr(f): key(**f) for f in changed + unchanged}
+    search_cache.invalidate('cfr', *write)
+    for filters in changed:
+        assert key(**filters) != before[repr(filters)]
+    for filters in unchanged:
+        assert key(**filters) == before[repr(filters)]
+
+
+def test_invalidate_other_doc_type():
+    before = key()
+    search_cache.invalidate('preamble', '1000')
+    assert key() == before
+
+
+def test_stats():
+    assert search_cache.stats() == {'hits': 0, 'misses': 0, 'hit_rate': 0.0}
+    search_cache.record(hit=True)
+    search_cache.record(hit=False)
+    search_cache.record(hit=True)
+    search_cache.record(hit=True)
+    assert search_cache.stats() == {'hits': 3, 'misses': 1, 'hit_rate': 0.75}
+    search_cache.reset_stats()
+    assert search_cache.stats()['hits'] == 0
+
+
+@pytest.mark.django_db
+def test_layer_writes_invalidate():
+    """The layers signal is connected; CFR layers identify a version"""
+    before = {'v1': key(version='v1'), 'v2': key(version='v2')}
+    DMLayers().bulk_delete('terms', 'cfr', 'v1/1000')
+    assert key(version='v1') != before['v1']
+    assert key(version='v2') == before['v2']
+
+    before = key(regulation='1000')
+    search_cache.layers_written(None, 'preamble', '1000-1')
+    assert key(regulation='1000') == before     # different doc_type
+    search_cache.layers_written(None, 'cfr', '1000-1')
+    assert key(regulation='1000') != before
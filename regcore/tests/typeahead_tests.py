@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import pytest
+from mock import Mock
+
+from regcore import typeahead
+from regcore.db.django_models import DMDocuments, DMLayers
+
+
+@pytest.fixture
+def dm_storage(monkeypatch):
+    """Read entries from the Django models, whichever backends are
+    configured"""
+    monkeypatch.setattr(typeahead.storage, 'for_documents', DMDocuments())
+    monkeypatch.setattr(typeahead.storage, 'for_layers', DMLayers())
+    typeahead.reset_index()
+    yield
+    typeahead.reset_index()
+
+
+def write_regulation(version, title='Definitions'):
+    section = {'text': '', 'label': ['1005', '2'], 'children': [],
+               'title': '§ 1005.2 ' + title, 'node_type': 'regtext'}
+    root = {'text': '', 'label': ['1005'], 'children': [section],
+            'title': 'Electronic Fund Transfers', 'node_type': 'regtext'}
+    section['parent'] = root
+    DMDocuments().bulk_insert([root, section], 'cfr', version)
+
+
+def write_layers(version):
+    doc_id = version + '/1005'
+    DMLayers().bulk_insert([{
+        'doc_id': doc_id,
+        'referenced': {'account:1005-2-b': {'term': 'account',
+                                            'reference': '1005-2-b'}},
+    }], 'terms', 'cfr')
+    DMLayers().bulk_insert([{
+        'doc_id': doc_id, '1005-2-a': [{'key_term': 'Accepted card'}],
+    }], 'keyterms', 'cfr')
+
+
+def test_phrase():
+    assert typeahead.phrase('§ 1005.2  Definitions.') == 'definitions.'
+    assert typeahead.phrase('§§ 1005.2-1005.3 Scope') == 'scope'
+    assert typeahead.phrase('1005.3 Coverage') == 'coverage'
+    assert typeahead.phrase('Appendix A to Part 1005') == \
+        'appendix a to part 1005'
+
+
+def entry(text, version='v1', regulation='1005', doc_type='cfr',
+          label_string='1005-1', kind=typeahead.TITLE):
+    return typeahead.Entry(typeahead.phrase(text), text, kind, doc_type,
+                           regulation, label_string, version)
+
+
+def test_prefix_index_search():
+    index = typeahead.PrefixIndex([
+        entry('Account'), entry('Account', version='v2'),
+        entry('Accepted card', kind=typeahead.KEYTERM),
+        entry('Access device', regulation='1010'),
+        entry('Account', doc_type='preamble', version=None),
+        entry('Business day'),
+    ])
+
+    def texts(*args, **kwargs):
+        return [(r['text'], r['versions'])
+                for r in index.search(*args, **kwargs)]
+
+    assert texts('acc', 10, 'cfr') == [
+        ('Accepted card', ['v1']), ('Access device', ['v1']),
+        ('Account', ['v1', 'v2'])]
+    assert texts('ACCO', 10, 'cfr') == [('Account', ['v1', 'v2'])]
+    assert texts('acc', 2, 'cfr') == [
+        ('Accepted card', ['v1']), ('Access device', ['v1'])]
+    assert texts('acc', 10, 'cfr', regulation='1005', version='v2') == [
+        ('Account', ['v2'])]
+    assert texts('acc', 10, 'preamble') == [('Account', [])]
+    assert texts('b', 10, 'cfr') == [('Business day', ['v1'])]
+    assert texts('z', 10, 'cfr') == []
+
+
+def test_prefix_index_replace():
+    index = typeahead.PrefixIndex([entry('Account'), entry('Fee')])
+    index.replace('cfr', '1005', 'v1', [entry('Fees')])
+    index.replace('cfr', '1005', 'v2', [entry('Account', version='v2')])
+    assert len(index) == 2
+    assert [r['versions'] for r in index.search('', 10, 'cfr')] == [
+        ['v2'], ['v1']]
+
+
+@pytest.mark.django_db
+@pytest.mark.usefixtures('dm_storage')
+def test_entries():
+    write_regulation('v1')
+    write_layers('v1')
+
+    entries = sorted(typeahead.entries('cfr', '1005', 'v1'))
+    assert [(e.phrase, e.kind, e.label_string) for e in entries] == [
+        ('accepted card', typeahead.KEYTERM, '1005-2-a'),
+        ('account', typeahead.TERM, '1005-2-b'),
+        ('definitions', typeahead.TITLE, '1005-2'),
+        ('electronic fund transfers', typeahead.TITLE, '1005'),
+    ]
+    assert typeahead.entries('cfr', '1005', 'v2') == []
+
+
+@pytest.mark.django_db
+@pytest.mark.usefixtures('dm_storage')
+def test_incremental_updates():
+    """Once built, the index should follow document and layer writes"""
+    write_regulation('v1')
+    index = typeahead.get_index()
+    assert [r['text'] for r in index.search('def', 10, 'cfr')] == [
+        '§ 1005.2 Definitions']
+
+    write_layers('v1')
+    assert [r['text'] for r in index.search('acc', 10, 'cfr')] == [
+        'Accepted card', 'account']
+
+    DMDocuments().bulk_delete('cfr', '1005', 'v1')
+    write_regulation('v1', title='Definitions and terms')
+    write_regulation('v2')
+    assert [(r['text'], r['versions'])
+            for r in index.search('def', 10, 'cfr')] == [
+        ('§ 1005.2 Definitions', ['v2']),
+        ('§ 1005.2 Definitions and terms', ['v1'])]
+    assert typeahead.get_index() is index
+
+
+@pytest.mark.django_db
+@pytest.mark.usefixtures('dm_storage')
+def test_layer_writes_refresh_their_kind(monkeypatch):
+    """Only layers which provide entries should be re-read, replacing only
+    their own kind of entries"""
+    write_regulation('v1')
+    index = typeahead.get_index()
+    entries = Mock(wraps=typeahead.entries)
+    monkeypatch.setattr(typeahead, 'entries', entries)
+
+    DMLayers().bulk_insert([{'doc_id': 'v1/1005', '1005-2': []}], 'toc',
+                           'cfr')
+    assert not entries.called
+
+    write_layers('v1')
+    # (Postgres deployments' tables are updated too)
+    assert {c[0][3] for c in entries.call_args_list} == {
+        (typeahead.TERM,), (typeahead.KEYTERM,)}
+    assert [r['text'] for r in index.search('', 10, 'cfr')] == [
+        'Accepted card', 'account', '§ 1005.2 Definitions',
+        'Electronic Fund Transfers']
+
+
+@pytest.mark.django_db
+@pytest.mark.usefixtures('dm_storage')
+def test_rebuilt_after_other_writes(monkeypatch, settings):
+    """Writes noted by other processes, and age, should lead to a rebuild"""
+    write_regulation('v1')
+    index = typeahead.get_index()
+    assert typeahead.get_index() is index
+
+    typeahead._bump_generation()    # as if written by another process
+    rebuilt = typeahead.get_index()
+    assert rebuilt is not index
+    assert len(rebuilt) == len(index)
+    assert typeahead.get_index() is rebuilt
+
+    settings.TYPEAHEAD_INDEX_MAX_AGE = 60
+    now = rebuilt.built_at
+    monkeypatch.setattr(typeahead.time, 'time', lambda: now + 61)
+    assert typeahead.get_index() is not rebuilt
+
+
+@pytest.mark.django_db
+@pytest.mark.usefixtures('dm_storage')
+def test_stale_index_served_during_rebuild():
+    """Searches shouldn't wait for another thread's rebuild"""
+    index = typeahead.get_index()
+    typeahead._bump_generation()
+    with typeahead._build_lock:
+        assert typeahead.get_index() is index
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+"""Prefix ("typeahead") lookup of section titles, keyterms and defined terms.
+Entries are derived from each regulation version's document tree and its
+terms and keyterms layers. Postgres deployments store them in an indexed
+table (see regcore_pgsql); elsewhere they're held in a sorted array in each
+process, built when first needed. The writing process updates its array as
+documents and layers are written and bumps a generation counter in the
+TYPEAHEAD_CACHE; other processes rebuild theirs when it changes. Use a shared
+cache (e.g. memcached) for that to reach every process; regardless, arrays
+are rebuilt after TYPEAHEAD_INDEX_MAX_AGE seconds"""
+from __future__ import unicode_literals
+
+import logging
+import re
+import threading
+import time
+from bisect import bisect_left
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.cache import caches
+
+from regcore.db import storage
+
+logger = logging.getLogger(__name__)
+
+DOC_TYPES = ('cfr', 'preamble')
+TITLE, KEYTERM, TERM = 'title', 'keyterm', 'term'
+KINDS = (TITLE, KEYTERM, TERM)
+# Titles come from the document tree; other kinds from these layers
+LAYER_KINDS = {'keyterms': KEYTERM, 'terms': TERM}
+
+# Fields are ordered so that entries sort by their phrase and so that entries
+# differing only in their version are adjacent
+Entry = namedtuple('Entry', ['phrase', 'text', 'kind', 'doc_type',
+                             'regulation', 'label_string', 'version'])
+
+# Section numbers (e.g. "§ 1005.2") which lead many titles
+SECTION_NUMBER_RE = re.compile(r'^(?:§+\s*)?\d[\w.-]*\s+', re.UNICODE)
+
+
+def phrase(text):
+    """The normalized form of text which prefixes are matched against"""
+    text = re.sub(r'\s+', ' ', text, flags=re.UNICODE).strip()
+    return SECTION_NUMBER_RE.sub('', text).lower()
+
+
+def entries(doc_type, regulation, version, kinds=KINDS):
+    """The entries (of these kinds) for a single regulation version, fetched
+    from storage. Only the sources of those kinds are read"""
+    def entry(text, kind, label_string):
+        return Entry(phrase(text), text, kind, doc_type, regulation,
+                     label_string, version)
+
+    results = []
+    if TITLE in kinds:
+        to_visit = [storage.for_documents.get(doc_type, regulation, version)]
+        while to_visit:
+            node = to_visit.pop()
+            if node is None:
+                continue
+            if node.get('title'):
+                results.append(
+                    entry(node['title'], TITLE, '-'.join(node['label'])))
+            to_visit.extend(node.get('children', []))
+
+    # Layers for CFR documents are keyed by version/label
+    doc_id = '{0}/{1}'.format(version, regulation) if version else regulation
+    if KEYTERM in kinds:
+        keyterms = storage.for_layers.get('keyterms', doc_type, doc_id) or {}
+        for label_string, keyterm_list in keyterms.items():
+            for keyterm in keyterm_list:
+                results.append(
+                    entry(keyterm['key_term'], KEYTERM, label_string))
+    if TERM in kinds:
+        terms = storage.for_layers.get('terms', doc_type, doc_id) or {}
+        for term_struct in terms.get('referenced', {}).values():
+            results.append(
+                entry(term_struct['term'], TERM, term_struct['reference']))
+    return list(set(e for e in results if e.phrase))
+
+
+def regulation_versions():
+    """Every stored (doc_type, regulation, version) triple"""
+    for doc_type in DOC_TYPES:
+        for version, label in storage.for_documents.listing(doc_type):
+            yield doc_type, label, version
+
+
+def as_results(entries, limit):
+    """Serialize (sorted) entries, combining those which differ only in their
+    version.
+    :return: at most `limit` results"""
+    results = []
+    for entry in entries:
+        key = entry[:-1]
+        if results and results[-1][0] == key:
+            results[-1][1]['versions'].append(entry.version)
+            continue
+        if len(results) == limit:
+            break
+        results.append((key, {
+            'text': entry.text, 'type': entry.kind,
+            'regulation': entry.regulation, 'label': entry.label_string,
+            'versions': [entry.version]}))
+    for _, result in results:
+        result['versions'] = sorted(v for v in result['versions'] if v)
+    return [result for _, result in results]
+
+
+class PrefixIndex(object):
+    """Entries in a sorted array, searched by bisection. Updates replace all
+    of a regulation version's entries (of some kinds) at once, building a new
+    array, so searches never need to lock"""
+    def __init__(self, entries=(), generation=None):
+        self._lock = threading.Lock()
+        self._set(sorted(entries))
+        self.generation, self.built_at = generation, time.time()
+
+    def __len__(self):
+        return len(self._arrays[0])
+
+    def _set(self, entries):
+        # Replaced as one; a parallel list of phrases lets us bisect on them
+        self._arrays = (entries, [e.phrase for e in entries])
+
+    def replace(self, doc_type, regulation, version, new_entries,
+                kinds=KINDS):
+        source = (doc_type, regulation, version)
+        with self._lock:
+            kept = [e for e in self._arrays[0]
+                    if (e.doc_type, e.regulation, e.version) != source or
+                    e.kind not in kinds]
+            self._set(sorted(kept + list(new_entries)))
+
+    def matches(self, prefix, doc_type, regulation=None, version=None):
+        """Generate (sorted) entries whose phrase starts with `prefix`"""
+        entries, phrases = self._arrays
+        prefix = phrase(prefix)
+        for idx in range(bisect_left(phrases, prefix), len(phrases)):
+            if not phrases[idx].startswith(prefix):
+                break
+            entry = entries[idx]
+            if entry.doc_type == doc_type \
+                    and regulation in (None, entry.regulation) \
+                    and version in (None, entry.version):
+                yield entry
+
+    def search(self, prefix, limit, doc_type, regulation=None, version=None):
+        return as_results(
+            self.matches(prefix, doc_type, regulation, version), limit)
+
+
+GENERATION_KEY = 'typeahead:generation'
+
+_index = None
+# Swapping in a new index is guarded by _index_lock; building one (which
+# reads from storage) by _build_lock, so that searches needn't wait for it
+_index_lock = threading.Lock()
+_build_lock = threading.Lock()
+
+
+def get_cache():
+    return caches[settings.TYPEAHEAD_CACHE]
+
+
+def _generation():
+    return get_cache().get(GENERATION_KEY, 0)
+
+
+def _bump_generation():
+    """Note that the entries have changed, so that processes other than the
+    writer rebuild their indexes.
+    :return: the new generation"""
+    cache = get_cache()
+    # `add` is a no-op if the key exists; `incr` is atomic in shared caches
+    cache.add(GENERATION_KEY, 0, timeout=None)
+    try:
+        return cache.incr(GENERATION_KEY)
+    except ValueError:  # evicted between the two calls
+        cache.set(GENERATION_KEY, 1, timeout=None)
+        return 1
+
+
+def _is_current(index, generation):
+    max_age = settings.TYPEAHEAD_INDEX_MAX_AGE
+    return index is not None and index.generation == generation and (
+        not max_age or time.time() - index.built_at < max_age)
+
+
+def get_index():
+    """The process's PrefixIndex, (re)building it from storage if there is
+    none, if any process has written entries since it was built, or if it's
+    older than TYPEAHEAD_INDEX_MAX_AGE. While one thread rebuilds an index,
+    others continue to search the old one"""
+    global _index
+    generation, current = _generation(), _index
+    if _is_current(current, generation):
+        return current
+    if not _build_lock.acquire(current is None):
+        return current      # stale, but being rebuilt
+    try:
+        current = _index
+        if _is_current(current, generation):   # built while we waited
+            return current
+        index = PrefixIndex((entry for source in regulation_versions()
+                             for entry in entries(*source)), generation)
+        logger.info('Built typeahead index of %s entries', len(index))
+        with _index_lock:
+            _index = index
+        return index
+    finally:
+        _build_lock.release()
+
+
+def reset_index():
+    global _index
+    with _index_lock:
+        _index = None
+
+
+def refresh(doc_type, regulation, version, kinds=KINDS):
+    """Re-derive a regulation version's entries of these kinds, if the index
+    is built, and invalidate other processes' indexes"""
+    current = _index
+    new_entries = None
+    if current is not None:
+        new_entries = entries(doc_type, regulation, version, kinds)
+    generation = _bump_generation()
+    with _index_lock:
+        if current is not None and current is _index:
+            current.replace(doc_type, regulation, version, new_entries,
+                            kinds)
+            # Unless some other process wrote in the meantime, our index is
+            # now as current as theirs will be once rebuilt
+            if current.generation == generation - 1:
+                current.generation = generation
+
+
+def written_kinds(layer_name):
+    """The kinds of entries derived from a layer (all kinds, if the layer's
+    name wasn't sent)"""
+    if layer_name is None:
+        return KINDS
+    if layer_name in LAYER_KINDS:
+        return (LAYER_KINDS[layer_name],)
+    return ()
+
+
+def documents_written(sender, doc_type, label, version, **kwargs):
+    refresh(doc_type, label.split('-')[0], version, (TITLE,))
+
+
+def layers_written(sender, doc_type, doc_id, name=None, **kwargs):
+    """CFR layers are identified by version/label; preamble layers by label
+    alone. Most layers provide no entries, so are ignored"""
+    kinds = written_kinds(name)
+    if not kinds:
+        return
+    if '/' in doc_id:
+        version, label = doc_id.split('/', 1)
+    else:
+        version, label = None, doc_id
+    refresh(doc_type, label.split('-')[0], version, kinds)
@@ -13,6 +13,7 @@ from regcore_read.views import diff as rdiff
 from regcore_read.views import document as rdocument
 from regcore_read.views import layer as rlayer
 from regcore_read.views import notice as rnotice
+from regcore_read.views import search_batch as rsearch_batch
 from regcore_write.views import diff as wdiff
 from regcore_write.views import document as wdocument
 from regcore_write.views import layer as wlayer
@@ -23,6 +24,7 @@ mapping = defaultdict(dict)
 
 if 'regcore_read' in settings.INSTALLED_APPS:
     mapping['diff']['GET'] = rdiff.get
+    mapping['diff-summary']['GET'] = rdiff.summary
     mapping['layer']['GET'] = rlayer.get
     mapping['notice']['GET'] = rnotice.get
     mapping['notices']['GET'] = rnotice.listing
@@ -30,6 +32,8 @@ if 'regcore_read' in settings.INSTALLED_APPS:
     mapping['regulation']['GET'] = rdocument.get
     mapping['reg-versions']['GET'] = rdocument.listing
     mapping['search']['GET'] = import_string(settings.SEARCH_HANDLER)
+    mapping['search-batch']['POST'] = rsearch_batch.batch
+    mapping['typeahead']['GET'] = import_string(settings.TYPEAHEAD_HANDLER)
 
 
 if 'regcore_write' in settings.INSTALLED_APPS:
@@ -57,6 +61,10 @@ urlpatterns = [
         r'^diff/{0}/{1}/{2}$'.format(
             seg('label_id'), seg('old_version'), seg('new_version')),
         'diff', mapping['diff']),
+    by_verb_url(
+        r'^diff/{0}/{1}/{2}/summary$'.format(
+            seg('label_id'), seg('old_version'), seg('new_version')),
+        'diff-summary', mapping['diff-summary']),
     by_verb_url(
         r'^layer/{0}/{1}/{2}$'.format(
             seg('name'), seg('doc_type'), r'(?P<doc_id>[-\w]+(/[-\w]+)*)'),
@@ -78,4 +86,12 @@ urlpatterns = [
                 kwargs={'doc_type': 'cfr'}),
     by_verb_url(r'^search/preamble$', 'search', mapping['search'],
                 kwargs={'doc_type': 'preamble'}),
+    by_verb_url(r'^search(?:/cfr)?/batch$', 'search-batch',
+                mapping['search-batch'], kwargs={'doc_type': 'cfr'}),
+    by_verb_url(r'^search/preamble/batch$', 'search-batch',
+                mapping['search-batch'], kwargs={'doc_type': 'preamble'}),
+    by_verb_url(r'^typeahead(?:/cfr)?$', 'typeahead', mapping['typeahead'],
+                kwargs={'doc_type': 'cfr'}),
+    by_verb_url(r'^typeahead/preamble$', 'typeahead', mapping['typeahead'],
+                kwargs={'doc_type': 'preamble'}),
 ]
@@ -0,0 +1 @@
+default_app_config = 'regcore_pgsql.apps.RegcorePgsqlConfig'
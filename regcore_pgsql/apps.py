@@ -0,0 +1,48 @@
+from django.apps import AppConfig
+
+from regcore.signals import documents_changed, layers_changed
+
+
+def enqueue_index_update(sender, doc_type, label, version, **kwargs):
+    """Mark the changed document tree for re-indexing"""
+    from regcore_pgsql.models import PendingIndex
+    PendingIndex.objects.create(doc_type=doc_type, version=version,
+                                label_string=label)
+
+
+def update_typeahead(sender, doc_type, label, version, **kwargs):
+    """Typeahead entries are few (titles and terms only), so are replaced
+    immediately rather than queued. Document writes replace only titles"""
+    from regcore import typeahead
+    from regcore_pgsql.models import update_typeahead
+    update_typeahead(doc_type, label.split('-')[0], version,
+                     (typeahead.TITLE,))
+
+
+def update_layer_typeahead(sender, doc_type, doc_id, name=None, **kwargs):
+    """CFR layers are identified by version/label; preamble layers by label
+    alone. Only the entries derived from the written layer (if any) are
+    replaced"""
+    from regcore import typeahead
+    from regcore_pgsql.models import update_typeahead
+    kinds = typeahead.written_kinds(name)
+    if not kinds:
+        return
+    if '/' in doc_id:
+        version, label = doc_id.split('/', 1)
+    else:
+        version, label = None, doc_id
+    update_typeahead(doc_type, label.split('-')[0], version, kinds)
+
+
+class RegcorePgsqlConfig(AppConfig):
+    name = 'regcore_pgsql'
+
+    def ready(self):
+        from regcore.db.django_models import DMDocuments, DMLayers
+        documents_changed.connect(enqueue_index_update, sender=DMDocuments,
+                                  dispatch_uid='regcore_pgsql_enqueue')
+        documents_changed.connect(update_typeahead, sender=DMDocuments,
+                                  dispatch_uid='regcore_pgsql_typeahead')
+        layers_changed.connect(update_layer_typeahead, sender=DMLayers,
+                               dispatch_uid='regcore_pgsql_typeahead_layers')
@@ -1,30 +1,181 @@
+"""Rebuild the Postgres search index from scratch. Rather than building each
+DocumentIndex in Python, the combined text and titles of each section are
+aggregated in SQL over the section's MPTT (tree_id, lft, rght) range. Each
+regulation is aggregated by a separate worker into a shadow table, which is
+swapped in for the live table once complete; readers never see a partially
+built index. Typeahead entries are also rebuilt."""
 import logging
+import re
+from multiprocessing.pool import ThreadPool
 
 from django.core.management.base import BaseCommand
-from django.db import transaction
+from django.db import connection, transaction
 
 from regcore.models import Document
-from regcore_pgsql.models import DocumentIndex
+from regcore_pgsql.models import (
+    REBUILD_LOCK_ID, DocumentIndex, PendingIndex, rebuild_typeahead)
 
 
 logger = logging.getLogger(__name__)
 
+TABLE = DocumentIndex._meta.db_table
+SHADOW_TABLE = TABLE + '_shadow'
 
-def section_documents():
-    return Document.objects\
-        .filter(label_string__contains='-')\
-        .exclude(label_string__regex=r'.*-.*-.*')
+# Equivalent to models.section_documents
+SECTION_FILTER = r"node.label_string ~ '^[^-]*-[^-]*$'"
+
+REGULATIONS_SQL = """
+SELECT DISTINCT split_part(node.label_string, '-', 1)
+FROM {document} AS node
+WHERE {section_filter}
+""".format(document=Document._meta.db_table, section_filter=SECTION_FILTER)
+
+# Mirrors DocumentIndex.from_document and rebuild_search_vectors
+INSERT_SQL = """
+INSERT INTO {shadow} (document_id, combined_text, combined_titles,
+                      root_title, doc_root, search_vector)
+SELECT node.id, combined.text, combined.titles, node.title, %(doc_root)s,
+       setweight(to_tsvector(COALESCE(node.title, '')), 'B') ||
+       setweight(to_tsvector(combined.titles), 'A') ||
+       setweight(to_tsvector(combined.text), 'B')
+FROM {document} AS node
+CROSS JOIN LATERAL (
+    SELECT COALESCE(string_agg(child.text, E'\\n' ORDER BY child.lft)
+                    FILTER (WHERE child.text <> ''), '') AS text,
+           COALESCE(string_agg(child.title, E'\\n' ORDER BY child.lft)
+                    FILTER (WHERE child.title <> ''), '') AS titles
+    FROM {document} AS child
+    WHERE child.tree_id = node.tree_id
+      AND child.lft BETWEEN node.lft AND node.rght
+) AS combined
+WHERE {section_filter}
+  AND split_part(node.label_string, '-', 1) = %(doc_root)s
+""".format(shadow=SHADOW_TABLE, document=Document._meta.db_table,
+           section_filter=SECTION_FILTER)
+
+CONSTRAINTS_SQL = """
+SELECT conname, pg_get_constraintdef(oid)
+FROM pg_constraint
+WHERE conrelid = %s::regclass
+"""
+
+# Indexes which don't back a constraint (constraints recreate their own)
+INDEXES_SQL = """
+SELECT index_class.relname, pg_get_indexdef(index_class.oid)
+FROM pg_index
+JOIN pg_class AS index_class ON index_class.oid = pg_index.indexrelid
+WHERE pg_index.indrelid = %s::regclass
+  AND NOT EXISTS (
+    SELECT 1 FROM pg_constraint
+    WHERE conindid = pg_index.indexrelid
+      AND conrelid = pg_index.indrelid)
+"""
+
+INDEX_DEF_RE = re.compile(
+    r'^(CREATE (?:UNIQUE )?INDEX )\S+( ON (?:ONLY )?)\S+')
+
+
+def create_shadow_table(cursor):
+    """(Re)create an empty, unindexed copy of the index table"""
+    cursor.execute('DROP TABLE IF EXISTS {0}'.format(SHADOW_TABLE))
+    cursor.execute('CREATE TABLE {0} (LIKE {1} INCLUDING DEFAULTS)'.format(
+        SHADOW_TABLE, TABLE))
+
+
+def populate_regulation(doc_root):
+    """Aggregate all of a regulation's sections into the shadow table. Runs
+    in a worker thread, and hence on its own connection"""
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(INSERT_SQL, {'doc_root': doc_root})
+            logger.info('Indexed %s sections of %s', cursor.rowcount,
+                        doc_root)
+    finally:
+        connection.close()
+
+
+def copy_schema(cursor):
+    """Recreate the live table's constraints and indexes on the shadow table,
+    under temporary names.
+    :return: list of (kind, temporary name, original name) triples"""
+    renames = []
+    cursor.execute(CONSTRAINTS_SQL, [TABLE])
+    for idx, (name, definition) in enumerate(cursor.fetchall()):
+        tmp_name = '{0}_con{1}'.format(SHADOW_TABLE, idx)
+        cursor.execute('ALTER TABLE {0} ADD CONSTRAINT {1} {2}'.format(
+            SHADOW_TABLE, tmp_name, definition))
+        renames.append(('CONSTRAINT', tmp_name, name))
+
+    cursor.execute(INDEXES_SQL, [TABLE])
+    for idx, (name, definition) in enumerate(cursor.fetchall()):
+        tmp_name = '{0}_idx{1}'.format(SHADOW_TABLE, idx)
+        cursor.execute(INDEX_DEF_RE.sub(
+            r'\g<1>{0}\g<2>{1}'.format(tmp_name, SHADOW_TABLE), definition))
+        renames.append(('INDEX', tmp_name, name))
+    return renames
+
+
+def swap_tables(cursor, renames):
+    """Atomically replace the live table with the shadow table. Must be
+    called within a transaction"""
+    cursor.execute('LOCK TABLE {0} IN ACCESS EXCLUSIVE MODE'.format(TABLE))
+    cursor.execute('SELECT pg_get_serial_sequence(%s, %s)', [TABLE, 'id'])
+    sequence = cursor.fetchone()[0]
+    cursor.execute('ALTER SEQUENCE {0} OWNED BY {1}.id'.format(
+        sequence, SHADOW_TABLE))
+    cursor.execute('DROP TABLE {0}'.format(TABLE))
+    cursor.execute('ALTER TABLE {0} RENAME TO {1}'.format(
+        SHADOW_TABLE, TABLE))
+    for kind, tmp_name, name in renames:
+        if kind == 'CONSTRAINT':
+            cursor.execute('ALTER TABLE {0} RENAME CONSTRAINT {1} TO {2}'
+                           .format(TABLE, tmp_name, name))
+        else:
+            cursor.execute('ALTER INDEX {0} RENAME TO {1}'.format(
+                tmp_name, name))
 
 
 class Command(BaseCommand):
     help = "Rebuild document indexes for searching sections within Postgres"
 
-    @transaction.atomic
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=4,
+            help='number of regulations to index concurrently')
+
     def handle(self, *args, **options):
-        DocumentIndex.objects.all().delete()
-        count = section_documents().count()
-        for idx, document in enumerate(section_documents().iterator()):
-            if idx % 100 == 0:
-                logger.info('Inserted DocumentIndex %s / %s', idx, count)
-            DocumentIndex.from_document(document).save()
-        DocumentIndex.rebuild_search_vectors()
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_lock(%s)', [REBUILD_LOCK_ID])
+            try:
+                self.rebuild(cursor, options['workers'])
+            finally:
+                cursor.execute('SELECT pg_advisory_unlock(%s)',
+                               [REBUILD_LOCK_ID])
+
+    def rebuild(self, cursor, workers):
+        # Writes queued before now will be reflected in the rebuilt index;
+        # anything later is left for update_pgsql_index
+        last_pending = PendingIndex.objects.order_by('-pk')\
+            .values_list('pk', flat=True).first()
+
+        create_shadow_table(cursor)
+        cursor.execute(REGULATIONS_SQL)
+        regulations = [row[0] for row in cursor.fetchall()]
+        logger.info('Indexing %s regulations with %s workers',
+                    len(regulations), workers)
+        pool = ThreadPool(workers)
+        try:
+            pool.map(populate_regulation, regulations)
+        finally:
+            pool.close()
+            pool.join()
+
+        renames = copy_schema(cursor)
+        with transaction.atomic():
+            swap_tables(cursor, renames)
+            if last_pending is not None:
+                PendingIndex.objects.filter(pk__lte=last_pending).delete()
+        logger.info('Swapped in rebuilt index')
+
+        rebuild_typeahead()
+        logger.info('Rebuilt typeahead entries')
@@ -0,0 +1,34 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+
+from regcore_pgsql.models import process_pending
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Incrementally re-index sections touched by recent writes"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=100,
+            help='number of queued writes to process per transaction')
+        parser.add_argument(
+            '--forever', action='store_true',
+            help='keep polling the queue rather than exiting once empty')
+        parser.add_argument(
+            '--interval', type=float, default=1.0,
+            help='seconds to sleep between polls of an empty queue')
+
+    def handle(self, *args, **options):
+        while True:
+            processed = process_pending(options['batch_size'])
+            if processed:
+                logger.info('Re-indexed %s queued writes', processed)
+            elif options['forever']:
+                time.sleep(options['interval'])
+            else:
+                break
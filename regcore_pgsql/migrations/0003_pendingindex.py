@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('regcore_pgsql', '0002_documentindex_doc_root'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingIndex',
+            fields=[
+                ('id', models.AutoField(
+                    auto_created=True, primary_key=True, serialize=False,
+                    verbose_name='ID')),
+                ('doc_type', models.SlugField(max_length=20)),
+                ('version', models.SlugField(
+                    blank=True, max_length=20, null=True)),
+                ('label_string', models.SlugField(max_length=200)),
+            ],
+        ),
+    ]
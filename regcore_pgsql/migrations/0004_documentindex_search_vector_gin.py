@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+GIN_INDEX = 'regcore_pgs_search__724a27_gin'
+
+
+def create_gin_index(apps, schema_editor):
+    """Search queries prefilter on the search vector. Created by hand, as
+    Django only declares GIN indexes from 1.11"""
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(
+            'CREATE INDEX IF NOT EXISTS {0} ON regcore_pgsql_documentindex '
+            'USING gin (search_vector)'.format(GIN_INDEX))
+
+
+def drop_gin_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX IF EXISTS {0}'.format(GIN_INDEX))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('regcore_pgsql', '0003_pendingindex'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_gin_index, drop_gin_index),
+    ]
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+PREFIX_INDEX = 'regcore_pgsql_typeaheadentry_phrase_like'
+
+
+def create_prefix_index(apps, schema_editor):
+    """Prefix (LIKE 'abc%') matches on the phrase need the pattern operator
+    class regardless of the database's collation; Django (1.11) can't declare
+    index operator classes"""
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(
+            'CREATE INDEX {0} ON regcore_pgsql_typeaheadentry '
+            '(doc_type, phrase text_pattern_ops)'.format(PREFIX_INDEX))
+
+
+def drop_prefix_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX {0}'.format(PREFIX_INDEX))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('regcore_pgsql', '0004_documentindex_search_vector_gin'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TypeaheadEntry',
+            fields=[
+                ('id', models.AutoField(
+                    auto_created=True, primary_key=True, serialize=False,
+                    verbose_name='ID')),
+                ('doc_type', models.SlugField(max_length=20)),
+                ('regulation', models.SlugField(max_length=200)),
+                ('version', models.SlugField(
+                    blank=True, max_length=20, null=True)),
+                ('label_string', models.SlugField(max_length=200)),
+                ('kind', models.SlugField(max_length=20)),
+                ('text', models.TextField()),
+                ('phrase', models.TextField()),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='typeaheadentry',
+            index_together=set([('doc_type', 'regulation', 'version')]),
+        ),
+        migrations.RunPython(create_prefix_index, drop_prefix_index),
+    ]
@@ -1,8 +1,23 @@
 from django.contrib.postgres.search import SearchVector, SearchVectorField
-from django.db import models
+from django.db import connection, models, transaction
+from django.db.models import Q
 
+from regcore import search_cache, typeahead
+from regcore.labels import section_label
 from regcore.models import Document
 
+# Held exclusively for the duration of a full rebuild (which replaces the
+# DocumentIndex table); incremental updates share it
+REBUILD_LOCK_ID = 41001
+
+
+def section_documents():
+    """Only CFR sections (e.g. 1005-12) are indexed; not the root nor
+    paragraphs"""
+    return Document.objects\
+        .filter(label_string__contains='-')\
+        .exclude(label_string__regex=r'.*-.*-.*')
+
 
 class DocumentIndex(models.Model):
     document = models.ForeignKey(Document, on_delete=models.CASCADE)
@@ -11,6 +26,7 @@ class DocumentIndex(models.Model):
     root_title = models.TextField()
     doc_root = models.SlugField(max_length=200)     # denormalized
 
+    # GIN-indexed; see migration 0004
     search_vector = SearchVectorField()
 
     @classmethod
@@ -27,11 +43,124 @@ class DocumentIndex(models.Model):
         )
 
     @classmethod
-    def rebuild_search_vectors(cls):
-        cls.objects.update(search_vector=(
+    def rebuild_search_vectors(cls, queryset=None):
+        if queryset is None:
+            queryset = cls.objects.all()
+        queryset.update(search_vector=(
             # note that the root title gets double-counted, as it's also in
             # combined_titles
             SearchVector('root_title', weight='B') +
             SearchVector('combined_titles', weight='A') +
             SearchVector('combined_text', weight='B')
         ))
+
+
+class PendingIndex(models.Model):
+    """Queue of document trees which have been written (or deleted) since
+    their sections were last indexed. Drained by `update_pgsql_index`"""
+    doc_type = models.SlugField(max_length=20)
+    version = models.SlugField(max_length=20, null=True, blank=True)
+    label_string = models.SlugField(max_length=200)
+
+    def affected_sections(self):
+        """Sections which contain or are contained by the changed tree.
+        Subparts, etc. contain sections which don't share their label's
+        prefix (1005-Subpart-A contains 1005-12), so these are found by their
+        position in the tree"""
+        sections = section_documents().filter(
+            doc_type=self.doc_type, version=self.version)
+        node = Document.objects.filter(
+            doc_type=self.doc_type, version=self.version,
+            label_string=self.label_string).first()
+        if node is None:    # deleted; only its containing section remains
+            return sections.filter(
+                label_string=section_label(self.label_string))
+        return sections.filter(tree_id=node.tree_id).filter(
+            Q(lft__gte=node.lft, rght__lte=node.rght) |
+            Q(lft__lte=node.lft, rght__gte=node.rght))
+
+
+class TypeaheadEntry(models.Model):
+    """A title or term, matched by prefix. The (normalized) phrase is indexed
+    for LIKE 'prefix%' queries; see regcore.typeahead"""
+    doc_type = models.SlugField(max_length=20)
+    regulation = models.SlugField(max_length=200)
+    version = models.SlugField(max_length=20, null=True, blank=True)
+    label_string = models.SlugField(max_length=200)
+    kind = models.SlugField(max_length=20)
+    text = models.TextField()
+    phrase = models.TextField()
+
+    class Meta:
+        index_together = [('doc_type', 'regulation', 'version')]
+
+    @classmethod
+    def from_entry(cls, entry):
+        return cls(doc_type=entry.doc_type, regulation=entry.regulation,
+                   version=entry.version, label_string=entry.label_string,
+                   kind=entry.kind, text=entry.text, phrase=entry.phrase)
+
+
+def update_typeahead(doc_type, regulation, version, kinds=typeahead.KINDS):
+    """Replace a regulation version's typeahead entries of these kinds"""
+    new_entries = typeahead.entries(doc_type, regulation, version, kinds)
+    with transaction.atomic():
+        TypeaheadEntry.objects.filter(
+            doc_type=doc_type, regulation=regulation, version=version,
+            kind__in=kinds).delete()
+        TypeaheadEntry.objects.bulk_create(
+            [TypeaheadEntry.from_entry(entry) for entry in new_entries])
+
+
+def rebuild_typeahead():
+    """Replace all typeahead entries"""
+    with transaction.atomic():
+        TypeaheadEntry.objects.all().delete()
+        for source in typeahead.regulation_versions():
+            TypeaheadEntry.objects.bulk_create(
+                [TypeaheadEntry.from_entry(entry)
+                 for entry in typeahead.entries(*source)])
+
+
+def process_pending(batch_size):
+    """Re-index the sections touched by (up to) `batch_size` queued writes.
+    Entries locked by a concurrent worker are skipped, as is everything
+    while a full rebuild is in progress.
+    :return: the number of queue entries processed"""
+    with transaction.atomic():
+        pending = PendingIndex.objects.order_by('pk')
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_try_advisory_xact_lock_shared(%s)',
+                               [REBUILD_LOCK_ID])
+                if not cursor.fetchone()[0]:
+                    return 0
+                # select_for_update(skip_locked=True) needs Django 1.11
+                cursor.execute(
+                    'SELECT id FROM {0} ORDER BY id LIMIT %s '
+                    'FOR UPDATE SKIP LOCKED'.format(
+                        PendingIndex._meta.db_table),
+                    [batch_size])
+                pending = pending.filter(
+                    pk__in=[row[0] for row in cursor.fetchall()])
+        pending = list(pending[:batch_size])
+        if not pending:
+            return 0
+        unique = {(p.doc_type, p.version, p.label_string): p for p in pending}
+
+        section_ids = set()
+        for entry in unique.values():
+            section_ids.update(
+                entry.affected_sections().values_list('pk', flat=True))
+
+        DocumentIndex.objects.filter(document__in=section_ids).delete()
+        DocumentIndex.objects.bulk_create(
+            [DocumentIndex.from_document(section)
+             for section in Document.objects.filter(pk__in=section_ids)])
+        DocumentIndex.rebuild_search_vectors(
+            DocumentIndex.objects.filter(document__in=section_ids))
+        PendingIndex.objects.filter(pk__in=[p.pk for p in pending]).delete()
+    # Searches since the writes may have cached the old index's results
+    for doc_type, version, label in unique:
+        search_cache.invalidate_tree(doc_type, label, version)
+    return len(pending)
@@ -1,11 +1,13 @@
 import pytest
 from django.core.management import call_command
-from mock import Mock
+from django.db import connection
 
 pytest.importorskip('django', minversion='1.10')    # noqa
 from regcore.tests.recipes import doc_recipe
 from regcore_pgsql.management.commands import rebuild_pgsql_index
-from regcore_pgsql.models import DocumentIndex
+from regcore_pgsql.models import (DocumentIndex, PendingIndex,
+                                  section_documents)
+from regcore_pgsql.tests.utils import requires_pg
 
 
 @pytest.mark.django_db
@@ -18,17 +20,16 @@ def test_section_documents():
     doc_recipe.make(label_string='root-1-b', parent=section1)
     doc_recipe.make(label_string='root-2', parent=root)
 
-    results = rebuild_pgsql_index.section_documents()
+    results = section_documents()
 
     assert {d.label_string for d in results} == {'root-1', 'root-2'}
 
 
-@pytest.mark.django_db
-def test_creates_index(monkeypatch):
+@requires_pg
+@pytest.mark.django_db(transaction=True)
+def test_creates_index():
     """We should see a new DocumentIndex per section, containing the text of
     all children"""
-    monkeypatch.setattr(rebuild_pgsql_index.DocumentIndex,
-                        'rebuild_search_vectors', Mock())
     root = doc_recipe.make(label_string='root')
     section1 = doc_recipe.make(label_string='root-1', parent=root)
     p1a = doc_recipe.make(label_string='root-1-a', parent=section1)
@@ -38,8 +39,6 @@ def test_creates_index(monkeypatch):
     p2c = doc_recipe.make(label_string='root-2-c', parent=section2)
 
     call_command('rebuild_pgsql_index')
-    rebuild_fn = rebuild_pgsql_index.DocumentIndex.rebuild_search_vectors
-    assert rebuild_fn.call_count == 1
 
     indexes = DocumentIndex.objects.order_by('document__label_string')
     assert indexes.count() == 2
@@ -52,6 +51,7 @@ def test_creates_index(monkeypatch):
         assert d.text in index1.combined_text
         assert d.title in index1.combined_titles
     assert section1.title == index1.root_title
+    assert index1.search_vector
 
     for d in (root, section1, p1a, p1a1, p1b):
         assert d.text not in index2.combined_text
@@ -60,3 +60,53 @@ def test_creates_index(monkeypatch):
         assert d.text in index2.combined_text
         assert d.title in index2.combined_titles
     assert section2.title == index2.root_title
+
+
+def schema(table):
+    """Names of the constraints and indexes on a table"""
+    with connection.cursor() as cursor:
+        cursor.execute(rebuild_pgsql_index.CONSTRAINTS_SQL, [table])
+        constraints = {row[0] for row in cursor.fetchall()}
+        cursor.execute(
+            'SELECT indexname FROM pg_indexes WHERE tablename = %s', [table])
+        indexes = {row[0] for row in cursor.fetchall()}
+    return constraints, indexes
+
+
+@requires_pg
+@pytest.mark.django_db(transaction=True)
+def test_rebuild_swaps_tables():
+    """Rebuilding should replace stale entries, preserve the table's schema,
+    and leave the id sequence usable for subsequent rebuilds"""
+    root = doc_recipe.make(label_string='root')
+    section1 = doc_recipe.make(label_string='root-1', parent=root)
+    other = doc_recipe.make(label_string='other')
+    section2 = doc_recipe.make(label_string='other-2', parent=other)
+    DocumentIndex.objects.create(
+        document=section1, combined_text='stale', combined_titles='',
+        root_title='', doc_root='root')
+    before = schema(DocumentIndex._meta.db_table)
+
+    call_command('rebuild_pgsql_index', workers=2)
+    call_command('rebuild_pgsql_index', workers=2)
+
+    assert schema(DocumentIndex._meta.db_table) == before
+    indexes = DocumentIndex.objects.order_by('doc_root')
+    assert [(i.document_id, i.doc_root) for i in indexes] == [
+        (section2.pk, 'other'), (section1.pk, 'root')]
+    assert indexes[1].combined_text == section1.text
+    # still writable
+    DocumentIndex.objects.create(
+        document=section1, combined_text='', combined_titles='',
+        root_title='', doc_root='root')
+
+
+@requires_pg
+@pytest.mark.django_db(transaction=True)
+def test_rebuild_drains_queue():
+    """Queued writes made before the rebuild are covered by it"""
+    PendingIndex.objects.create(doc_type='cfr', label_string='root')
+
+    call_command('rebuild_pgsql_index')
+
+    assert not PendingIndex.objects.exists()
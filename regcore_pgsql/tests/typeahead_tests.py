@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+
+import pytest
+
+pytest.importorskip('django', minversion='1.10')    # noqa
+from regcore.db.django_models import DMDocuments, DMLayers
+from regcore_pgsql import views
+from regcore_pgsql.models import TypeaheadEntry, rebuild_typeahead
+from regcore_pgsql.tests.utils import requires_pg
+
+
+def write_regulation(version):
+    section = {'text': '', 'label': ['1005', '2'], 'children': [],
+               'title': '§ 1005.2 Definitions', 'node_type': 'regtext'}
+    root = {'text': '', 'label': ['1005'], 'children': [section],
+            'title': 'Electronic Fund Transfers', 'node_type': 'regtext'}
+    section['parent'] = root
+    DMDocuments().bulk_insert([root, section], 'cfr', version)
+
+
+@pytest.mark.django_db
+def test_entries_follow_writes():
+    """Entries should be replaced as documents and layers are written"""
+    write_regulation('v1')
+    assert set(TypeaheadEntry.objects.values_list('phrase', flat=True)) == {
+        'definitions', 'electronic fund transfers'}
+
+    DMLayers().bulk_insert([{
+        'doc_id': 'v1/1005', '1005-2-a': [{'key_term': 'Accepted card'}],
+    }], 'keyterms', 'cfr')
+    assert TypeaheadEntry.objects.get(kind='keyterm').label_string == \
+        '1005-2-a'
+    # other layers provide no entries; titles are left alone
+    DMLayers().bulk_insert([{'doc_id': 'v1/1005', '1005-2': []}], 'toc',
+                           'cfr')
+    assert TypeaheadEntry.objects.count() == 3
+
+    DMDocuments().bulk_delete('cfr', '1005', 'v1')
+    assert list(TypeaheadEntry.objects.values_list('kind', flat=True)) == [
+        'keyterm']
+
+    TypeaheadEntry.objects.all().delete()
+    write_regulation('v2')
+    TypeaheadEntry.objects.all().delete()
+    rebuild_typeahead()
+    assert TypeaheadEntry.objects.count() == 2
+
+
+@requires_pg
+@pytest.mark.django_db
+def test_typeahead(rf):
+    write_regulation('v1')
+    write_regulation('v2')
+
+    response = views.typeahead(rf.get('?q=DEF'), doc_type='cfr')
+    assert json.loads(response.content.decode('utf-8')) == {'results': [{
+        'text': '§ 1005.2 Definitions', 'type': 'title',
+        'regulation': '1005', 'label': '1005-2', 'versions': ['v1', 'v2']}]}
+
+    response = views.typeahead(rf.get('?q=e&version=v2&limit=1'),
+                               doc_type='cfr')
+    results = json.loads(response.content.decode('utf-8'))['results']
+    assert [r['versions'] for r in results] == [['v2']]
+
+    response = views.typeahead(rf.get('?q=def'), doc_type='preamble')
+    assert json.loads(response.content.decode('utf-8')) == {'results': []}
@@ -0,0 +1,105 @@
+import pytest
+from django.core.management import call_command
+from mock import Mock
+
+pytest.importorskip('django', minversion='1.10')    # noqa
+from regcore import search_cache
+from regcore.db.django_models import DMDocuments
+from regcore.tests.recipes import doc_recipe
+from regcore_pgsql.models import DocumentIndex, PendingIndex
+
+
+def make_tree():
+    root = doc_recipe.make(label_string='root', version='vvv', doc_type='cfr')
+    section1 = doc_recipe.make(label_string='root-1', parent=root,
+                               version='vvv', doc_type='cfr')
+    p1a = doc_recipe.make(label_string='root-1-a', parent=section1,
+                          version='vvv', doc_type='cfr')
+    section2 = doc_recipe.make(label_string='root-2', parent=root,
+                               version='vvv', doc_type='cfr')
+    return root, section1, p1a, section2
+
+
+@pytest.mark.django_db
+def test_affected_sections():
+    """Changes to a root affect all of its sections; changes to a section or
+    paragraph affect only the containing section"""
+    root, section1, p1a, section2 = make_tree()
+
+    def affected(label):
+        pending = PendingIndex(doc_type='cfr', version='vvv',
+                               label_string=label)
+        return {d.label_string for d in pending.affected_sections()}
+
+    assert affected('root') == {'root-1', 'root-2'}
+    assert affected('root-1') == {'root-1'}
+    assert affected('root-1-a') == {'root-1'}
+    assert affected('other') == set()
+
+
+@pytest.mark.django_db
+def test_affected_sections_subpart():
+    """Changes to a subpart affect the sections within it, though their
+    labels don't share its prefix"""
+    root = doc_recipe.make(label_string='root', version='vvv', doc_type='cfr')
+    subpart_a = doc_recipe.make(label_string='root-Subpart-A', parent=root,
+                                version='vvv', doc_type='cfr')
+    section1 = doc_recipe.make(label_string='root-1', parent=subpart_a,
+                               version='vvv', doc_type='cfr')
+    doc_recipe.make(label_string='root-1-a', parent=section1, version='vvv',
+                    doc_type='cfr')
+    subpart_b = doc_recipe.make(label_string='root-Subpart-B', parent=root,
+                                version='vvv', doc_type='cfr')
+    doc_recipe.make(label_string='root-2', parent=subpart_b, version='vvv',
+                    doc_type='cfr')
+
+    def affected(label):
+        pending = PendingIndex(doc_type='cfr', version='vvv',
+                               label_string=label)
+        return {d.label_string for d in pending.affected_sections()}
+
+    assert affected('root-Subpart-A') == {'root-1'}
+    assert affected('root-Subpart-B') == {'root-2'}
+    assert affected('root-1-a') == {'root-1'}
+    assert affected('root-1-b') == {'root-1'}     # deleted paragraph
+
+
+@pytest.mark.django_db
+def test_writes_enqueue():
+    """Inserting or deleting documents should queue up a re-index"""
+    DMDocuments().bulk_insert([{
+        'text': 'some text', 'label': ['root'], 'node_type': 'regtext',
+        'children': []}], 'cfr', 'vvv')
+    DMDocuments().bulk_delete('cfr', 'root', 'vvv')
+
+    assert list(PendingIndex.objects.values_list(
+        'doc_type', 'version', 'label_string')) == [
+            ('cfr', 'vvv', 'root'), ('cfr', 'vvv', 'root')]
+
+
+@pytest.mark.django_db
+def test_update_pgsql_index(monkeypatch):
+    """Only the affected sections should be re-indexed, and the queue should
+    be drained. Cached searches are invalidated once the index is updated"""
+    monkeypatch.setattr(DocumentIndex, 'rebuild_search_vectors', Mock())
+    monkeypatch.setattr(search_cache, 'invalidate_tree', Mock())
+    root, section1, p1a, section2 = make_tree()
+    stale = DocumentIndex.objects.create(
+        document=section2, combined_text='stale', combined_titles='',
+        root_title='', doc_root='root')
+    PendingIndex.objects.create(doc_type='cfr', version='vvv',
+                                label_string='root-1-a')
+    PendingIndex.objects.create(doc_type='cfr', version='vvv',
+                                label_string='root-1')
+
+    call_command('update_pgsql_index', batch_size=1)
+
+    assert not PendingIndex.objects.exists()
+    assert DocumentIndex.rebuild_search_vectors.call_count == 2
+    assert DocumentIndex.objects.count() == 2
+    assert DocumentIndex.objects.get(pk=stale.pk).combined_text == 'stale'
+    index = DocumentIndex.objects.get(document=section1)
+    assert p1a.text in index.combined_text
+    assert section1.text in index.combined_text
+    assert [c[0] for c in search_cache.invalidate_tree.call_args_list] == [
+        ('cfr', 'root-1-a', 'vvv'), ('cfr', 'root-1', 'vvv')]
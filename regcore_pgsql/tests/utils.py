@@ -0,0 +1,6 @@
+import pytest
+from django.db import connection
+
+requires_pg = pytest.mark.skipif(
+    connection.vendor != 'postgresql',
+    reason='Requires a Postgres database')
@@ -1,17 +1,22 @@
+import json
+from importlib import import_module
+
 import pytest
-from django.db.models import Q
+from django.db import connection, transaction
 from mock import call, Mock
 
 pytest.importorskip('django', minversion='1.10')    # noqa
 from regcore.tests.recipes import doc_recipe
 from regcore_pgsql import views
-from regcore_read.views.search_utils import SearchArgs
+from regcore_pgsql.models import DocumentIndex
+from regcore_pgsql.tests.utils import requires_pg
+from regcore_read.views.search_utils import SearchArgs, SearchTimeout
 
 
 def make_queryset_mock():
     """Mocked queryset which returns itself for most manipulations."""
     queryset_mock = Mock()
-    for transform in ('annotate', 'filter', 'order_by'):
+    for transform in ('annotate', 'filter', 'order_by', 'none'):
         getattr(queryset_mock, transform).return_value = queryset_mock
     return queryset_mock
 
@@ -24,7 +29,8 @@ def test_matching_sections(monkeypatch, settings):
 
     result = views.matching_sections(SearchArgs(
         q='some terms', version='vvv', regulation='rrr',
-        is_root=None, is_subpart=None, page=0, page_size=10))
+        is_root=None, is_subpart=None, page=0, page_size=10, collapse=False,
+        count='exact', cursor=None, facets=[], snippet=False))
     assert result == queryset_mock
     # no point in repeating the exact calls here; test the general flow
     assert 'some terms' in str(queryset_mock.annotate.call_args)
@@ -32,24 +38,78 @@ def test_matching_sections(monkeypatch, settings):
     filters = queryset_mock.filter.call_args_list
     assert call(rank__gt=0.1234) in filters
     assert call(version='vvv') in filters
-    assert call(documentindex__doc_root='rrr') in filters
+    assert 'search_vector' in str(filters[0])
+    assert "documentindex__doc_root='rrr'" in str(filters[0])
+    assert not queryset_mock.none.called
+
+
+def test_matching_sections_root_subpart(monkeypatch):
+    """is_root should filter on the indexed root column; no sections are
+    subparts"""
+    queryset_mock = make_queryset_mock()
+    monkeypatch.setattr(views.Document, 'objects', queryset_mock)
+
+    views.matching_sections(SearchArgs(
+        q='some terms', version=None, regulation=None, is_root=False,
+        is_subpart=False, page=0, page_size=10, collapse=False,
+        count='exact', cursor=None, facets=[], snippet=False))
+    assert call(root=False) in queryset_mock.filter.call_args_list
+    assert not queryset_mock.none.called
 
+    views.matching_sections(SearchArgs(
+        q='some terms', version=None, regulation=None, is_root=None,
+        is_subpart=True, page=0, page_size=10, collapse=False,
+        count='exact', cursor=None, facets=[], snippet=False))
+    assert queryset_mock.none.called
 
+
+def explain(queryset):
+    """Fetch the query plan for a queryset as a single string"""
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN ' + sql, params)
+        return '\n'.join(row[0] for row in cursor.fetchall())
+
+
+@requires_pg
 @pytest.mark.django_db
-def test_transform_results(monkeypatch):
+def test_matching_sections_uses_gin_index():
+    """The match should be resolved through the GIN index rather than by
+    ranking every row. Our test tables are tiny, so we discourage sequential
+    scans to see which plans are possible"""
+    root = doc_recipe.make(label_string='root')
+    for idx in range(3):
+        section = doc_recipe.make(label_string='root-{0}'.format(idx),
+                                  parent=root)
+        DocumentIndex.from_document(section).save()
+    DocumentIndex.rebuild_search_vectors()
+    gin_index = import_module('regcore_pgsql.migrations.'
+                              '0004_documentindex_search_vector_gin').GIN_INDEX
+
+    with connection.cursor() as cursor:
+        cursor.execute('SET LOCAL enable_seqscan = off')
+    plan = explain(views.matching_sections(SearchArgs(
+        q='some terms', version=None, regulation=None, is_root=None,
+        is_subpart=None, page=0, page_size=10, collapse=False,
+        count='exact', cursor=None, facets=[], snippet=False)))
+    assert 'Bitmap Index Scan on {0}'.format(gin_index) in plan
+
+
+@requires_pg
+@pytest.mark.django_db
+def test_transform_results():
     """If there's a text match inside a section, we should convert it to a
     dictionary."""
-    monkeypatch.setattr(    # __search isn't supported by sqlite
-        views, 'Q', Mock(return_value=Q(text__contains='matching')))
     sect = doc_recipe.make(label_string='root-11', title='Sect 111',
                            version='vvv')
     par_a = doc_recipe.make(label_string='root-11-a', parent=sect)
     doc_recipe.make(text='matching text', label_string='root-11-a-3',
                     parent=par_a, title="Match's title")
 
-    results = views.transform_results([sect], 'this is a query')
+    results = views.transform_results([sect], 'matching')
     assert results == [{
         'text': 'matching text',
+        'snippet': '<b>matching</b> text',
         'label': ['root', '11', 'a', '3'],
         'version': 'vvv',
         'regulation': 'root',
@@ -61,12 +121,11 @@ def test_transform_results(monkeypatch):
     }]
 
 
+@requires_pg
 @pytest.mark.django_db
-def test_transform_title_match(monkeypatch):
+def test_transform_title_match():
     """If there's a title match with no text, we should conver to the correct
     dictionary."""
-    monkeypatch.setattr(    # __search isn't supported by sqlite
-        views, 'Q', Mock(return_value=Q(title__contains='matching')))
     sect = doc_recipe.make(label_string='root-11', title='Sect 111',
                            version='vvv')
     par_a = doc_recipe.make(label_string='root-11-a', parent=sect, text='',
@@ -74,9 +133,10 @@ def test_transform_title_match(monkeypatch):
     doc_recipe.make(label_string='root-11-a-3', parent=par_a,
                     text='inner text', title='inner title')
 
-    results = views.transform_results([sect], 'this is a query')
+    results = views.transform_results([sect], 'matching')
     assert results == [{
         'text': 'inner text',
+        'snippet': 'inner text',
         'label': ['root', '11', 'a'],
         'version': 'vvv',
         'regulation': 'root',
@@ -88,21 +148,21 @@ def test_transform_title_match(monkeypatch):
     }]
 
 
+@requires_pg
 @pytest.mark.django_db
-def test_transform_no_exact_match(monkeypatch):
+def test_transform_no_exact_match():
     """If text is searched text is broken across multiple paragraphs, we
     should just graph the first text node we can find."""
-    monkeypatch.setattr(    # __search isn't supported by sqlite
-        views, 'Q', Mock(return_value=Q(text=None)))    # will have no results
     sect = doc_recipe.make(label_string='root-11', text='', title='Sect 111',
                            version='vvv')
     par_a = doc_recipe.make(label_string='root-11-a', parent=sect,
                             text='has some text', title='nonmatching title')
     doc_recipe.make(label_string='root-11-a-3', parent=par_a)
 
-    results = views.transform_results([sect], 'this is a query')
+    results = views.transform_results([sect], 'absent')
     assert results == [{
         'text': 'has some text',
+        'snippet': 'has some text',
         'label': ['root', '11'],
         'version': 'vvv',
         'regulation': 'root',
@@ -112,3 +172,152 @@ def test_transform_no_exact_match(monkeypatch):
         'section_title': 'Sect 111',
         'title': 'Sect 111',
     }]
+
+
+@requires_pg
+@pytest.mark.django_db
+def test_transform_single_query(django_assert_num_queries):
+    """All sections in the page should be resolved with one query, and the
+    page's ordering should be preserved."""
+    sections = []
+    for idx in range(5):
+        sect = doc_recipe.make(label_string='root-{0}'.format(idx),
+                               text='matching {0}'.format(idx))
+        sections.append(sect)
+    sections.reverse()
+
+    with django_assert_num_queries(1):
+        results = views.transform_results(sections, 'matching')
+    assert [r['label_string'] for r in results] == [
+        'root-4', 'root-3', 'root-2', 'root-1', 'root-0']
+
+
+def test_transform_empty():
+    """An empty page shouldn't hit the database."""
+    assert views.transform_results([], 'matching') == []
+
+
+@requires_pg
+@pytest.mark.django_db
+def test_search_estimate(rf, settings):
+    """Estimated counts should stop at the cap, without limiting the page"""
+    settings.PG_SEARCH_RANK_CUTOFF = 0
+    settings.SEARCH_COUNT_CAP = 2
+    root = doc_recipe.make(label_string='root')
+    for idx in range(4):
+        section = doc_recipe.make(label_string='root-{0}'.format(idx),
+                                  text='matching {0}'.format(idx),
+                                  parent=root)
+        DocumentIndex.from_document(section).save()
+    DocumentIndex.rebuild_search_vectors()
+
+    response = views.search(rf.get('?q=matching'), doc_type='cfr')
+    assert json.loads(response.content.decode('utf-8'))['total_hits'] == 4
+
+    response = views.search(rf.get('?q=matching&count=estimate&page_size=3'),
+                            doc_type='cfr')
+    results = json.loads(response.content.decode('utf-8'))
+    assert results['total_hits'] == 2
+    assert results['total_hits_relation'] == 'gte'
+    assert len(results['results']) == 3
+
+
+@requires_pg
+@pytest.mark.django_db
+def test_search_cursor(rf, settings):
+    """Following cursors should walk through every section once, in rank
+    order, including sections which share a rank"""
+    settings.PG_SEARCH_RANK_CUTOFF = 0
+    root = doc_recipe.make(label_string='root')
+    for idx in range(5):
+        section = doc_recipe.make(
+            label_string='root-{0}'.format(idx), parent=root,
+            text='matching text' if idx % 2 else 'matching matching text')
+        DocumentIndex.from_document(section).save()
+    DocumentIndex.rebuild_search_vectors()
+
+    def search(**params):
+        response = views.search(rf.get('', dict(q='matching', **params)),
+                                doc_type='cfr')
+        return json.loads(response.content.decode('utf-8'))
+
+    results = search(page_size=2)
+    labels = [r['label_string'] for r in results['results']]
+    while 'next_cursor' in results:
+        assert len(labels) < 5
+        results = search(page_size=2, cursor=results['next_cursor'])
+        labels.extend(r['label_string'] for r in results['results'])
+    assert labels == [r['label_string']
+                      for r in search(page_size=5)['results']]
+    assert sorted(labels) == ['root-{0}'.format(idx) for idx in range(5)]
+
+
+@requires_pg
+@pytest.mark.django_db
+def test_facet_counts(settings, django_assert_num_queries):
+    """Sections should be counted by each facet in a single query"""
+    settings.PG_SEARCH_RANK_CUTOFF = 0
+    for label, version in (('root', 'v1'), ('root', 'v2'), ('other', 'v1')):
+        root = doc_recipe.make(label_string=label, version=version)
+        section = doc_recipe.make(
+            label_string=label + '-1', parent=root, version=version,
+            node_type='regtext', text='matching text')
+        DocumentIndex.from_document(section).save()
+    DocumentIndex.rebuild_search_vectors()
+
+    search_args = SearchArgs(
+        q='matching', version=None, regulation=None, is_root=None,
+        is_subpart=None, page=0, page_size=10, collapse=False, count='exact',
+        cursor=None, facets=['node_type', 'regulation', 'version'],
+        snippet=False)
+    sections = views.matching_sections(search_args)
+    with django_assert_num_queries(1):
+        counts = views.facet_counts(sections, search_args.facets)
+    assert counts == {'node_type': {'regtext': 3},
+                      'regulation': {'root': 2, 'other': 1},
+                      'version': {'v1': 2, 'v2': 1}}
+    assert views.facet_counts(sections.none(), ['version']) == {
+        'version': {}}
+
+
+@requires_pg
+@pytest.mark.django_db
+def test_statement_timeout(settings):
+    """Statements running past the timeout should be cancelled"""
+    @views.statement_timeout
+    def sleep(seconds):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_sleep(%s)', [seconds])
+        return seconds
+
+    settings.SEARCH_TIMEOUT = 0.05
+    assert sleep(0) == 0
+    with pytest.raises(SearchTimeout):
+        sleep(1)
+
+
+@requires_pg
+@pytest.mark.django_db
+def test_statement_timeout_nested(settings):
+    """Within an outer transaction, later statements shouldn't inherit the
+    timeout"""
+    def current_timeout():
+        with connection.cursor() as cursor:
+            cursor.execute('SHOW statement_timeout')
+            return cursor.fetchone()[0]
+
+    @views.statement_timeout
+    def view(seconds):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_sleep(%s)', [seconds])
+        return current_timeout()
+
+    settings.SEARCH_TIMEOUT = 0.05
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute("SET LOCAL statement_timeout = '5s'")
+        assert view(0) == '50ms'
+        assert current_timeout() == '5s'
+        with pytest.raises(SearchTimeout):
+            view(1)
+        assert current_timeout() == '5s'
@@ -1,65 +1,261 @@
+from functools import wraps
+
 from django.conf import settings
+from django.contrib.postgres.aggregates import ArrayAgg
 from django.contrib.postgres.search import SearchRank, SearchQuery
-from django.db.models import F, Q
+from django.db import OperationalError, connection, transaction
+from django.db.models import F, FloatField, Q
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Cast
 
+from regcore import typeahead as typeahead_index
 from regcore.models import Document
 from regcore.responses import success
-from regcore_read.views.search_utils import requires_search_args
+from regcore_pgsql.models import TypeaheadEntry
+from regcore_read.views.search_utils import (
+    SearchTimeout, cached_search, count_limit, encode_cursor, format_facets,
+    hit_count, limited_search, requires_search_args, snippet_results,
+    unpack_cursor)
+from regcore_read.views.typeahead import requires_typeahead_args
+
+# SQLSTATE of statements cancelled by statement_timeout
+QUERY_CANCELED = '57014'
+
+# For each section in the page, find the first node (in tree order) whose
+# text or title matches the query and the first text-bearing node beneath
+# that match. MPTT's (tree_id, lft, rght) columns let us express "descendants
+# of" as a range, so both lookups become lateral joins in a single statement
+# rather than two queries per section.
+TRANSFORM_SQL = """
+SELECT section.id,
+       COALESCE(match_node.label_string, section.label_string),
+       COALESCE(match_node.title, section.title),
+       text_node.text,
+       text_node.title,
+       ts_headline(text_node.text, plainto_tsquery(%(q)s))
+FROM {table} AS section
+LEFT JOIN LATERAL (
+    SELECT node.lft, node.rght, node.label_string, node.title
+    FROM {table} AS node
+    WHERE node.tree_id = section.tree_id
+      AND node.lft BETWEEN section.lft AND section.rght
+      AND (to_tsvector(COALESCE(node.text, '')) @@ plainto_tsquery(%(q)s)
+           OR to_tsvector(COALESCE(node.title, '')) @@ plainto_tsquery(%(q)s))
+    ORDER BY node.lft
+    LIMIT 1
+) AS match_node ON TRUE
+LEFT JOIN LATERAL (
+    SELECT node.text, node.title
+    FROM {table} AS node
+    WHERE node.tree_id = section.tree_id
+      AND node.lft BETWEEN COALESCE(match_node.lft, section.lft)
+                       AND COALESCE(match_node.rght, section.rght)
+      AND node.text <> ''
+    ORDER BY node.lft
+    LIMIT 1
+) AS text_node ON TRUE
+WHERE section.id = ANY(%(ids)s)
+""".format(table=Document._meta.db_table)
 
 
 def matching_sections(search_args):
-    """Retrieve all Document sections that match the parsed search args."""
+    """Retrieve all Document sections that match the parsed search args.
+    Matches are found via the (GIN-indexed) search vector before any ranking
+    takes place, so only matching sections are ranked."""
+    query = SearchQuery(search_args.q)
+    # Conditions on the index must share a single filter() call, lest each
+    # add its own join
+    index_filters = {'documentindex__search_vector': query}
+    if search_args.regulation:
+        index_filters['documentindex__doc_root'] = search_args.regulation
     sections_query = Document.objects\
-        .annotate(rank=SearchRank(
-            F('documentindex__search_vector'), SearchQuery(search_args.q)))\
+        .filter(**index_filters)\
+        .annotate(rank=Cast(SearchRank(F('documentindex__search_vector'),
+                                       query), FloatField()))\
         .filter(rank__gt=settings.PG_SEARCH_RANK_CUTOFF)\
-        .order_by('-rank')
+        .order_by('-rank', 'pk')
 
     if search_args.version:
         sections_query = sections_query.filter(version=search_args.version)
-    if search_args.regulation:
-        sections_query = sections_query.filter(
-            documentindex__doc_root=search_args.regulation)
-    # can't filter regulation yet
+    if search_args.is_root is not None:
+        sections_query = sections_query.filter(root=search_args.is_root)
+    # Only sections are indexed, and sections are never subparts
+    if search_args.is_subpart:
+        sections_query = sections_query.none()
     return sections_query
 
 
+def after_cursor(sections, search_args):
+    """Seek past the (rank, pk) of the previous page's last section, rather
+    than counting through an offset. Ranks are single-precision, but are
+    read as doubles (so they aren't rounded for output) and compared to the
+    cursor's rank as single-precision"""
+    rank, pk = unpack_cursor(search_args, 2)
+    rank = RawSQL('%s::real', [rank])
+    return sections.filter(Q(rank__lt=rank) | Q(rank=rank, pk__gt=pk))
+
+
+# Columns holding each facet's values
+FACET_FIELDS = {
+    'node_type': 'node_type',
+    'regulation': 'documentindex__doc_root',
+    'version': 'version',
+}
+
+
+# Counts matches by each facet in a single pass. GROUPING(column) is 0 in
+# the rows grouped by that column
+FACET_SQL = """
+SELECT {groupings}, {columns}, COUNT(*)
+FROM ({matches}) AS matches ({columns})
+GROUP BY GROUPING SETS ({columns})
+"""
+
+
+def facet_counts(sections, facets):
+    """Count the matching sections by each facet's values, with a single
+    query (rather than repeating the match for each facet).
+    :return: dict of facet -> {value: count}"""
+    counts = {facet: {} for facet in facets}
+    if sections.query.is_empty():
+        return counts
+    matches, params = sections.order_by()\
+        .values_list(*[FACET_FIELDS[facet] for facet in facets])\
+        .query.sql_with_params()
+    columns = ['facet{0}'.format(idx) for idx in range(len(facets))]
+    sql = FACET_SQL.format(
+        groupings=', '.join('GROUPING({0})'.format(c) for c in columns),
+        columns=', '.join(columns), matches=matches)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        for row in cursor.fetchall():
+            groupings, values = row[:len(facets)], row[len(facets):-1]
+            idx = groupings.index(0)
+            counts[facets[idx]][values[idx]] = row[-1]
+    return counts
+
+
+def statement_timeout(view):
+    """Run the view in a transaction whose statements are cancelled after
+    SEARCH_TIMEOUT seconds. Within an existing transaction (e.g. with
+    ATOMIC_REQUESTS), the view runs in a savepoint instead, and the previous
+    timeout is restored once it returns"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not settings.SEARCH_TIMEOUT or connection.vendor != 'postgresql':
+            return view(*args, **kwargs)
+        nested = connection.in_atomic_block
+        try:
+            with transaction.atomic():
+                with connection.cursor() as cursor:
+                    if nested:
+                        cursor.execute('SHOW statement_timeout')
+                        previous = cursor.fetchone()[0]
+                    # SET LOCAL lasts only until the transaction ends
+                    cursor.execute('SET LOCAL statement_timeout = %s',
+                                   [int(settings.SEARCH_TIMEOUT * 1000)])
+                response = view(*args, **kwargs)
+                # ...which, for a savepoint, is the outer transaction. (Errors
+                # roll back the savepoint, and with it the setting)
+                if nested:
+                    with connection.cursor() as cursor:
+                        cursor.execute(
+                            "SELECT set_config('statement_timeout', %s, true)",
+                            [previous])
+                return response
+        except OperationalError as err:
+            if getattr(err.__cause__, 'pgcode', None) == QUERY_CANCELED:
+                raise SearchTimeout()
+            raise
+    return wrapper
+
+
 @requires_search_args
+@cached_search
+@limited_search
+@statement_timeout
 def search(request, doc_type, search_args):
     sections = matching_sections(search_args)
-    start = search_args.page * search_args.page_size
-    end = start + search_args.page_size
 
-    return success({
-        'total_hits': sections.count(),
-        'results': transform_results(sections[start:end], search_args.q),
-    })
+    limit = count_limit(search_args)
+    if limit is None:
+        count = sections.count()
+    else:
+        # Without an ordering, matches needn't all be ranked to be counted
+        count = sections.order_by()[:limit].count()
+
+    if search_args.cursor is None:
+        start = search_args.page * search_args.page_size
+        page = sections[start:start + search_args.page_size]
+    else:
+        page = after_cursor(sections, search_args)[:search_args.page_size]
+    page = list(page)
+
+    response = hit_count(search_args, count)
+    response['results'] = snippet_results(
+        transform_results(page, search_args.q), search_args)
+    if search_args.facets:
+        response['facets'] = format_facets(
+            facet_counts(sections, search_args.facets))
+    if len(page) == search_args.page_size:
+        response['next_cursor'] = encode_cursor(page[-1].rank, page[-1].pk)
+    return success(response)
+
+
+def fetch_matches(sections, search_terms):
+    """Find the matching and text-bearing nodes for every section at once.
+    :return: dict mapping section id to a tuple of (match label_string,
+    match title, text, text title, highlighted snippet)"""
+    ids = [section.id for section in sections]
+    if not ids:
+        return {}
+    with connection.cursor() as cursor:
+        cursor.execute(TRANSFORM_SQL, {'q': search_terms, 'ids': ids})
+        return {row[0]: row[1:] for row in cursor.fetchall()}
 
 
 def transform_results(sections, search_terms):
     """Convert matching Section objects into the corresponding dict for
     serialization."""
+    sections = list(sections)
+    matches = fetch_matches(sections, search_terms)
     final_results = []
     for section in sections:
-        # TODO: n+1 problem; hypothetically these could all be performed via
-        # subqueries and annotated on the sections queryset
-        match_node = section.get_descendants(include_self=True)\
-            .filter(Q(text__search=search_terms) |
-                    Q(title__search=search_terms))\
-            .first() or section
-        text_node = match_node.get_descendants(include_self=True)\
-            .exclude(text='')\
-            .first()
-
+        label_string, match_title, text, text_title, snippet = \
+            matches[section.id]
         final_results.append({
-            'text': text_node.text if text_node else '',
-            'label': match_node.label_string.split('-'),
+            'text': text or '',
+            'snippet': snippet or '',
+            'label': label_string.split('-'),
             'version': section.version,
             'regulation': section.label_string.split('-')[0],
-            'label_string': match_node.label_string,
-            'match_title': match_node.title,
-            'paragraph_title': text_node.title if text_node else '',
+            'label_string': label_string,
+            'match_title': match_title,
+            'paragraph_title': text_title or '',
             'section_title': section.title,
             'title': section.title,
         })
     return final_results
+
+
+@requires_typeahead_args
+def typeahead(request, doc_type, typeahead_args):
+    """Titles and terms starting with the query, found via the phrase index.
+    Entries differing only in their version are combined, as in
+    regcore.typeahead"""
+    entries = TypeaheadEntry.objects.filter(
+        doc_type=doc_type,
+        phrase__startswith=typeahead_index.phrase(typeahead_args.q))
+    if typeahead_args.regulation:
+        entries = entries.filter(regulation=typeahead_args.regulation)
+    if typeahead_args.version:
+        entries = entries.filter(version=typeahead_args.version)
+    grouping = ('phrase', 'text', 'kind', 'regulation', 'label_string')
+    rows = entries.values(*grouping)\
+        .annotate(versions=ArrayAgg('version'))\
+        .order_by(*grouping)[:typeahead_args.limit]
+    return success({'results': [{
+        'text': row['text'], 'type': row['kind'],
+        'regulation': row['regulation'], 'label': row['label_string'],
+        'versions': sorted(v for v in row['versions'] if v),
+    } for row in rows]})
@@ -1,6 +1,6 @@
 from django.conf.urls import url
 
-from regcore_read.views import es_search, haystack_search
+from regcore_read.views import es_search, haystack_search, memory_search
 
 urlpatterns = [
     url(r'^es_search$', es_search.search, kwargs={'doc_type': 'cfr'}),
@@ -9,4 +9,6 @@ urlpatterns = [
         haystack_search.search,
         kwargs={'doc_type': 'cfr'},
     ),
+    url(r'^memory_search$', memory_search.search,
+        kwargs={'doc_type': 'cfr'}),
 ]
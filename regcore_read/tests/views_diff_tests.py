@@ -1,14 +1,19 @@
 import json
 from unittest import TestCase
 
+import pytest
+from django.db import DatabaseError
 from django.test.client import Client
 from mock import patch
 
+from regcore.diff import invalidate_summaries
+
 
 class ViewsDiffTest(TestCase):
     @patch('regcore_read.views.diff.storage')
     def test_get_none(self, storage):
         storage.for_diffs.get.return_value = None
+        storage.for_documents.get.return_value = None
         response = Client().get('/diff/lablab/oldold/newnew')
         self.assertEqual(404, response.status_code)
 
@@ -26,3 +31,85 @@ class ViewsDiffTest(TestCase):
         self.assertEqual(200, response.status_code)
         self.assertEqual({'example': 'response'},
                          json.loads(response.content.decode('utf-8')))
+
+
+@pytest.mark.django_db
+@patch('regcore_read.views.diff.storage')
+def test_get_computed(storage):
+    """Diffs which weren't uploaded should be computed and stored"""
+    def tree(version):
+        return {'label': ['1005'], 'text': version, 'node_type': 'regtext',
+                'children': []}
+    storage.for_diffs.get.return_value = None
+    storage.for_documents.get.side_effect = \
+        lambda doc_type, label, version: tree(version)
+
+    response = Client().get('/diff/1005/old/new')
+    assert response.status_code == 200
+    diff = json.loads(response.content.decode('utf-8'))
+    assert diff['1005']['op'] == 'modified'
+    storage.for_diffs.insert.assert_called_once_with(
+        '1005', 'old', 'new', {'1005': {'op': 'modified', 'text': [
+            ('delete', 0, 3), ('insert', 0, 'new')]}},
+        {'added': 0, 'modified': 1, 'deleted': 0,
+         'sections': {'1005': {'added': 0, 'modified': 1, 'deleted': 0}}})
+
+    storage.for_documents.get.side_effect = \
+        lambda doc_type, label, version: None
+    assert Client().get('/diff/1005/old/missing').status_code == 404
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('error', [DatabaseError('read-only'),
+                                   IOError('index unavailable')])
+@patch('regcore_read.views.diff.storage')
+def test_get_computed_read_only(storage, error):
+    """Computed diffs should be served even if they can't be stored, by any
+    backend"""
+    storage.for_diffs.get.return_value = None
+    storage.for_documents.get.side_effect = lambda doc_type, label, version: {
+        'label': ['1005'], 'text': version, 'children': []}
+    storage.for_diffs.insert.side_effect = error
+
+    response = Client().get('/diff/1005/old/new')
+    assert response.status_code == 200
+    assert '1005' in json.loads(response.content.decode('utf-8'))
+
+
+@pytest.mark.django_db
+@patch('regcore_read.views.diff.storage')
+def test_summary(storage, settings):
+    """Summaries should be cached until a diff between the versions is
+    written"""
+    settings.CACHES = {'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'diff-summary-tests'}}
+    settings.DIFF_SUMMARY_CACHE_TTL = 60
+    storage.for_diffs.get_summary.return_value = {'added': 1}
+    response = Client().get('/diff/1005/old/new/summary')
+    assert json.loads(response.content.decode('utf-8')) == {'added': 1}
+
+    storage.for_diffs.get_summary.return_value = {'added': 2}
+    response = Client().get('/diff/1005/old/new/summary')
+    assert json.loads(response.content.decode('utf-8')) == {'added': 1}
+    assert storage.for_diffs.get_summary.call_count == 1
+
+    invalidate_summaries('old', 'new')
+    response = Client().get('/diff/1005/old/new/summary')
+    assert json.loads(response.content.decode('utf-8')) == {'added': 2}
+
+    storage.for_diffs.get_summary.return_value = None
+    storage.for_documents.get.return_value = None
+    response = Client().get('/diff/1005/old/missing/summary')
+    assert response.status_code == 404
+
+
+@patch('regcore_read.views.diff.storage')
+def test_summary_uncached(storage, settings):
+    """With no TTL, summaries should be read from storage every time"""
+    settings.DIFF_SUMMARY_CACHE_TTL = 0
+    storage.for_diffs.get_summary.return_value = {'added': 1}
+    Client().get('/diff/1005/old/new/summary')
+    storage.for_diffs.get_summary.return_value = {'added': 2}
+    response = Client().get('/diff/1005/old/new/summary')
+    assert json.loads(response.content.decode('utf-8')) == {'added': 2}
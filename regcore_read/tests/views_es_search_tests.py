@@ -1,10 +1,14 @@
+import json
+
 import pytest
-from django.test import TestCase, override_settings
+from django.test import RequestFactory, TestCase, override_settings
 from django.test.client import Client
 from mock import patch
 
 pytest.importorskip('pyelasticsearch')  # noqa
-from regcore_read.views.es_search import transform_results
+from pyelasticsearch.exceptions import Timeout
+from regcore_read.views.es_search import search, transform_results
+from regcore_read.views.search_utils import encode_cursor
 
 
 @override_settings(SEARCH_HANDLER='regcore_read.views.es_search.search')
@@ -13,7 +17,7 @@ class ViewsESSearchTest(TestCase):
         response = Client().get('/search?non_q=test')
         self.assertEqual(400, response.status_code)
 
-    @patch('regcore_read.views.es_search.ElasticSearch')
+    @patch('regcore_read.views.es_search.get_client')
     def test_search_success(self, es):
         es.return_value.search.return_value = {'hits': {'hits': [],
                                                         'total': 0}}
@@ -22,7 +26,7 @@ class ViewsESSearchTest(TestCase):
         self.assertTrue(es.called)
         self.assertTrue(es.return_value.search.called)
 
-    @patch('regcore_read.views.es_search.ElasticSearch')
+    @patch('regcore_read.views.es_search.get_client')
     def test_search_version(self, es):
         es.return_value.search.return_value = {'hits': {'hits': [],
                                                         'total': 0}}
@@ -32,7 +36,7 @@ class ViewsESSearchTest(TestCase):
         self.assertTrue(es.return_value.search.called)
         self.assertIn('12345678', str(es.return_value.search.call_args))
 
-    @patch('regcore_read.views.es_search.ElasticSearch')
+    @patch('regcore_read.views.es_search.get_client')
     def test_search_version_regulation(self, es):
         es.return_value.search.return_value = {'hits': {'hits': [],
                                                         'total': 0}}
@@ -43,7 +47,7 @@ class ViewsESSearchTest(TestCase):
         self.assertIn('678', str(es.return_value.search.call_args))
         self.assertIn('123', str(es.return_value.search.call_args))
 
-    @patch('regcore_read.views.es_search.ElasticSearch')
+    @patch('regcore_read.views.es_search.get_client')
     def test_search_paging(self, es):
         es.return_value.search.return_value = {'hits': {'hits': [],
                                                         'total': 0}}
@@ -55,10 +59,134 @@ class ViewsESSearchTest(TestCase):
         self.assertEqual(50, query['size'])
         self.assertEqual(250, query['from'])
 
+    @patch('regcore_read.views.es_search.transform_results')
+    @patch('regcore_read.views.es_search.get_client')
+    def test_search_facets(self, es, transform_results):
+        """Facets should be counted by aggregations within the search"""
+        es.return_value.search.return_value = {
+            'hits': {'hits': [], 'total': 3},
+            'aggregations': {
+                'facet_version': {'buckets': [
+                    {'key': 'v1', 'doc_count': 2},
+                    {'key': 'v2', 'doc_count': 1}]}}}
+        transform_results.side_effect = lambda hits, doc_type: hits
+        response = Client().get('/search?q=test&facets=version')
+        query = es.return_value.search.call_args[0][0]
+        self.assertEqual(query['aggs'], {
+            'facet_version': {'terms': {'field': 'version', 'size': 0}}})
+        self.assertEqual(json.loads(response.content.decode('utf-8'))[
+            'facets'], {'version': [{'value': 'v1', 'count': 2},
+                                    {'value': 'v2', 'count': 1}]})
+
+    @patch('regcore_read.views.es_search.transform_results')
+    @patch('regcore_read.views.es_search.get_client')
+    def test_search_cursor(self, es, transform_results):
+        """Cursors hold the offset of the next page"""
+        es.return_value.search.return_value = {'hits': {
+            'hits': [{'fields': {}}] * 2, 'total': 10}}
+        transform_results.side_effect = lambda hits, doc_type: hits
+        response = Client().get('/search', {
+            'q': 'test', 'page_size': 2, 'cursor': encode_cursor(4)})
+        query = es.return_value.search.call_args[0][0]
+        self.assertEqual(4, query['from'])
+        self.assertEqual(encode_cursor(6), json.loads(
+            response.content.decode('utf-8'))['next_cursor'])
+
+        response = Client().get('/search', {
+            'q': 'test', 'cursor': encode_cursor(1.5, 2)})
+        self.assertEqual(400, response.status_code)
+
+    @patch('regcore_read.views.es_search.transform_results')
+    @patch('regcore_read.views.es_search.get_client')
+    def test_search_collapse(self, es, transform_results):
+        """Results should come from per-section buckets, skipping those on
+        earlier pages"""
+        es.return_value.search.return_value = {
+            'hits': {'hits': [], 'total': 7},
+            'aggregations': {
+                'section_count': {'value': 3},
+                'sections': {'buckets': [
+                    {'key': '1005-2', 'doc_count': 4, 'best': {'hits': {
+                        'hits': [{'_source': {'label_string': '1005-2-a'}}]
+                    }}},
+                    {'key': '1005-3', 'doc_count': 2, 'best': {'hits': {
+                        'hits': [{'_source': {'label_string': '1005-3'}}]
+                    }}},
+                ]},
+            },
+        }
+        transform_results.side_effect = lambda hits, doc_type: hits
+        response = Client().get(
+            '/search?q=test&collapse=true&page=1&page_size=1')
+        self.assertEqual(200, response.status_code)
+        query = es.return_value.search.call_args[0][0]
+        self.assertEqual(0, query['size'])
+        self.assertEqual(2, query['aggs']['sections']['terms']['size'])
+        # Sandboxed, so permitted without enabling dynamic scripting
+        self.assertEqual('expression', query['aggs']['sections']['aggs'][
+            'best_score']['max']['lang'])
+        self.assertEqual(json.loads(response.content.decode('utf-8')), {
+            'total_hits': 3,
+            'results': [{'label_string': '1005-3', 'section': '1005-3',
+                         'section_hits': 2}],
+            'next_cursor': encode_cursor(2)})
+
+    @patch('regcore_read.views.es_search.transform_results')
+    @patch('regcore_read.views.es_search.get_client')
+    def test_search_snippet(self, es, transform_results):
+        """Snippets come from Elastic Search's highlighter, in place of the
+        text"""
+        es.return_value.search.return_value = {'hits': {'total': 1, 'hits': [
+            {'fields': {'label_string': '1005-2'},
+             'highlight': {'text': ['An <b>overdraft</b>']}}]}}
+        transform_results.side_effect = lambda hits, doc_type: hits
+        response = search(RequestFactory().get('?q=overdraft&snippet=true'),
+                          doc_type='cfr')
+        query = es.return_value.search.call_args[0][0]
+        self.assertNotIn('text', query['fields'])
+        self.assertEqual(['<b>'], query['highlight']['pre_tags'])
+        self.assertIn('text', query['highlight']['fields'])
+        self.assertEqual(
+            json.loads(response.content.decode('utf-8'))['results'],
+            [{'label_string': '1005-2', 'snippet': 'An <b>overdraft</b>'}])
+
+        es.return_value.search.return_value = {
+            'hits': {'hits': [], 'total': 0},
+            'aggregations': {'section_count': {'value': 0},
+                             'sections': {'buckets': []}}}
+        search(RequestFactory().get('?q=overdraft&snippet=true&collapse=1'),
+               doc_type='cfr')
+        top_hits = es.return_value.search.call_args[0][0][
+            'aggs']['sections']['aggs']['best']['top_hits']
+        self.assertNotIn('text', top_hits['_source']['include'])
+        self.assertIn('highlight', top_hits)
+
+    @override_settings(SEARCH_TIMEOUT=2)
+    @patch('regcore_read.views.es_search.get_client')
+    def test_search_timeout(self, es):
+        """Searches are bounded on the server and client; either timing out
+        results in a 503"""
+        es.return_value.search.return_value = {
+            'hits': {'hits': [], 'total': 0}, 'timed_out': False}
+        request = RequestFactory().get('?q=test')
+        self.assertEqual(200, search(request, doc_type='cfr').status_code)
+        self.assertEqual('2000ms',
+                         es.return_value.search.call_args[0][0]['timeout'])
+        self.assertEqual(
+            3, es.return_value.search.call_args[1]['es_request_timeout'])
+
+        es.return_value.search.return_value['timed_out'] = True
+        request = RequestFactory().get('?q=other')
+        self.assertEqual(503, search(request, doc_type='cfr').status_code)
+
+        es.return_value.search.side_effect = Timeout()
+        request = RequestFactory().get('?q=another')
+        self.assertEqual(503, search(request, doc_type='cfr').status_code)
+
     @patch('regcore_read.views.es_search.ESLayers')
     def test_transform_results(self, eslayers):
         # combine keyterms and terms into a single layer
-        eslayers.return_value.get.return_value = {
+        layer = {
             '2': [{'key_term': 'k2'}], '3': [{'key_term': 'k3'}],
             '6': [{'key_term': 'k6'}], '7': [{'key_term': 'k7'}],
             'referenced': {
@@ -68,6 +196,8 @@ class ViewsESSearchTest(TestCase):
                 'lab4': {'reference': '7', 'term': 'd7'}
             }
         }
+        eslayers.return_value.get_many.side_effect = (
+            lambda name, doc_type, doc_ids: {d: layer for d in doc_ids})
         results = transform_results([
             {'regulation': 'r', 'version': 'v', 'label_string': '0'},
             {'regulation': 'rr', 'version': 'v', 'label_string': '1'},
@@ -90,3 +220,9 @@ class ViewsESSearchTest(TestCase):
         self.assertEqual('t5', results[5]['title'])
         self.assertEqual('t6', results[6]['title'])
         self.assertEqual('t7', results[7]['title'])
+
+        # a single lookup for each of the layers
+        self.assertEqual(2, eslayers.return_value.get_many.call_count)
+        self.assertEqual(
+            {'v/r', 'v/rr', 'vv/r', 'vv/rr'},
+            set(eslayers.return_value.get_many.call_args[0][2]))
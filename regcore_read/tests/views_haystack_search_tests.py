@@ -1,12 +1,14 @@
+import json
 from collections import namedtuple
 
 import pytest
-from django.test import TestCase, override_settings
+from django.test import RequestFactory, TestCase, override_settings
 from django.test.client import Client
 from mock import patch
 
 pytest.importorskip('haystack')  # noqa
-from regcore_read.views.haystack_search import transform_results
+from regcore_read.views.haystack_search import (
+    group_by_section, search, transform_results)
 
 
 @override_settings(SEARCH_HANDLER='regcore_read.views.haystack_search.search')
@@ -85,10 +87,107 @@ class ViewsHaystackSearchTest(TestCase):
         self.assertEqual(list(range(250, 300)),
                          transform_results.call_args[0][0])
 
+    @patch('regcore_read.views.haystack_search.SearchQuerySet')
+    @patch('regcore_read.views.haystack_search.transform_results')
+    def test_search_collapse(self, transform_results, sqs):
+        """Only the best match in each section should be transformed; the
+        total counts sections rather than matches"""
+        Result = namedtuple('Result', ('label_string',))
+        results = sqs.return_value.models.return_value.filter
+        results.return_value = [
+            Result('1005-2-a'), Result('1005-3'), Result('1005-2-b'),
+            Result('1005-4-a'), Result('1005-3-c')]
+        transform_results.side_effect = lambda hits, doc_type: [
+            {'label_string': h.label_string} for h in hits]
+        response = Client().get(
+            '/search?q=test&collapse=true&page=1&page_size=2')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(transform_results.call_args[0][0],
+                         [Result('1005-4-a')])
+        self.assertEqual(json.loads(response.content.decode('utf-8')), {
+            'total_hits': 3,
+            'results': [{'label_string': '1005-4-a', 'section': '1005-4',
+                         'section_hits': 1}]})
+
+    @override_settings(HAYSTACK_COLLAPSE_CAP=3)
+    @patch('regcore_read.views.haystack_search.SearchQuerySet')
+    @patch('regcore_read.views.haystack_search.transform_results')
+    def test_search_collapse_cap(self, transform_results, sqs):
+        """Only the best HAYSTACK_COLLAPSE_CAP matches should be grouped"""
+        Result = namedtuple('Result', ('label_string',))
+        results = sqs.return_value.models.return_value.filter
+        results.return_value = [
+            Result('1005-2-a'), Result('1005-3'), Result('1005-2-b'),
+            Result('1005-4-a'), Result('1005-3-c')]
+        transform_results.side_effect = lambda hits, doc_type: [
+            {'label_string': h.label_string} for h in hits]
+        response = search(RequestFactory().get('?q=test&collapse=true'),
+                          doc_type='cfr')
+        self.assertEqual(json.loads(response.content.decode('utf-8')), {
+            'total_hits': 2, 'total_hits_relation': 'gte',
+            'results': [
+                {'label_string': '1005-2-a', 'section': '1005-2',
+                 'section_hits': 2},
+                {'label_string': '1005-3', 'section': '1005-3',
+                 'section_hits': 1}]})
+
+    @patch('regcore_read.views.haystack_search.SearchQuerySet')
+    @patch('regcore_read.views.haystack_search.transform_results')
+    def test_search_facets(self, transform_results, sqs):
+        results = sqs.return_value.models.return_value.filter
+        faceted = results.return_value.facet.return_value.facet.return_value
+        faceted.__getitem__.return_value = []
+        faceted.__len__.return_value = 0
+        faceted.facet_counts.return_value = {'fields': {
+            'regulation': [('1005', 3), ('1010', 4)]}}
+        transform_results.return_value = []
+        response = Client().get('/search?q=test&facets=version,regulation')
+        self.assertEqual(200, response.status_code)
+        results.return_value.facet.assert_called_with('regulation')
+        self.assertEqual(json.loads(response.content.decode('utf-8'))[
+            'facets'], {'regulation': [{'value': '1010', 'count': 4},
+                                       {'value': '1005', 'count': 3}],
+                        'version': []})
+
+    @patch('regcore_read.views.haystack_search.SearchQuerySet')
+    @patch('regcore_read.views.haystack_search.transform_results')
+    def test_search_facets_unsupported(self, transform_results, sqs):
+        """Backends without faceting (e.g. the SimpleEngine) should have
+        facets counted from their matches"""
+        Result = namedtuple('Result', ('label_string', 'version'))
+        results = sqs.return_value.models.return_value.filter
+        faceted = results.return_value.facet.return_value.facet.return_value
+        faceted.__getitem__.return_value = []
+        faceted.__len__.return_value = 3
+        faceted.__iter__.return_value = iter([
+            Result('1005-2', 'v1'), Result('1005-3-a', 'v2'),
+            Result('1010-1', 'v1')])
+        faceted.facet_counts.return_value = {}
+        transform_results.return_value = []
+        response = search(
+            RequestFactory().get('?q=test&facets=version,regulation'),
+            doc_type='cfr')
+        self.assertEqual(json.loads(response.content.decode('utf-8'))[
+            'facets'], {'regulation': [{'value': '1005', 'count': 2},
+                                       {'value': '1010', 'count': 1}],
+                        'version': [{'value': 'v1', 'count': 2},
+                                    {'value': 'v2', 'count': 1}]})
+
+    def test_group_by_section(self):
+        Result = namedtuple('Result', ('label_string',))
+        results = [Result('1005'), Result('1005-2-a'), Result('1005-2'),
+                   Result('1005-Subpart-A'), Result('1005-2-a-1'),
+                   Result('1005-Subpart-B')]
+        self.assertEqual(group_by_section(results), [
+            ('1005', [results[0]]),
+            ('1005-2', [results[1], results[2], results[4]]),
+            ('1005-Subpart-A', [results[3]]),
+            ('1005-Subpart-B', [results[5]])])
+
     @patch('regcore_read.views.haystack_search.DMLayers')
     def test_transform_results(self, dmlayers):
         # combine keyterms and terms into a single layer
-        dmlayers.return_value.get.return_value = {
+        layer = {
             '2': [{'key_term': 'k2'}], '3': [{'key_term': 'k3'}],
             '6': [{'key_term': 'k6'}], '7': [{'key_term': 'k7'}],
             'referenced': {
@@ -98,6 +197,8 @@ class ViewsHaystackSearchTest(TestCase):
                 'lab4': {'reference': '7', 'term': 'd7'}
             }
         }
+        dmlayers.return_value.get_many.side_effect = (
+            lambda name, doc_type, doc_ids: {d: layer for d in doc_ids})
 
         Result = namedtuple('Result', ('regulation', 'version',
                                        'label_string', 'text', 'title'))
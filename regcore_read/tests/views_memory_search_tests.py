@@ -0,0 +1,97 @@
+import json
+
+import pytest
+from django.test.client import Client
+
+from regcore import inverted_index
+from regcore.models import Document
+
+
+@pytest.fixture
+def memory_index(tmpdir, monkeypatch, settings):
+    settings.MEMORY_SEARCH_INDEX = str(tmpdir.join('index'))
+    monkeypatch.setattr(inverted_index, '_loaded', {})
+    for idx in range(1, 4):
+        Document.objects.create(
+            id='vvv:1000-{0}'.format(idx),
+            label_string='1000-{0}'.format(idx), text='Some text',
+            title='Section {0}'.format(idx), version='vvv', doc_type='cfr',
+            node_type='regtext')
+    Document.objects.create(
+        id='vvv:1000-4', label_string='1000-4', text='Other', version='vvv',
+        doc_type='cfr')
+
+
+@pytest.mark.django_db
+@pytest.mark.urls('regcore_read.tests.urls')
+@pytest.mark.usefixtures('memory_index')
+def test_search_results():
+    response = Client().get('/memory_search?q=text&version=vvv')
+    assert response.status_code == 200
+    data = json.loads(response.content.decode('utf-8'))
+    assert data['total_hits'] == 3
+    assert [r['label_string'] for r in data['results']] == [
+        '1000-1', '1000-2', '1000-3']
+    assert data['results'][0] == {
+        'text': 'Some text', 'label': ['1000', '1'], 'version': 'vvv',
+        'regulation': '1000', 'label_string': '1000-1',
+        'title': 'Section 1'}
+
+
+@pytest.mark.django_db
+@pytest.mark.urls('regcore_read.tests.urls')
+@pytest.mark.usefixtures('memory_index')
+def test_search_snippet():
+    response = Client().get('/memory_search?q=text&snippet=true&page_size=1')
+    result = json.loads(response.content.decode('utf-8'))['results'][0]
+    assert 'text' not in result
+    assert result['snippet'] == 'Some <b>text</b>'
+
+
+@pytest.mark.django_db
+@pytest.mark.urls('regcore_read.tests.urls')
+@pytest.mark.usefixtures('memory_index')
+def test_search_paging():
+    response = Client().get('/memory_search?q=text&page=1&page_size=2')
+    data = json.loads(response.content.decode('utf-8'))
+    assert data['total_hits'] == 3
+    assert [r['label_string'] for r in data['results']] == ['1000-3']
+    assert 'next_cursor' not in data
+
+
+@pytest.mark.django_db
+@pytest.mark.urls('regcore_read.tests.urls')
+@pytest.mark.usefixtures('memory_index')
+def test_search_cursor():
+    """Following cursors should walk through every result once"""
+    response = Client().get('/memory_search?q=text&page_size=2')
+    data = json.loads(response.content.decode('utf-8'))
+    assert [r['label_string'] for r in data['results']] == [
+        '1000-1', '1000-2']
+
+    response = Client().get('/memory_search', {
+        'q': 'text', 'page_size': 2, 'cursor': data['next_cursor']})
+    data = json.loads(response.content.decode('utf-8'))
+    assert data['total_hits'] == 3
+    assert [r['label_string'] for r in data['results']] == ['1000-3']
+    assert 'next_cursor' not in data
+
+
+@pytest.mark.django_db
+@pytest.mark.urls('regcore_read.tests.urls')
+@pytest.mark.usefixtures('memory_index')
+def test_search_facets():
+    response = Client().get('/memory_search?q=text&facets=version,node_type')
+    data = json.loads(response.content.decode('utf-8'))
+    assert data['facets'] == {
+        'version': [{'value': 'vvv', 'count': 3}],
+        'node_type': [{'value': 'regtext', 'count': 3}]}
+
+
+@pytest.mark.django_db
+@pytest.mark.urls('regcore_read.tests.urls')
+@pytest.mark.usefixtures('memory_index')
+def test_search_filtered():
+    response = Client().get('/memory_search?q=text&version=other')
+    data = json.loads(response.content.decode('utf-8'))
+    assert data == {'total_hits': 0, 'results': []}
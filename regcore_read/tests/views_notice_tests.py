@@ -32,5 +32,6 @@ class ViewsNoticeTest(TestCase):
         storage.for_notices.listing.return_value = [1, 2, 3]
         response = Client().get('/notice')
         self.assertEqual(200, response.status_code)
+        content = b''.join(response.streaming_content)
         self.assertEqual({'results': [1, 2, 3]},
-                         json.loads(response.content.decode('utf-8')))
+                         json.loads(content.decode('utf-8')))
@@ -1,5 +1,7 @@
 import pytest
+from django.http import HttpResponse
 
+from regcore import search_cache
 from regcore_read.views import search_utils
 
 
@@ -23,3 +25,185 @@ def test_valid_page_size(rf):
 
     result = view(rf.get('?q=term&page_size=10'))
     assert result.page_size == 10
+
+
+def test_hit_count(rf, settings):
+    """Estimated counts are capped and say so; exact counts are unchanged"""
+    settings.SEARCH_COUNT_CAP = 10
+    view = search_utils.requires_search_args(inner_fn)
+    exact = view(rf.get('?q=term'))
+    estimate = view(rf.get('?q=term&count=estimate'))
+
+    assert search_utils.count_limit(exact) is None
+    assert search_utils.count_limit(estimate) == 11
+    assert search_utils.hit_count(exact, 25) == {'total_hits': 25}
+    assert search_utils.hit_count(estimate, 10) == {
+        'total_hits': 10, 'total_hits_relation': 'eq'}
+    assert search_utils.hit_count(estimate, 11) == {
+        'total_hits': 10, 'total_hits_relation': 'gte'}
+    assert view(rf.get('?q=term&count=approx')).status_code == 400
+
+
+@pytest.mark.parametrize('cursor', ('abc', 'e30=', 'W1tdXQ==', '!!!'))
+def test_invalid_cursor(cursor, rf):
+    """Cursors must be base64-encoded lists of numbers"""
+    view = search_utils.requires_search_args(inner_fn)
+    result = view(rf.get('?q=term&cursor={0}'.format(cursor)))
+    assert result.status_code == 400
+
+
+def test_cursor(rf):
+    view = search_utils.requires_search_args(inner_fn)
+    assert view(rf.get('?q=term')).cursor is None
+    result = view(rf.get('?q=term&page_size=10&cursor={0}'.format(
+        search_utils.encode_cursor(1.5, 20))))
+    assert result.cursor == [1.5, 20]
+    with pytest.raises(search_utils.InvalidCursor):
+        search_utils.page_bounds(result)
+    assert search_utils.unpack_cursor(result, 2) == [1.5, 20]
+
+    result = view(rf.get('?q=term&page_size=10&cursor={0}'.format(
+        search_utils.encode_cursor(30))))
+    assert search_utils.page_bounds(result) == (30, 40)
+    result = view(rf.get('?q=term&page=2&page_size=10'))
+    assert search_utils.page_bounds(result) == (20, 30)
+
+
+def test_cursor_mismatch(rf):
+    """Handlers given the wrong kind of cursor respond with a 400"""
+    def handler(request, search_args):
+        search_utils.unpack_cursor(search_args, 2)
+    view = search_utils.requires_search_args(handler)
+    result = view(rf.get('?q=term&cursor={0}'.format(
+        search_utils.encode_cursor(30))))
+    assert result.status_code == 400
+
+
+def test_facets(rf):
+    """Facets are optional, de-duplicated and limited to known fields"""
+    view = search_utils.requires_search_args(inner_fn)
+    assert view(rf.get('?q=term')).facets == []
+    assert view(rf.get('?q=term&facets=version,regulation,version')).facets \
+        == ['regulation', 'version']
+    assert view(rf.get('?q=term&facets=text')).status_code == 400
+
+
+def test_format_facets():
+    assert search_utils.format_facets({
+        'version': {'b': 2, 'a': 2, 'c': 5}, 'node_type': {}}) == {
+        'version': [{'value': 'c', 'count': 5}, {'value': 'a', 'count': 2},
+                    {'value': 'b', 'count': 2}],
+        'node_type': []}
+
+
+def test_cached_search(rf, settings):
+    """Successful responses should be cached; errors should not"""
+    settings.SEARCH_CACHE_TTL = 300
+    calls = []
+
+    def view(request, doc_type, search_args):
+        calls.append(search_args.q)
+        return HttpResponse('{}', 'application/json',
+                            200 if search_args.q != 'bad' else 500)
+    view = search_utils.requires_search_args(search_utils.cached_search(view))
+
+    assert view(rf.get('?q=term'), doc_type='cfr').content == b'{}'
+    assert view(rf.get('?q=TERM'), doc_type='cfr').content == b'{}'
+    assert view(rf.get('?q=term'), doc_type='preamble').status_code == 200
+    assert calls == ['term', 'term']
+
+    assert view(rf.get('?q=bad'), doc_type='cfr').status_code == 500
+    assert view(rf.get('?q=bad'), doc_type='cfr').status_code == 500
+    assert len(calls) == 4
+    assert search_cache.stats()['hits'] == 1
+
+    settings.SEARCH_CACHE_TTL = 0
+    view(rf.get('?q=term'), doc_type='cfr')
+    assert len(calls) == 5
+
+
+def test_fetch_layers():
+    """Layers should be memoized within a layer_cache"""
+    class Backend(object):
+        def __init__(self):
+            self.requested = []
+
+        def get_many(self, name, doc_type, doc_ids):
+            self.requested.append(list(doc_ids))
+            return {doc_id: {'id': doc_id} for doc_id in doc_ids
+                    if doc_id != 'missing'}
+
+    backend = Backend()
+    cache = {}
+    with search_utils.layer_cache(cache):
+        assert search_utils.fetch_layers(
+            backend, 'terms', 'cfr', ['a', 'missing']) == {
+                'a': {'id': 'a'}, 'missing': None}
+        assert search_utils.fetch_layers(
+            backend, 'terms', 'cfr', ['a', 'b', 'missing']) == {
+                'a': {'id': 'a'}, 'b': {'id': 'b'}, 'missing': None}
+    assert backend.requested == [['a', 'missing'], ['b']]
+    assert len(cache) == 3
+
+    search_utils.fetch_layers(backend, 'terms', 'cfr', ['a'])
+    assert backend.requested[-1] == ['a']
+
+
+def test_limited_search(settings):
+    """Searches beyond the concurrency limit, or which time out, should be
+    refused"""
+    settings.SEARCH_MAX_CONCURRENT = 2
+    statuses = []
+
+    @search_utils.limited_search
+    def view(depth):
+        if depth == 'timeout':
+            raise search_utils.SearchTimeout()
+        if depth < 3:
+            statuses.append(view(depth + 1).status_code)
+        return HttpResponse('{}', 'application/json')
+
+    assert view(1).status_code == 200
+    assert statuses == [503, 200]   # the third nested search was refused
+
+    # slots are released, even after failures
+    assert view('timeout').status_code == 503
+    assert view(2).status_code == 200
+    assert statuses[-1] == 200
+
+    settings.SEARCH_MAX_CONCURRENT = 0
+    statuses[:] = []
+    assert view(1).status_code == 200
+    assert statuses == [200, 200]
+
+
+def test_highlight():
+    text = ('Each of the first words is context. An overdraft occurs when '
+            'Overdrafts are charged; the rest continues for a while.')
+    assert search_utils.highlight(text, 'overdraft', length=60) == (
+        '...first words is context. An <b>overdraft</b> occurs when '
+        '<b>Overdrafts</b>...')
+    assert search_utils.highlight('Short overdraft text', 'overdraft') == \
+        'Short <b>overdraft</b> text'
+    assert search_utils.highlight('No match here', 'other') == \
+        'No match here'
+    assert search_utils.highlight('', 'other') == ''
+
+
+def test_snippet_results():
+    """Text should be replaced by snippets, computing them if needed"""
+    def search_args(snippet):
+        return search_utils.SearchArgs(
+            q='fee', version=None, regulation=None, is_root=None,
+            is_subpart=None, page=0, page_size=10, collapse=False,
+            count='exact', cursor=None, facets=[], snippet=snippet)
+
+    def results():
+        return [{'text': 'A fee'}, {'text': 'A fee', 'snippet': 'A <b>f</b>'},
+                {'text': None}]
+
+    assert search_utils.snippet_results(results(), search_args(False)) == \
+        results()
+    assert search_utils.snippet_results(results(), search_args(True)) == [
+        {'snippet': 'A <b>fee</b>'}, {'snippet': 'A <b>f</b>'},
+        {'snippet': ''}]
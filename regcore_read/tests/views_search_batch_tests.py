@@ -0,0 +1,96 @@
+import json
+import threading
+
+import pytest
+from django.test.client import Client
+from mock import Mock
+
+from regcore.responses import success
+from regcore_read.views import search_batch
+from regcore_read.views.search_utils import fetch_layers, requires_search_args
+
+layers = Mock()
+threads = set()
+
+
+@requires_search_args
+def fake_search(request, doc_type, search_args):
+    threads.add(threading.current_thread().ident)
+    fetch_layers(layers, 'terms', doc_type, ['v/1005'])
+    return success({'q': search_args.q, 'doc_type': doc_type,
+                    'facets': search_args.facets,
+                    'is_root': search_args.is_root})
+
+
+@pytest.fixture
+def fake_handler(settings):
+    settings.SEARCH_HANDLER = __name__ + '.fake_search'
+    layers.reset_mock()
+    layers.get_many.side_effect = lambda name, doc_type, doc_ids: {
+        doc_id: None for doc_id in doc_ids}
+    threads.clear()
+    yield
+    fake_search.__dict__.pop('concurrent', None)
+
+
+def post(url, body):
+    response = Client().post(url, json.dumps(body),
+                             content_type='application/json')
+    return response.status_code, json.loads(response.content.decode('utf-8'))
+
+
+@pytest.mark.usefixtures('fake_handler')
+def test_batch():
+    """Each query should be searched, sharing their layers"""
+    status, body = post('/search/batch', {'queries': [
+        {'q': 'first', 'facets': ['version', 'regulation']},
+        {'q': 'second', 'is_root': True},
+        {'page_size': 500},
+    ]})
+    assert status == 200
+    assert body['results'][:2] == [
+        {'q': 'first', 'doc_type': 'cfr', 'facets': ['regulation', 'version'],
+         'is_root': None},
+        {'q': 'second', 'doc_type': 'cfr', 'facets': [], 'is_root': True}]
+    assert body['results'][2]['status'] == 400
+    assert 'q' in body['results'][2]['reason']
+    assert layers.get_many.call_count == 1
+    assert threads == {threading.current_thread().ident}
+
+    status, body = post('/search/preamble/batch', {'queries': [{'q': 'q'}]})
+    assert body['results'][0]['doc_type'] == 'preamble'
+
+
+@pytest.mark.usefixtures('fake_handler')
+def test_batch_concurrent(settings):
+    """Handlers marked as concurrent run on worker threads"""
+    settings.SEARCH_BATCH_WORKERS = 2
+    fake_search.concurrent = True
+    status, body = post('/search/batch', {'queries': [
+        {'q': str(idx)} for idx in range(6)]})
+    assert status == 200
+    assert [r['q'] for r in body['results']] == [str(i) for i in range(6)]
+    assert threading.current_thread().ident not in threads
+
+
+@pytest.mark.usefixtures('fake_handler')
+@pytest.mark.parametrize('body', ({}, [], {'queries': 'q'},
+                                  {'queries': ['q']}))
+def test_batch_invalid(body):
+    status, _ = post('/search/batch', body)
+    assert status == 400
+
+
+@pytest.mark.usefixtures('fake_handler')
+def test_batch_limit(settings):
+    settings.SEARCH_BATCH_MAX_QUERIES = 2
+    status, _ = post('/search/batch', {'queries': [{'q': 'q'}] * 3})
+    assert status == 400
+
+
+def test_query_params():
+    params = search_batch.query_params(
+        {'q': 'term', 'is_root': False, 'facets': ['version', 'regulation'],
+         'page': 2})
+    assert params.dict() == {'q': 'term', 'is_root': 'false',
+                             'facets': 'version,regulation', 'page': 2}
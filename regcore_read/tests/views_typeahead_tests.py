@@ -0,0 +1,40 @@
+import json
+
+import pytest
+
+from regcore import typeahead as typeahead_index
+from regcore_read.views import typeahead
+
+
+@pytest.fixture
+def index(monkeypatch):
+    index = typeahead_index.PrefixIndex([
+        typeahead_index.Entry('account', 'Account', typeahead_index.TERM,
+                              'cfr', '1005', '1005-2-b', 'v1'),
+        typeahead_index.Entry('accepted card', 'Accepted card',
+                              typeahead_index.KEYTERM, 'cfr', '1005',
+                              '1005-2-a', 'v1'),
+    ])
+    monkeypatch.setattr(typeahead_index, 'get_index', lambda: index)
+    return index
+
+
+@pytest.mark.usefixtures('index')
+def test_typeahead(rf):
+    response = typeahead.typeahead(rf.get('?q=Acc&limit=1'), doc_type='cfr')
+    assert response.status_code == 200
+    assert json.loads(response.content.decode('utf-8')) == {'results': [{
+        'text': 'Accepted card', 'type': 'keyterm', 'regulation': '1005',
+        'label': '1005-2-a', 'versions': ['v1']}]}
+
+    response = typeahead.typeahead(rf.get('?q=acc&version=v2'),
+                                   doc_type='cfr')
+    assert json.loads(response.content.decode('utf-8')) == {'results': []}
+
+
+@pytest.mark.usefixtures('index')
+@pytest.mark.parametrize('query', ('', '?q=', '?q=a&limit=0',
+                                   '?q=a&limit=500'))
+def test_typeahead_invalid(query, rf):
+    response = typeahead.typeahead(rf.get(query), doc_type='cfr')
+    assert response.status_code == 400
@@ -1,11 +1,68 @@
+import logging
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+
 from regcore.db import storage
+from regcore.diff import (
+    changes_between, get_summary_cache, summarize, summary_cache_key)
 from regcore.responses import four_oh_four, success
 
+logger = logging.getLogger(__name__)
+
 
 def get(request, label_id, old_version, new_version):
-    """Find and return the diff with the provided label / versions"""
+    """Find and return the diff with the provided label / versions. Diffs
+    which weren't uploaded are computed from the stored versions and saved,
+    so they're only computed once"""
     diff = storage.for_diffs.get(label_id, old_version, new_version)
+    if diff is None:
+        diff = compute(label_id, old_version, new_version)
     if diff is not None:
         return success(diff)
     else:
         return four_oh_four()
+
+
+def compute(label_id, old_version, new_version):
+    """Diff two stored versions of a regulation (or part of one). Diffs (and
+    their routes) have no doc_type: only CFR documents have versions.
+    :return: the diff, or None if either version doesn't exist"""
+    old_tree = storage.for_documents.get('cfr', label_id, old_version)
+    new_tree = storage.for_documents.get('cfr', label_id, new_version)
+    if old_tree is None or new_tree is None:
+        return None
+    diff = changes_between(old_tree, new_tree)
+    try:
+        with transaction.atomic():
+            storage.for_diffs.insert(label_id, old_version, new_version, diff,
+                                     summarize(diff))
+    except IntegrityError:  # a concurrent request stored it first
+        pass
+    except Exception:   # e.g. a read-only replica or an unavailable Elastic
+        # Search cluster; the diff is served regardless
+        logger.warning('Could not store the diff of %s between %s and %s',
+                       label_id, old_version, new_version, exc_info=True)
+    return diff
+
+
+def summary(request, label_id, old_version, new_version):
+    """Counts of the nodes added, modified and deleted between the versions,
+    in total and per section, without the diff itself"""
+    ttl = settings.DIFF_SUMMARY_CACHE_TTL
+    if ttl > 0:
+        cache = get_summary_cache()
+        key = summary_cache_key(label_id, old_version, new_version)
+        result = cache.get(key)
+        if result is not None:
+            return success(result)
+
+    result = storage.for_diffs.get_summary(label_id, old_version, new_version)
+    if result is None:
+        diff = compute(label_id, old_version, new_version)
+        if diff is None:
+            return four_oh_four()
+        result = summarize(diff)
+    if ttl > 0:
+        cache.set(key, result, ttl)
+    return success(result)
@@ -2,22 +2,32 @@
 results. If using haystack, see haystack_search.py"""
 
 from django.conf import settings
-from pyelasticsearch import ElasticSearch
+from pyelasticsearch.exceptions import Timeout
 
-from regcore.db.es import ESLayers
+from regcore.db.es import ESLayers, get_client
 from regcore.responses import success
-from regcore_read.views.search_utils import requires_search_args
+from regcore_read.views.search_utils import (
+    HIGHLIGHT_TAGS, SNIPPET_LENGTH, SearchTimeout, cached_search,
+    encode_cursor, fetch_layers, format_facets, hit_count, layer_doc_id,
+    limited_search, page_bounds, requires_search_args)
+
+
+FIELDS = ['text', 'label', 'version', 'regulation', 'title', 'label_string']
+# In snippet mode, the best fragment of each hit's text replaces the text
+HIGHLIGHT = {
+    'pre_tags': [HIGHLIGHT_TAGS[0]], 'post_tags': [HIGHLIGHT_TAGS[1]],
+    'fields': {'text': {'fragment_size': SNIPPET_LENGTH,
+                        'number_of_fragments': 1,
+                        'no_match_size': SNIPPET_LENGTH}},
+}
 
 
 @requires_search_args
+@cached_search
+@limited_search
 def search(request, doc_type, search_args):
     """Search elastic search for any matches in the node's text"""
-    query = {
-        'fields': ['text', 'label', 'version', 'regulation', 'title',
-                   'label_string'],
-        'from': search_args.page * search_args.page_size,
-        'size': search_args.page_size,
-    }
+    query = {}
     text_match = {'match': {'text': search_args.q, 'doc_type': doc_type}}
     if search_args.version or search_args.regulation:
         term = {}
@@ -35,37 +45,140 @@ def search(request, doc_type, search_args):
         }}
     else:
         query['query'] = text_match
-    es = ElasticSearch(settings.ELASTIC_SEARCH_URLS)
-    results = es.search(query, index=settings.ELASTIC_SEARCH_INDEX)
+    if search_args.facets:
+        # size 0 requests every bucket
+        query['aggs'] = {'facet_' + facet: {'terms': {'field': facet,
+                                                      'size': 0}}
+                         for facet in search_args.facets}
+
+    # Elastic Search 1.x can't seek past a sort value (i.e. search_after), so
+    # cursors hold offsets
+    start, end = page_bounds(search_args)
+    fields = FIELDS
+    if search_args.snippet:
+        fields = [field for field in FIELDS if field != 'text']
+    if search_args.collapse:
+        total_hits, hits, aggregations = collapsed_search(
+            query, start, end, fields, search_args.snippet)
+    else:
+        query.update({
+            'fields': fields,
+            'from': start,
+            'size': search_args.page_size,
+        })
+        if search_args.snippet:
+            query['highlight'] = HIGHLIGHT
+        results = timed_search(query)
+        total_hits = results['hits']['total']
+        hits = [with_snippet(h['fields'], h, search_args.snippet)
+                for h in results['hits']['hits']]
+        aggregations = results.get('aggregations', {})
+
+    # Elastic Search 1.x tallies every match while collecting the page, so
+    # estimated counts are merely capped
+    response = hit_count(search_args, total_hits)
+    response['results'] = transform_results(hits, doc_type)
+    if search_args.facets:
+        response['facets'] = format_facets({
+            facet: {bucket['key']: bucket['doc_count'] for bucket
+                    in aggregations['facet_' + facet]['buckets']}
+            for facet in search_args.facets})
+    if len(hits) == search_args.page_size:
+        response['next_cursor'] = encode_cursor(end)
+    return success(response)
+
+
+# Needs no database connection, so batches can run searches concurrently
+search.concurrent = True
+
+
+def timed_search(query):
+    """Run the search, bounded by SEARCH_TIMEOUT. Shards stop collecting
+    matches once the timeout passes (returning partial results, which we
+    discard) and we stop waiting for the response shortly after"""
+    if not settings.SEARCH_TIMEOUT:
+        return get_client().search(query, index=settings.ELASTIC_SEARCH_INDEX)
+    query = dict(query, timeout='{0}ms'.format(
+        int(settings.SEARCH_TIMEOUT * 1000)))
+    try:
+        results = get_client().search(
+            query, index=settings.ELASTIC_SEARCH_INDEX,
+            es_request_timeout=settings.SEARCH_TIMEOUT + 1)
+    except Timeout:
+        raise SearchTimeout()
+    if results.get('timed_out'):
+        raise SearchTimeout()
+    return results
+
+
+def with_snippet(fields, hit, snippet):
+    """Add the hit's highlighted fragment (if in snippet mode) to its
+    fields"""
+    if snippet:
+        fields['snippet'] = hit.get('highlight', {}).get('text', [''])[0]
+    return fields
+
 
-    return success({
-        'total_hits': results['hits']['total'],
-        'results': transform_results([h['fields'] for h in
-                                      results['hits']['hits']])
-    })
+def collapsed_search(query, start, end, fields=FIELDS, snippet=False):
+    """Elastic Search 1.x has no field collapsing, so we bucket matches by
+    section (ordered by their best score) and pull the best-matching node
+    from each bucket. Buckets can't be offset, so we request every bucket up
+    to the end of the page. Buckets are ordered by a script reading each
+    match's score; it's a Lucene expression, as those are sandboxed and so
+    (unlike Groovy) permitted inline by default.
+    :return: the number of matching sections, the page's best hits and the
+    search's aggregations"""
+    top_hits = {'size': 1, '_source': {'include': fields}}
+    if snippet:
+        top_hits['highlight'] = HIGHLIGHT
+    query = dict(query, size=0, aggs=dict(query.get('aggs', {}), **{
+        'sections': {
+            'terms': {'field': 'section', 'size': end,
+                      'order': {'best_score': 'desc'}},
+            'aggs': {
+                'best': {'top_hits': top_hits},
+                'best_score': {'max': {'script': '_score',
+                                       'lang': 'expression'}},
+            },
+        },
+        'section_count': {'cardinality': {'field': 'section'}},
+    }))
+    results = timed_search(query)
+    aggregations = results['aggregations']
+    hits = []
+    for bucket in aggregations['sections']['buckets'][start:end]:
+        best = bucket['best']['hits']['hits'][0]
+        hit = with_snippet(best['_source'], best, snippet)
+        hit['section'] = bucket['key']
+        hit['section_hits'] = bucket['doc_count']
+        hits.append(hit)
+    return aggregations['section_count']['value'], hits, aggregations
 
 
-def transform_results(results):
+def transform_results(results, doc_type='cfr'):
     """Pull out unused fields, add title field from layers if possible"""
-    regulations = {(r['regulation'], r['version']) for r in results}
+    doc_ids = {layer_doc_id(r['regulation'], r['version']) for r in results}
+    # One request per layer type, rather than one per layer
+    all_terms = fetch_layers(ESLayers(), 'terms', doc_type, doc_ids)
+    all_keyterms = fetch_layers(ESLayers(), 'keyterms', doc_type, doc_ids)
 
     layers = {}
-    for regulation, version in regulations:
-        terms = ESLayers().get('terms', regulation, version)
+    for doc_id in doc_ids:
+        terms = all_terms.get(doc_id)
         # We need the references, not the locations of defined terms
         if terms:
             defined = {}
             for term_struct in terms['referenced'].values():
                 defined[term_struct['reference']] = term_struct['term']
             terms = defined
-        layers[(regulation, version)] = {
-            'keyterms': ESLayers().get('keyterms', regulation, version),
+        layers[doc_id] = {
+            'keyterms': all_keyterms.get(doc_id),
             'terms': terms
         }
 
     for result in results:
         title = result.get('title', '')
-        ident = (result['regulation'], result['version'])
+        ident = layer_doc_id(result['regulation'], result['version'])
         keyterms = layers[ident]['keyterms']
         terms = layers[ident]['terms']
         if not title and keyterms and result['label_string'] in keyterms:
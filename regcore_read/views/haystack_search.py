@@ -1,15 +1,24 @@
 """If using the haystack backend, this endpoing provides search results. If
 using Elastic Search, see es_search.py"""
 
+from collections import Counter, OrderedDict
+
+from django.conf import settings
 from haystack.query import SearchQuerySet
 
 from regcore.db.django_models import DMLayers
+from regcore.labels import section_label
 from regcore.models import Document
 from regcore.responses import success
-from regcore_read.views.search_utils import requires_search_args
+from regcore_read.views.search_utils import (
+    cached_search, encode_cursor, fetch_layers, format_facets, hit_count,
+    layer_doc_id, limited_search, page_bounds, requires_search_args,
+    snippet_results)
 
 
 @requires_search_args
+@cached_search
+@limited_search
 def search(request, doc_type, search_args):
     """Use haystack to find search results"""
     query = SearchQuerySet().models(Document).filter(
@@ -22,31 +31,99 @@ def search(request, doc_type, search_args):
         query = query.filter(is_root=search_args.is_root)
     if search_args.is_subpart is not None:
         query = query.filter(is_subpart=search_args.is_subpart)
+    for facet in search_args.facets:
+        query = query.facet(facet)
+
+    # Haystack has no backend-agnostic way to seek past a result, so cursors
+    # hold offsets
+    start, end = page_bounds(search_args)
+
+    truncated = False
+    if search_args.collapse:
+        # Only the best HAYSTACK_COLLAPSE_CAP matches are grouped
+        matches = query[:settings.HAYSTACK_COLLAPSE_CAP + 1]
+        truncated = len(matches) > settings.HAYSTACK_COLLAPSE_CAP
+        sections = group_by_section(matches[:settings.HAYSTACK_COLLAPSE_CAP])
+        page = sections[start:end]
+        results = transform_results([hits[0] for _, hits in page], doc_type)
+        for result, (section, hits) in zip(results, page):
+            result['section'] = section
+            result['section_hits'] = len(hits)
+        total_hits = len(sections)
+    else:
+        # Fetching the page first lets most backends report the number of
+        # matches alongside it, rather than in a separate query
+        results = transform_results(query[start:end], doc_type)
+        total_hits = len(query)
+
+    response = hit_count(search_args, total_hits)
+    if truncated:
+        response['total_hits_relation'] = 'gte'
+    response['results'] = snippet_results(results, search_args)
+    if search_args.facets:
+        # Computed by the search which fetched the results, if the backend
+        # supports faceting
+        counts = query.facet_counts()
+        if 'fields' in counts:
+            counts = {facet: dict(counts['fields'].get(facet, []))
+                      for facet in search_args.facets}
+        else:
+            counts = count_facets(query, search_args.facets)
+        response['facets'] = format_facets(counts)
+    if len(results) == search_args.page_size:
+        response['next_cursor'] = encode_cursor(end)
+    return success(response)
+
 
-    start = search_args.page * search_args.page_size
-    end = start + search_args.page_size
+def facet_value(result, facet):
+    if facet == 'regulation':   # not stored by e.g. the SimpleEngine
+        return result.label_string.split('-')[0]
+    return getattr(result, facet, None)
 
-    return success({
-        'total_hits': len(query),
-        'results': transform_results(query[start:end]),
-    })
+
+def count_facets(results, facets):
+    """Count facet values by walking the results, for backends (e.g. the
+    SimpleEngine) which don't support faceting. Those fetch every match
+    anyway, so this adds no queries.
+    :return: dict of facet -> {value: count}"""
+    counts = {facet: Counter() for facet in facets}
+    for result in results:
+        for facet in facets:
+            counts[facet][facet_value(result, facet)] += 1
+    return counts
+
+
+def group_by_section(results):
+    """Group (relevance-ordered) results by the section which contains them,
+    so the first result in each group is its best match. Haystack has no
+    backend-agnostic grouping, so this walks every result it's given; the
+    search view caps those at HAYSTACK_COLLAPSE_CAP matches.
+    :return: list of (section label, results) pairs, best section first"""
+    sections = OrderedDict()
+    for result in results:
+        sections.setdefault(section_label(result.label_string), []).append(
+            result)
+    return list(sections.items())
 
 
-def transform_results(results):
+def transform_results(results, doc_type='cfr'):
     """Add title field from layers if possible"""
-    regulations = {(r.regulation, r.version) for r in results}
+    results = list(results)
+    doc_ids = {layer_doc_id(r.regulation, r.version) for r in results}
+    all_terms = fetch_layers(DMLayers(), 'terms', doc_type, doc_ids)
+    all_keyterms = fetch_layers(DMLayers(), 'keyterms', doc_type, doc_ids)
 
     layers = {}
-    for regulation, version in regulations:
-        terms = DMLayers().get('terms', regulation, version)
+    for doc_id in doc_ids:
+        terms = all_terms.get(doc_id)
         # We need the references, not the locations of defined terms
         if terms:
             defined = {}
             for term_struct in terms['referenced'].values():
                 defined[term_struct['reference']] = term_struct['term']
             terms = defined
-        layers[(regulation, version)] = {
-            'keyterms': DMLayers().get('keyterms', regulation, version),
+        layers[doc_id] = {
+            'keyterms': all_keyterms.get(doc_id),
             'terms': terms
         }
 
@@ -64,7 +141,7 @@ def transform_results(results):
             title = result.title[0]
         else:
             title = None
-        ident = (result.regulation, result.version)
+        ident = layer_doc_id(result.regulation, result.version)
         keyterms = layers[ident]['keyterms']
         terms = layers[ident]['terms']
         if not title and keyterms and result.label_string in keyterms:
@@ -0,0 +1,43 @@
+"""Search handler backed by an in-memory (memory-mapped) inverted index. Only
+suitable for read-only deployments, as the index is built once, when first
+needed; see regcore.inverted_index"""
+
+from regcore.inverted_index import load_index
+from regcore.responses import success
+from regcore_read.views.search_utils import (
+    encode_cursor, format_facets, hit_count, limited_search,
+    requires_search_args, snippet_results, unpack_cursor)
+
+
+@requires_search_args
+@limited_search
+def search(request, doc_type, search_args):
+    """Search the inverted index for documents containing all terms"""
+    index = load_index()
+    if search_args.cursor is None:
+        start, after = search_args.page * search_args.page_size, None
+    else:
+        start, after = 0, unpack_cursor(search_args, 2)
+    end = start + search_args.page_size
+    filters = dict(
+        doc_type=doc_type, version=search_args.version,
+        regulation=search_args.regulation, is_root=search_args.is_root,
+        is_subpart=search_args.is_subpart)
+    total, ranked = index.search(search_args.q, limit=end, after=after,
+                                 with_scores=True, **filters)
+    page = ranked[start:end]
+
+    response = hit_count(search_args, total)
+    response['results'] = snippet_results(
+        [index.document(doc_id) for doc_id, _ in page], search_args)
+    if search_args.facets:
+        response['facets'] = format_facets(index.facet_counts(
+            search_args.q, search_args.facets, **filters))
+    if len(page) == search_args.page_size:
+        doc_id, score = page[-1]
+        response['next_cursor'] = encode_cursor(score, doc_id)
+    return success(response)
+
+
+# Needs no database connection, so batches can run searches concurrently
+search.concurrent = True
@@ -1,5 +1,5 @@
 from regcore.db import storage
-from regcore.responses import four_oh_four, success
+from regcore.responses import four_oh_four, stream_results, success
 
 
 def get(request, docnum):
@@ -12,8 +12,7 @@ def get(request, docnum):
 
 
 def listing(request):
-    """Find and return all notices"""
-    return success({
-        'results': storage.for_notices.listing(
-            request.GET.get('part', None))
-    })
+    """Find and return all notices, streamed. Should fetching them fail
+    part-way through, the (200) response will be cut short"""
+    return stream_results(
+        storage.for_notices.listing(request.GET.get('part', None)))
@@ -0,0 +1,85 @@
+"""Runs several searches in a single request, e.g. for autocomplete panels.
+Each query is handled by the configured SEARCH_HANDLER as though it were its
+own GET request, so validation, paging and caching all behave as they would
+for individual searches."""
+import json
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.http import HttpRequest, QueryDict
+from django.utils.module_loading import import_string
+from django.views.decorators.csrf import csrf_exempt
+
+from regcore.responses import success, user_error
+from regcore_read.views.search_utils import layer_cache
+
+
+def query_params(query):
+    """Convert a JSON query into the GET parameters a search expects"""
+    params = QueryDict(mutable=True)
+    for key, value in query.items():
+        if isinstance(value, bool):
+            value = 'true' if value else 'false'
+        elif isinstance(value, list):
+            value = ','.join(str(v) for v in value)
+        params[key] = value
+    return params
+
+
+def search_request(request, query):
+    """A GET request for a single query within the batch"""
+    sub_request = HttpRequest()
+    sub_request.method = 'GET'
+    sub_request.META = request.META
+    sub_request.GET = query_params(query)
+    return sub_request
+
+
+def run_search(handler, request, doc_type, cache):
+    """:return: the search's response body. Failed searches also include
+    their status code"""
+    with layer_cache(cache):
+        response = handler(request, doc_type=doc_type)
+    body = json.loads(response.content.decode('utf-8'))
+    if response.status_code != 200:
+        body['status'] = response.status_code
+    return body
+
+
+@csrf_exempt
+def batch(request, doc_type):
+    """Run each of the posted queries ({"queries": [{"q": ...}, ...]}).
+    Layers used to title results are shared between the searches. Handlers
+    marked `concurrent` (those which don't need the database, and hence
+    don't need to share the request's connection) are run on a pool of
+    SEARCH_BATCH_WORKERS threads"""
+    try:
+        body = json.loads(request.body.decode('utf-8'))
+    except (ValueError, UnicodeError):
+        return user_error('invalid format')
+    queries = body.get('queries') if isinstance(body, dict) else None
+    if not isinstance(queries, list) or not all(
+            isinstance(query, dict) for query in queries):
+        return user_error('expected a list of queries')
+    if len(queries) > settings.SEARCH_BATCH_MAX_QUERIES:
+        return user_error('at most {0} queries are allowed'.format(
+            settings.SEARCH_BATCH_MAX_QUERIES))
+
+    handler = import_string(settings.SEARCH_HANDLER)
+    cache = {}
+    requests = [search_request(request, query) for query in queries]
+
+    def run(sub_request):
+        return run_search(handler, sub_request, doc_type, cache)
+
+    workers = min(len(requests), settings.SEARCH_BATCH_WORKERS)
+    if getattr(handler, 'concurrent', False) and workers > 1:
+        pool = ThreadPool(workers)
+        try:
+            results = pool.map(run, requests)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [run(sub_request) for sub_request in requests]
+    return success({'results': results})
@@ -1,12 +1,65 @@
+import base64
+import json
+import re
+import threading
 from collections import namedtuple
+from contextlib import contextmanager
 from functools import wraps
 
+import six
+from django.conf import settings
+from django.http import HttpResponse
 from webargs import fields, validate, ValidationError
 from webargs.djangoparser import parser
 
-from regcore.responses import user_error
+from regcore import search_cache
+from regcore.responses import unavailable, user_error
 
 MAX_PAGE_SIZE = 50
+# Ways of counting matches: exactly, or only up to SEARCH_COUNT_CAP
+EXACT, ESTIMATE = 'exact', 'estimate'
+# Fields which matches can be counted by
+FACETS = ('regulation', 'version', 'node_type')
+# Approximate length (in characters) of highlighted snippets, and the markup
+# wrapped around matching words (as used by Postgres and SQLite)
+SNIPPET_LENGTH = 200
+HIGHLIGHT_TAGS = ('<b>', '</b>')
+
+_local = threading.local()
+# Semaphores limiting concurrent searches, keyed by SEARCH_MAX_CONCURRENT
+_slots = {}
+_slots_lock = threading.Lock()
+
+
+class InvalidCursor(ValueError):
+    """Raised by search handlers given a cursor they can't interpret (e.g.
+    one produced by a different handler)"""
+
+
+class SearchTimeout(Exception):
+    """Raised by search handlers whose query ran longer than SEARCH_TIMEOUT"""
+
+
+class Cursor(fields.Field):
+    """Opaque pagination cursor: a base64-encoded JSON list of the values
+    identifying where the previous page ended"""
+    def _deserialize(self, value, *args, **kwargs):
+        try:
+            values = json.loads(
+                base64.urlsafe_b64decode(str(value)).decode('utf-8'))
+        except (TypeError, ValueError):
+            raise ValidationError('Invalid cursor')
+        if not isinstance(values, list) or not all(
+                isinstance(v, (int, float) + six.string_types)
+                for v in values):
+            raise ValidationError('Invalid cursor')
+        return values
+
+
+def encode_cursor(*values):
+    return base64.urlsafe_b64encode(
+        json.dumps(values).encode('utf-8')).decode('ascii')
+
 
 search_args = {
     'q': fields.Str(required=True),
@@ -17,11 +70,151 @@ search_args = {
     'page': fields.Int(missing=0),
     'page_size': fields.Int(missing=MAX_PAGE_SIZE,
                             validate=validate.Range(1, MAX_PAGE_SIZE)),
+    'collapse': fields.Bool(missing=False),
+    'count': fields.Str(missing=EXACT,
+                        validate=validate.OneOf([EXACT, ESTIMATE])),
+    # Replaces `page` if present
+    'cursor': Cursor(missing=None),
+    'facets': fields.DelimitedList(
+        fields.Str(validate=validate.OneOf(FACETS)), missing=[]),
+    # Return highlighted snippets in place of each result's text
+    'snippet': fields.Bool(missing=False),
 }
 SearchArgs = namedtuple(
     'SearchArgs',
     ['q', 'version', 'regulation', 'is_root', 'is_subpart', 'page',
-     'page_size'])
+     'page_size', 'collapse', 'count', 'cursor', 'facets', 'snippet'])
+
+
+def count_limit(search_args):
+    """The number of matches worth counting, or None if all should be"""
+    if search_args.count == ESTIMATE:
+        return settings.SEARCH_COUNT_CAP + 1
+    return None
+
+
+def hit_count(search_args, count):
+    """Response fields describing the number of matches. Estimated counts
+    are capped, with `total_hits_relation` indicating whether there may be
+    more (as in "1000+")"""
+    if search_args.count != ESTIMATE:
+        return {'total_hits': count}
+    if count > settings.SEARCH_COUNT_CAP:
+        return {'total_hits': settings.SEARCH_COUNT_CAP,
+                'total_hits_relation': 'gte'}
+    return {'total_hits': count, 'total_hits_relation': 'eq'}
+
+
+def unpack_cursor(search_args, length):
+    """The values within the search's cursor, which the handler expects to
+    number `length`"""
+    if len(search_args.cursor) != length:
+        raise InvalidCursor()
+    return search_args.cursor
+
+
+def page_bounds(search_args):
+    """Start and end offsets of the requested page. Handlers which can't seek
+    past the previous page's last result use cursors holding the offset"""
+    if search_args.cursor is None:
+        start = search_args.page * search_args.page_size
+    else:
+        start, = unpack_cursor(search_args, 1)
+    return start, start + search_args.page_size
+
+
+def highlight(text, q, length=SNIPPET_LENGTH):
+    """A snippet of roughly `length` characters of the text, starting a
+    little before the first word matching the query. Matching words (those
+    beginning with one of the query's terms, to allow for plurals, etc.) are
+    wrapped in HIGHLIGHT_TAGS"""
+    terms = re.findall(r'\w+', q.lower(), re.UNICODE)
+    words = list(re.finditer(r'\w+', text, re.UNICODE))
+
+    def matches(word):
+        return any(word.group().lower().startswith(t) for t in terms)
+    first = next((idx for idx, word in enumerate(words) if matches(word)), 0)
+    # Leave a few words of context before the first match
+    window = words[max(0, first - 5):]
+    if not window:
+        return text[:length]
+    start = 0 if window[0] is words[0] else window[0].start()
+    window = [w for w in window if w.end() <= start + length] or window[:1]
+    end = len(text.rstrip()) if window[-1] is words[-1] else window[-1].end()
+
+    fragments, position = [], start
+    for word in window:
+        if matches(word):
+            fragments.extend([text[position:word.start()], HIGHLIGHT_TAGS[0],
+                              word.group(), HIGHLIGHT_TAGS[1]])
+            position = word.end()
+    fragments.append(text[position:end])
+    snippet = ''.join(fragments)
+    if start > 0:
+        snippet = '...' + snippet
+    if end < len(text.rstrip()):
+        snippet += '...'
+    return snippet
+
+
+def snippet_results(results, search_args):
+    """In snippet mode, results carry highlighted snippets in place of their
+    text. Handlers which don't produce snippets themselves get them from
+    `highlight`"""
+    if search_args.snippet:
+        for result in results:
+            text = result.pop('text', None) or ''
+            if 'snippet' not in result:
+                result['snippet'] = highlight(text, search_args.q)
+    return results
+
+
+def format_facets(counts):
+    """Convert a dict of facet -> {value: number of matches} into the
+    response's format: lists of values and counts, most common first"""
+    return {
+        facet: [{'value': value, 'count': count}
+                for value, count in sorted(
+                    values.items(),
+                    key=lambda pair: (-pair[1], str(pair[0])))]
+        for facet, values in counts.items()}
+
+
+def layer_doc_id(regulation, version):
+    """Layers for CFR documents are keyed by version/label"""
+    if version:
+        return '{0}/{1}'.format(version, regulation)
+    return regulation
+
+
+@contextmanager
+def layer_cache(cache):
+    """Within this context (and thread), layers fetched to add titles to
+    search results are memoized in `cache`, which may be shared by several
+    searches and threads"""
+    previous = getattr(_local, 'layer_cache', None)
+    _local.layer_cache = cache
+    try:
+        yield
+    finally:
+        _local.layer_cache = previous
+
+
+def fetch_layers(backend, name, doc_type, doc_ids):
+    """Fetch many layers from the backend, consulting the active
+    `layer_cache`, if any.
+    :return: dict of doc_id -> layer (or None)"""
+    cache = getattr(_local, 'layer_cache', None)
+    if cache is None:
+        return backend.get_many(name, doc_type, doc_ids)
+
+    missing = [doc_id for doc_id in doc_ids
+               if (name, doc_type, doc_id) not in cache]
+    if missing:
+        found = backend.get_many(name, doc_type, missing)
+        for doc_id in missing:
+            cache[(name, doc_type, doc_id)] = found.get(doc_id)
+    return {doc_id: cache[(name, doc_type, doc_id)] for doc_id in doc_ids}
 
 
 def requires_search_args(view):
@@ -33,6 +226,63 @@ def requires_search_args(view):
             user_args = parser.parse(search_args, request)
         except ValidationError as err:
             return user_error(err.messages)
-        return view(request, *args, search_args=SearchArgs(**user_args),
-                    **kwargs)
+        user_args['facets'] = sorted(set(user_args['facets']))
+        try:
+            return view(request, *args, search_args=SearchArgs(**user_args),
+                        **kwargs)
+        except InvalidCursor:
+            return user_error({'cursor': ['Not valid for this search']})
+    return wrapper
+
+
+def search_slots():
+    """This process's semaphore for SEARCH_MAX_CONCURRENT searches"""
+    limit = settings.SEARCH_MAX_CONCURRENT
+    with _slots_lock:
+        if limit not in _slots:
+            _slots[limit] = threading.BoundedSemaphore(limit)
+        return _slots[limit]
+
+
+def limited_search(view):
+    """Wraps a search view (beneath `cached_search`, so cache hits aren't
+    limited) such that at most SEARCH_MAX_CONCURRENT searches run at once in
+    this process. Rather than queue, excess searches and those which time out
+    are refused immediately, so that they can't tie up the workers serving
+    other requests"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        slots = search_slots() if settings.SEARCH_MAX_CONCURRENT else None
+        if slots and not slots.acquire(False):
+            return unavailable('too many concurrent searches')
+        try:
+            return view(*args, **kwargs)
+        except SearchTimeout:
+            return unavailable('search timed out')
+        finally:
+            if slots:
+                slots.release()
+    return wrapper
+
+
+def cached_search(view):
+    """Wraps a search view (beneath `requires_search_args`) in a cache of its
+    successful responses; see regcore.search_cache"""
+    handler = '.'.join([view.__module__, view.__name__])
+
+    @wraps(view)
+    def wrapper(request, doc_type, search_args, *args, **kwargs):
+        if not search_cache.enabled():
+            return view(request, doc_type, search_args, *args, **kwargs)
+        cache = search_cache.get_cache()
+        key = search_cache.cache_key(handler, doc_type, search_args)
+        cached = cache.get(key)
+        search_cache.record(hit=cached is not None)
+        if cached is not None:
+            return HttpResponse(cached, 'application/json')
+
+        response = view(request, doc_type, search_args, *args, **kwargs)
+        if response.status_code == 200:
+            cache.set(key, response.content, settings.SEARCH_CACHE_TTL)
+        return response
     return wrapper
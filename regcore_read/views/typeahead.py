@@ -0,0 +1,46 @@
+"""Typeahead lookup of section titles, keyterms and defined terms by prefix.
+This handler uses the in-process index of regcore.typeahead; see
+TYPEAHEAD_HANDLER for alternatives"""
+from collections import namedtuple
+from functools import wraps
+
+from webargs import fields, validate, ValidationError
+from webargs.djangoparser import parser
+
+from regcore import typeahead as typeahead_index
+from regcore.responses import success, user_error
+
+MAX_LIMIT = 50
+
+typeahead_args = {
+    'q': fields.Str(required=True, validate=validate.Length(min=1)),
+    'version': fields.Str(missing=None),
+    'regulation': fields.Str(missing=None),
+    'limit': fields.Int(missing=10, validate=validate.Range(1, MAX_LIMIT)),
+}
+TypeaheadArgs = namedtuple('TypeaheadArgs',
+                           ['q', 'version', 'regulation', 'limit'])
+
+
+def requires_typeahead_args(view):
+    """Wraps a view in a validation test for typeahead arguments, as
+    `requires_search_args` does for searches"""
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        try:
+            user_args = parser.parse(typeahead_args, request)
+        except ValidationError as err:
+            return user_error(err.messages)
+        return view(request, *args,
+                    typeahead_args=TypeaheadArgs(**user_args), **kwargs)
+    return wrapper
+
+
+@requires_typeahead_args
+def typeahead(request, doc_type, typeahead_args):
+    """Titles and terms starting with the query"""
+    results = typeahead_index.get_index().search(
+        typeahead_args.q, typeahead_args.limit, doc_type,
+        regulation=typeahead_args.regulation,
+        version=typeahead_args.version)
+    return success({'results': results})
@@ -0,0 +1,19 @@
+from django.apps import AppConfig
+
+from regcore.signals import documents_changed
+
+
+def update_index(sender, doc_type, label, version, **kwargs):
+    """SQLite allows only a single writer, so rather than queue changes for a
+    separate process, re-index the affected sections immediately"""
+    from regcore_sqlite.models import update_sections
+    update_sections(doc_type, label, version)
+
+
+class RegcoreSqliteConfig(AppConfig):
+    name = 'regcore_sqlite'
+
+    def ready(self):
+        from regcore.db.django_models import DMDocuments
+        documents_changed.connect(update_index, sender=DMDocuments,
+                                  dispatch_uid='regcore_sqlite_update')
@@ -0,0 +1,27 @@
+import logging
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from regcore.models import Document
+from regcore_sqlite.models import FTS_TABLE, SectionIndex
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Rebuild the SQLite full text index of document sections"
+
+    @transaction.atomic
+    def handle(self, *args, **options):
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM {0}'.format(FTS_TABLE))
+        SectionIndex.objects.all().delete()
+        SectionIndex.add_sections(
+            Document.objects.order_by('tree_id', 'lft').iterator())
+        with connection.cursor() as cursor:
+            # merge the index's b-trees for faster queries
+            cursor.execute("INSERT INTO {0} ({0}) VALUES ('optimize')".format(
+                FTS_TABLE))
+        logger.info('Indexed %s sections', SectionIndex.objects.count())
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('regcore', '0014_auto_20160504_0101'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SectionIndex',
+            fields=[
+                ('id', models.AutoField(
+                    auto_created=True, primary_key=True, serialize=False,
+                    verbose_name='ID')),
+                ('document_id', models.TextField()),
+                ('doc_type', models.SlugField(max_length=20)),
+                ('version', models.SlugField(
+                    blank=True, max_length=20, null=True)),
+                ('label_string', models.SlugField(max_length=200)),
+                ('doc_root', models.SlugField(max_length=200)),
+                ('root_title', models.TextField()),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='sectionindex',
+            index_together=set([('doc_type', 'version', 'label_string'),
+                                ('doc_type', 'version', 'doc_root')]),
+        ),
+        migrations.RunSQL(
+            ["CREATE VIRTUAL TABLE regcore_sqlite_sectiontext USING fts5("
+             "combined_titles, combined_text, tokenize='porter unicode61')"],
+            ["DROP TABLE regcore_sqlite_sectiontext"],
+        ),
+    ]
@@ -0,0 +1,120 @@
+from django.db import connection, models, transaction
+from django.db.models import Q
+
+from regcore.labels import section_label
+from regcore.models import Document
+
+# FTS5 virtual table holding the searchable text of each section. Its rowids
+# match SectionIndex ids
+FTS_TABLE = 'regcore_sqlite_sectiontext'
+
+
+def is_section(document):
+    """Only CFR sections (e.g. 1005-12) are indexed; not the root nor
+    paragraphs"""
+    return document.label_string.count('-') == 1
+
+
+def combine_sections(documents):
+    """Group documents (ordered by tree_id, lft) into their sections.
+    :return: generator of (section, [section and descendants]) pairs"""
+    section, members = None, []
+    for document in documents:
+        if (section and document.tree_id == section.tree_id and
+                document.lft < section.rght):
+            members.append(document)
+            continue
+        if section:
+            yield section, members
+        if is_section(document):
+            section, members = document, [document]
+        else:
+            section, members = None, []
+    if section:
+        yield section, members
+
+
+class SectionIndex(models.Model):
+    """Filterable metadata for each section in the full text index"""
+    document_id = models.TextField()
+    doc_type = models.SlugField(max_length=20)
+    version = models.SlugField(max_length=20, null=True, blank=True)
+    label_string = models.SlugField(max_length=200)
+    doc_root = models.SlugField(max_length=200)     # denormalized
+    root_title = models.TextField()
+
+    class Meta:
+        index_together = (('doc_type', 'version', 'label_string'),
+                          ('doc_type', 'version', 'doc_root'))
+
+    @classmethod
+    def add_sections(cls, documents):
+        """Index all of the sections within these documents (which must be
+        ordered by tree_id, lft)"""
+        with connection.cursor() as cursor:
+            for section, members in combine_sections(documents):
+                index = cls.objects.create(
+                    document_id=section.id,
+                    doc_type=section.doc_type,
+                    version=section.version,
+                    label_string=section.label_string,
+                    doc_root=section.label_string.split('-')[0],
+                    root_title=section.title or '',
+                )
+                cursor.execute(
+                    'INSERT INTO {0} (rowid, combined_titles, combined_text) '
+                    'VALUES (%s, %s, %s)'.format(FTS_TABLE),
+                    [index.pk,
+                     '\n'.join(d.title for d in members if d.title),
+                     '\n'.join(d.text for d in members if d.text)])
+
+    @classmethod
+    def remove(cls, queryset):
+        """Remove these entries, and their text, from the index"""
+        ids = list(queryset.values_list('pk', flat=True))
+        with connection.cursor() as cursor:
+            # chunked to stay under SQLite's parameter limit
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                cursor.execute(
+                    'DELETE FROM {0} WHERE rowid IN ({1})'.format(
+                        FTS_TABLE, ', '.join(['%s'] * len(chunk))),
+                    chunk)
+                cls.objects.filter(pk__in=chunk).delete()
+
+
+def update_sections(doc_type, label, version):
+    """Re-index the sections which contain or are contained by the tree
+    rooted at `label`. Subparts, etc. contain sections which don't share
+    their label's prefix (1005-Subpart-A contains 1005-12), so these are
+    found by their position in the tree"""
+    label_parts = label.split('-')
+    stale = SectionIndex.objects.filter(doc_type=doc_type, version=version,
+                                        doc_root=label_parts[0])
+    version_documents = Document.objects.filter(doc_type=doc_type,
+                                                version=version)
+    if len(label_parts) == 1:
+        documents = Document.objects.filter(
+            tree_id__in=version_documents.filter(label_string=label)
+            .values('tree_id'))
+    else:
+        # If the node was deleted, only its containing section remains
+        node = version_documents.filter(label_string=label).first() or \
+            version_documents.filter(label_string=section_label(label))\
+            .first()
+        if node:
+            node = next((ancestor for ancestor
+                         in node.get_ancestors(include_self=True)
+                         if is_section(ancestor)), node)
+            documents = node.get_descendants(include_self=True)
+        else:
+            documents = version_documents.none()
+        # Sections deleted along with the tree (e.g. a subpart's) would
+        # otherwise be left behind
+        stale = stale.filter(
+            Q(document_id__in=documents.values('id')) |
+            ~Q(document_id__in=version_documents.values('id')))
+
+    with transaction.atomic():
+        SectionIndex.remove(stale)
+        SectionIndex.add_sections(documents.order_by('tree_id', 'lft'))
@@ -0,0 +1,80 @@
+import pytest
+from django.core.management import call_command
+
+from regcore.db.django_models import DMDocuments
+from regcore.models import Document
+from regcore_sqlite.models import SectionIndex, combine_sections
+from regcore_sqlite.tests.utils import make_node, write_tree
+
+
+def sample_tree():
+    return make_node('root', children=[
+        make_node('root-1', 'Section one', 'Sect 1', children=[
+            make_node('root-1-a', 'Para a text', 'Para a'),
+        ]),
+        make_node('root-2', 'Section two', 'Sect 2'),
+    ])
+
+
+@pytest.mark.django_db
+def test_combine_sections():
+    """Sections should be grouped with their descendants"""
+    write_tree(sample_tree())
+    grouped = combine_sections(
+        Document.objects.order_by('tree_id', 'lft'))
+    assert [(s.label_string, [d.label_string for d in members])
+            for s, members in grouped] == [
+                ('root-1', ['root-1', 'root-1-a']), ('root-2', ['root-2'])]
+
+
+def indexed():
+    return sorted(SectionIndex.objects.values_list('label_string', 'version'))
+
+
+@pytest.mark.django_db
+def test_writes_update_index():
+    """Writing or deleting documents should update only the affected
+    sections"""
+    write_tree(sample_tree())
+    write_tree(sample_tree(), version='other')
+    assert indexed() == [('root-1', 'other'), ('root-1', 'vvv'),
+                         ('root-2', 'other'), ('root-2', 'vvv')]
+
+    write_tree(make_node('root-1', 'Replaced', 'Sect 1'))
+    assert indexed() == [('root-1', 'other'), ('root-1', 'vvv'),
+                         ('root-2', 'other'), ('root-2', 'vvv')]
+
+    DMDocuments().bulk_delete('cfr', 'root', 'vvv')
+    assert indexed() == [('root-1', 'other'), ('root-2', 'other')]
+
+
+@pytest.mark.django_db
+def test_subpart_writes_update_index():
+    """Writing or deleting a subpart should update the sections within it,
+    though their labels don't share its prefix"""
+    write_tree(make_node('root', children=[
+        make_node('root-Subpart-A', children=[
+            make_node('root-1', 'One', 'Sect 1'),
+            make_node('root-2', 'Two', 'Sect 2'),
+        ]),
+    ]))
+    assert indexed() == [('root-1', 'vvv'), ('root-2', 'vvv')]
+
+    DMDocuments().bulk_delete('cfr', 'root-Subpart-A', 'vvv')
+    assert indexed() == []
+
+    write_tree(make_node('root-Subpart-A', children=[
+        make_node('root-3', 'Three', 'Sect 3'),
+    ]))
+    assert indexed() == [('root-3', 'vvv')]
+
+
+@pytest.mark.django_db
+def test_rebuild_sqlite_index():
+    """A full rebuild should index every section"""
+    write_tree(sample_tree())
+    SectionIndex.remove(SectionIndex.objects.all())
+    assert indexed() == []
+
+    call_command('rebuild_sqlite_index')
+    assert indexed() == [('root-1', 'vvv'), ('root-2', 'vvv')]
@@ -0,0 +1,7 @@
+from django.conf.urls import url
+
+from regcore_sqlite import views
+
+urlpatterns = [
+    url(r'^sqlite_search$', views.search, kwargs={'doc_type': 'cfr'}),
+]
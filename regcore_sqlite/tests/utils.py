@@ -0,0 +1,24 @@
+from regcore.db.django_models import DMDocuments
+
+
+def make_node(label, text='', title='', children=()):
+    node = {'label': label.split('-'), 'text': text, 'node_type': 'regtext',
+            'children': list(children)}
+    if title:
+        node['title'] = title
+    return node
+
+
+def write_tree(tree, version='vvv'):
+    """Mimic the write view: flatten, then delete and insert"""
+    to_save = []
+
+    def add_node(node, parent=None):
+        node['parent'] = parent
+        to_save.append(node)
+        for child in node['children']:
+            add_node(child, parent=node)
+    add_node(tree)
+    label = '-'.join(tree['label'])
+    DMDocuments().bulk_delete('cfr', label, version)
+    DMDocuments().bulk_insert(to_save, 'cfr', version)
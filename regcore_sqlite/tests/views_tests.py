@@ -0,0 +1,203 @@
+import json
+
+import pytest
+from django.db import connection
+from django.test.client import Client
+
+from regcore_read.views.search_utils import SearchArgs, SearchTimeout
+from regcore_sqlite import views
+from regcore_sqlite.tests.utils import make_node, write_tree
+
+
+def search_args(**kwargs):
+    params = dict(q='', version=None, regulation=None, is_root=None,
+                  is_subpart=None, page=0, page_size=10, collapse=False,
+                  count='exact', cursor=None,
+                  facets=[], snippet=False)
+    params.update(kwargs)
+    return SearchArgs(**params)
+
+
+def test_match_expression():
+    """Terms should be quoted so that they can't be interpreted as FTS5
+    syntax"""
+    assert views.match_expression('some "terms" OR (other)*') == \
+        '"some" "terms" "OR" "other"'
+    assert views.match_expression('?!') == ''
+
+
+def test_matching_sections():
+    """Filters should be converted into SQL"""
+    where, params = views.matching_sections('cfr', search_args(
+        q='terms', version='vvv', regulation='rrr'))
+    assert 'section.version = %s' in where
+    assert 'section.doc_root = %s' in where
+    assert params == ['"terms"', 'cfr', 'vvv', 'rrr']
+
+    where, _ = views.matching_sections('cfr', search_args(
+        q='terms', is_root=False, is_subpart=False))
+    assert ' 0' not in where
+    where, _ = views.matching_sections('cfr', search_args(
+        q='terms', is_subpart=True))
+    assert where.endswith(' 0')
+
+
+def search(**params):
+    response = Client().get('/sqlite_search', params)
+    assert response.status_code == 200
+    return json.loads(response.content.decode('utf-8'))
+
+
+@pytest.mark.django_db
+@pytest.mark.urls('regcore_sqlite.tests.urls')
+def test_search():
+    """Results should be ranked, filtered, paged, and highlighted"""
+    write_tree(make_node('root', children=[
+        make_node('root-1', 'Overdraft fees', 'Fees', children=[
+            make_node('root-1-a', 'Other text'),
+        ]),
+        make_node('root-2', 'Escrow accounts', 'Overdraft'),
+        make_node('root-3', 'Unrelated'),
+    ]))
+    write_tree(make_node('other', children=[
+        make_node('other-1', 'More about overdrafts'),
+    ]), version='v2')
+
+    results = search(q='overdraft')
+    assert results['total_hits'] == 3
+    # title matches outweigh text matches
+    assert [r['label_string'] for r in results['results']][0] == 'root-2'
+    assert {r['label_string'] for r in results['results']} == {
+        'root-1', 'root-2', 'other-1'}
+
+    results = search(q='overdraft fees')
+    assert results['total_hits'] == 1
+    result = results['results'][0]
+    assert result['snippet'] == '<b>Overdraft</b> <b>fees</b>\nOther text'
+    assert result['text'] == 'Overdraft fees\nOther text'
+    assert result['label'] == ['root', '1']
+    assert result['regulation'] == 'root'
+    assert result['title'] == 'Fees'
+    assert result['match_title'] == 'Fees'
+    assert result['paragraph_title'] == 'Fees'
+
+    result = search(q='overdraft fees', snippet='true')['results'][0]
+    assert 'text' not in result
+    assert result['snippet'] == '<b>Overdraft</b> <b>fees</b>\nOther text'
+
+    assert search(q='overdraft', version='v2')['total_hits'] == 1
+    assert search(q='overdraft', regulation='root')['total_hits'] == 2
+    assert search(q='overdraft', is_root='true')['total_hits'] == 0
+
+    paged = search(q='overdraft', page=1, page_size=2)
+    assert paged['total_hits'] == 3
+    assert len(paged['results']) == 1
+
+    assert search(q='"') == {'total_hits': 0, 'results': []}
+
+
+@pytest.mark.django_db
+@pytest.mark.urls('regcore_sqlite.tests.urls')
+def test_search_titles():
+    """As with Postgres, results should include the titles of the first
+    matching node and of the first text-bearing node within it"""
+    write_tree(make_node('root', children=[
+        make_node('root-1', 'Intro', 'Section one', children=[
+            make_node('root-1-a', 'Other', 'Unrelated'),
+            make_node('root-1-b', '', 'Escrow accounts', children=[
+                make_node('root-1-b-1', 'Details', 'Subparagraph'),
+            ]),
+        ]),
+    ]))
+    result = search(q='escrow')['results'][0]
+    assert result['section_title'] == 'Section one'
+    assert result['match_title'] == 'Escrow accounts'
+    assert result['paragraph_title'] == 'Subparagraph'
+
+    # no single node matches every term; fall back to the section
+    result = search(q='escrow details other')['results'][0]
+    assert result['match_title'] == 'Section one'
+    assert result['paragraph_title'] == 'Section one'
+
+
+@pytest.mark.django_db
+@pytest.mark.urls('regcore_sqlite.tests.urls')
+def test_search_cursor():
+    """Following cursors should walk through every result once, in rank
+    order"""
+    write_tree(make_node('root', children=[
+        make_node('root-{0}'.format(idx), 'Overdraft fees')
+        for idx in range(5)] + [make_node('root-5', 'Fees', 'Overdraft')]))
+
+    first = search(q='overdraft', page_size=2)
+    labels = [r['label_string'] for r in first['results']]
+    cursor = first['next_cursor']
+    while cursor:
+        assert len(labels) <= 6
+        results = search(q='overdraft', page_size=2, cursor=cursor)
+        labels.extend(r['label_string'] for r in results['results'])
+        cursor = results.get('next_cursor')
+    assert labels[0] == 'root-5'
+    assert sorted(labels) == ['root-{0}'.format(idx) for idx in range(6)]
+    assert labels == [r['label_string'] for r in
+                      search(q='overdraft', page_size=6)['results']]
+
+
+@pytest.mark.django_db
+@pytest.mark.urls('regcore_sqlite.tests.urls')
+def test_search_facets():
+    """Matches should be counted by each requested facet"""
+    write_tree(make_node('root', children=[
+        make_node('root-1', 'Overdraft fees'),
+        make_node('root-2', 'Overdraft'),
+        make_node('root-3', 'Unrelated')]))
+    write_tree(make_node('other', children=[
+        make_node('other-1', 'Overdraft')]), version='v2')
+
+    results = search(q='overdraft', facets='version,regulation,node_type')
+    assert results['facets'] == {
+        'regulation': [{'value': 'root', 'count': 2},
+                       {'value': 'other', 'count': 1}],
+        'version': [{'value': 'vvv', 'count': 2},
+                    {'value': 'v2', 'count': 1}],
+        'node_type': [{'value': 'regtext', 'count': 3}],
+    }
+    assert 'facets' not in search(q='overdraft')
+
+
+@pytest.mark.django_db
+@pytest.mark.urls('regcore_sqlite.tests.urls')
+def test_search_estimate(settings):
+    """Estimated counts should stop at the cap"""
+    settings.SEARCH_COUNT_CAP = 2
+    write_tree(make_node('root', children=[
+        make_node('root-{0}'.format(idx), 'Overdraft fees')
+        for idx in range(4)]))
+
+    results = search(q='overdraft', count='estimate', page_size=3)
+    assert results['total_hits'] == 2
+    assert results['total_hits_relation'] == 'gte'
+    assert len(results['results']) == 3
+
+    results = search(q='overdraft', count='estimate', regulation='other')
+    assert results['total_hits'] == 0
+    assert results['total_hits_relation'] == 'eq'
+
+
+@pytest.mark.django_db
+def test_interrupt_after_timeout(settings):
+    """Statements running past the timeout should be interrupted"""
+    @views.interrupt_after_timeout
+    def count(limit):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL '
+                'SELECT i + 1 FROM n WHERE i < %s) SELECT count(*) FROM n',
+                [limit])
+            return cursor.fetchone()[0]
+
+    settings.SEARCH_TIMEOUT = 0.05
+    assert count(10) == 10
+    with pytest.raises(SearchTimeout):
+        count(10 ** 12)
+    assert count(10) == 10
@@ -0,0 +1,247 @@
+import re
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.db import OperationalError, connection
+
+from regcore.models import Document
+from regcore.responses import success
+from regcore_read.views.search_utils import (
+    SearchTimeout, cached_search, count_limit, encode_cursor, format_facets,
+    hit_count, limited_search, requires_search_args, snippet_results,
+    unpack_cursor)
+from regcore_sqlite.models import FTS_TABLE, SectionIndex
+
+# Relative weights of the titles and text columns when ranking
+BM25_WEIGHTS = (2.5, 1.0)
+SNIPPET_TOKENS = 32
+# SQLite calls our progress handler (to check the timeout) after this many
+# virtual machine instructions
+PROGRESS_INSTRUCTIONS = 10000
+
+SEARCH_SQL = """
+SELECT section.document_id, section.version, section.label_string,
+       section.doc_root, section.root_title, {fts}.combined_text,
+       snippet({fts}, 1, '<b>', '</b>', '...', {snippet_tokens}),
+       bm25({fts}, {weights}) AS score, section.id
+FROM {fts}
+JOIN {index} AS section ON section.id = {fts}.rowid
+WHERE {where} {after}
+ORDER BY score, section.id
+LIMIT %s OFFSET %s
+"""
+
+# Each facet is a GROUP BY over the same matches, combined into one query
+FACET_SQL = """
+WITH matches AS (
+    SELECT section.doc_root AS regulation, section.version,
+           document.node_type
+    FROM {fts}
+    JOIN {index} AS section ON section.id = {fts}.rowid
+    LEFT JOIN {document} AS document ON document.id = section.document_id
+    WHERE {where}
+)
+{groups}
+"""
+FACET_GROUP_SQL = "SELECT %s, {facet}, COUNT(*) FROM matches GROUP BY 2"
+
+# The nodes of each of the page's sections, in tree order. The FTS table
+# only holds whole sections, so nodes matching the query are found from
+# these (see fetch_titles)
+NODES_SQL = """
+SELECT section.id, node.lft, node.rght, node.title, node.text
+FROM {document} AS section
+JOIN {document} AS node ON node.tree_id = section.tree_id
+                       AND node.lft BETWEEN section.lft AND section.rght
+WHERE section.id IN ({ids})
+ORDER BY node.tree_id, node.lft
+"""
+
+# Seeks past the (score, id) of the previous page's last section
+AFTER_SQL = "AND (score > %s OR (score = %s AND section.id > %s))"
+
+COUNT_SQL = """
+SELECT COUNT(*)
+FROM {fts}
+JOIN {index} AS section ON section.id = {fts}.rowid
+WHERE {where}
+"""
+
+CAPPED_COUNT_SQL = """
+SELECT COUNT(*) FROM (
+    SELECT 1
+    FROM {fts}
+    JOIN {index} AS section ON section.id = {fts}.rowid
+    WHERE {where}
+    LIMIT %s
+)
+"""
+
+
+def match_expression(q):
+    """Convert free text into an FTS5 query matching all of its terms.
+    Quoting each term keeps user input from being parsed as FTS5 syntax"""
+    terms = re.findall(r'\w+', q, re.UNICODE)
+    return ' '.join('"{0}"'.format(term) for term in terms)
+
+
+def matching_sections(doc_type, search_args):
+    """Build the WHERE clause (and its parameters) for a search"""
+    clauses = [FTS_TABLE + ' MATCH %s', 'section.doc_type = %s']
+    params = [match_expression(search_args.q), doc_type]
+    if search_args.version:
+        clauses.append('section.version = %s')
+        params.append(search_args.version)
+    if search_args.regulation:
+        clauses.append('section.doc_root = %s')
+        params.append(search_args.regulation)
+    # Only sections are indexed; never roots nor subparts
+    if search_args.is_root or search_args.is_subpart:
+        clauses.append('0')
+    return ' AND '.join(clauses), params
+
+
+def interrupt_after_timeout(view):
+    """SQLite has no statement timeout, so we interrupt statements from its
+    progress handler once SEARCH_TIMEOUT seconds have passed"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not settings.SEARCH_TIMEOUT:
+            return view(*args, **kwargs)
+        deadline = time.time() + settings.SEARCH_TIMEOUT
+        connection.ensure_connection()
+        # A true return value aborts the running statement
+        connection.connection.set_progress_handler(
+            lambda: time.time() > deadline, PROGRESS_INSTRUCTIONS)
+        try:
+            return view(*args, **kwargs)
+        except OperationalError as err:
+            if 'interrupted' in str(err):
+                raise SearchTimeout()
+            raise
+        finally:
+            connection.connection.set_progress_handler(None, 0)
+    return wrapper
+
+
+@requires_search_args
+@cached_search
+@limited_search
+@interrupt_after_timeout
+def search(request, doc_type, search_args):
+    if not match_expression(search_args.q):
+        return success({'total_hits': 0, 'results': []})
+
+    where, params = matching_sections(doc_type, search_args)
+    table_names = {'fts': FTS_TABLE, 'index': SectionIndex._meta.db_table,
+                   'where': where}
+    limit = count_limit(search_args)
+    with connection.cursor() as cursor:
+        if limit is None:
+            cursor.execute(COUNT_SQL.format(**table_names), params)
+        else:
+            cursor.execute(CAPPED_COUNT_SQL.format(**table_names),
+                           params + [limit])
+        total_hits = cursor.fetchone()[0]
+
+        if search_args.cursor is None:
+            after, after_params = '', []
+            offset = search_args.page * search_args.page_size
+        else:
+            score, pk = unpack_cursor(search_args, 2)
+            after, after_params = AFTER_SQL, [score, score, pk]
+            offset = 0
+        cursor.execute(
+            SEARCH_SQL.format(
+                snippet_tokens=SNIPPET_TOKENS,
+                weights=', '.join(str(w) for w in BM25_WEIGHTS),
+                after=after, **table_names),
+            params + after_params + [search_args.page_size, offset])
+        rows = cursor.fetchall()
+
+    response = hit_count(search_args, total_hits)
+    response['results'] = snippet_results(
+        transform_results(rows, fetch_titles(rows, search_args.q)),
+        search_args)
+    if search_args.facets:
+        response['facets'] = format_facets(
+            facet_counts(search_args, table_names, params))
+    if len(rows) == search_args.page_size:
+        response['next_cursor'] = encode_cursor(*rows[-1][-2:])
+    return success(response)
+
+
+def facet_counts(search_args, table_names, params):
+    """Count the matching sections by each of the requested facets.
+    :return: dict of facet -> {value: count}"""
+    groups = ' UNION ALL '.join(
+        FACET_GROUP_SQL.format(facet=facet) for facet in search_args.facets)
+    counts = {facet: {} for facet in search_args.facets}
+    with connection.cursor() as cursor:
+        cursor.execute(
+            FACET_SQL.format(document=Document._meta.db_table, groups=groups,
+                             **table_names),
+            params + list(search_args.facets))
+        for facet, value, count in cursor.fetchall():
+            counts[facet][value] = count
+    return counts
+
+
+def words(text):
+    return set(re.findall(r'\w+', text.lower(), re.UNICODE))
+
+
+def fetch_titles(rows, q):
+    """As regcore_pgsql does, find the first node (in tree order) of each
+    section whose text or title contains every term of the query, and the
+    first text-bearing node within that match.
+    :return: dict of section id -> (match title, paragraph title)"""
+    ids = [row[0] for row in rows]
+    if not ids:
+        return {}
+    nodes = {}
+    with connection.cursor() as cursor:
+        cursor.execute(
+            NODES_SQL.format(document=Document._meta.db_table,
+                             ids=', '.join(['%s'] * len(ids))),
+            ids)
+        for section_id, lft, rght, title, text in cursor.fetchall():
+            nodes.setdefault(section_id, []).append(
+                (lft, rght, title or '', text or ''))
+
+    terms, titles = words(q), {}
+    for section_id, section_nodes in nodes.items():
+        match = next((node for node in section_nodes
+                      if terms <= words(node[2]) or terms <= words(node[3])),
+                     section_nodes[0])
+        text_node = next((node for node in section_nodes
+                          if match[0] <= node[0] <= match[1] and node[3]),
+                         None)
+        titles[section_id] = (match[2], text_node[2] if text_node else '')
+    return titles
+
+
+def transform_results(rows, titles):
+    """Convert rows of the search query into the corresponding dict for
+    serialization. Mirrors the titles provided by regcore_pgsql, though the
+    label and text are always the whole section's (as indexed).
+    :param titles: see fetch_titles"""
+    final_results = []
+    for row in rows:
+        section_id, version, label_string, doc_root, title, text, snippet = \
+            row[:7]
+        match_title, paragraph_title = titles.get(section_id, (title, ''))
+        final_results.append({
+            'text': text,
+            'snippet': snippet,
+            'label': label_string.split('-'),
+            'version': version,
+            'regulation': doc_root,
+            'label_string': label_string,
+            'match_title': match_title,
+            'paragraph_title': paragraph_title,
+            'section_title': title,
+            'title': title,
+        })
+    return final_results
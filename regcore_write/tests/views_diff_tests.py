@@ -22,4 +22,18 @@ class ViewsDiffTest(TestCase):
                      data=json.dumps({'some': 'struct'}))
         args = storage.for_diffs.insert.call_args[0]
         self.assertEqual(('lablab', 'oldold', 'newnew', {'some': 'struct'}),
-                         args)
+                         args[:4])
+
+    @patch('regcore_write.views.diff.invalidate_summaries')
+    @patch('regcore_write.views.diff.storage')
+    def test_add_summary(self, storage, invalidate_summaries):
+        """A summary should be stored with the diff"""
+        diff = {'1005-2': {'op': 'added'}, '1005-2-a': {'op': 'added'},
+                '1005-3-b': {'op': 'deleted'}}
+        Client().put('/diff/1005/oldold/newnew',
+                     content_type='application/json', data=json.dumps(diff))
+        self.assertEqual(storage.for_diffs.insert.call_args[0][4], {
+            'added': 2, 'modified': 0, 'deleted': 1, 'sections': {
+                '1005-2': {'added': 2, 'modified': 0, 'deleted': 0},
+                '1005-3': {'added': 0, 'modified': 0, 'deleted': 1}}})
+        invalidate_summaries.assert_called_once_with('oldold', 'newnew')
@@ -1,4 +1,5 @@
 from regcore.db import storage
+from regcore.diff import invalidate_summaries, summarize
 from regcore.responses import success
 from regcore_write.views.security import json_body, secure_write
 
@@ -6,11 +7,15 @@ from regcore_write.views.security import json_body, secure_write
 @secure_write
 @json_body
 def add(request, label_id, old_version, new_version):
-    """Add the diff to the db, indexed by the label and versions"""
+    """Add the diff to the db, indexed by the label and versions, along with
+    its summary"""
     #   @todo: write a schema that verifies the diff's structure
+    diff = request.json_body
+    summary = summarize(diff) if isinstance(diff, dict) else None
     storage.for_diffs.delete(label_id, old_version, new_version)
-    storage.for_diffs.insert(
-        label_id, old_version, new_version, request.json_body)
+    storage.for_diffs.insert(label_id, old_version, new_version, diff,
+                             summary)
+    invalidate_summaries(old_version, new_version)
     return success()
 
 
@@ -18,4 +23,5 @@ def add(request, label_id, old_version, new_version):
 def delete(request, label_id, old_version, new_version):
     """Delete the diff from the db"""
     storage.for_diffs.delete(label_id, old_version, new_version)
+    invalidate_summaries(old_version, new_version)
     return success()
@@ -7,7 +7,6 @@ setup(
     packages=find_packages(),
     include_package_data=True,
     install_requires=[
-        'cached_property',
         'django>=1.10,<1.12',
         'django-mptt~=0.8.6',
         'jsonschema',